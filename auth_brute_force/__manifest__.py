@@ -3,7 +3,7 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 {
     'name': 'Authentication - Brute-Force Filter',
-    'version': '11.0.1.2.0',
+    'version': '11.0.1.7.0',
     'category': 'Tools',
     'summary': "Track Authentication Attempts and Prevent Brute-force Attacks",
     'author': "GRAP, "
@@ -14,9 +14,11 @@
     'depends': [
         # If we don't depend on it, it would inhibit this addon
         "auth_crypt",
+        "web",
     ],
     'data': [
         'security/ir_model_access.yml',
+        'data/ir_cron.xml',
         'views/view.xml',
         'views/action.xml',
         'views/menu.xml',
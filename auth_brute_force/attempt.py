@@ -0,0 +1,92 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+"""Authentication attempt running in the current request.
+
+One login goes through several nested auth methods (``authenticate``,
+``_login``, ``check_credentials``...). All of them share the same
+:class:`AttemptContext`, so they know its remote, login and ban decision
+without asking the database again.
+
+Each finished attempt adds the queries it cost to process-wide stats,
+available through :func:`stats`.
+"""
+
+import logging
+import threading
+
+_logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_stats = {"attempts": 0, "queries": 0}
+_stats_lock = threading.Lock()
+
+
+class AttemptContext(object):
+    """State of one authentication attempt."""
+
+    __slots__ = (
+        "login", "remote", "result", "create_date", "decisions", "queries",
+        "depth",
+    )
+
+    def __init__(self, login, remote, create_date):
+        self.login = login
+        self.remote = remote
+        self.result = False
+        self.create_date = create_date
+        # Ban decisions, by (remote, login)
+        self.decisions = {}
+        # Queries run while checking credentials
+        self.queries = 0
+        # Nesting level of auth methods using this attempt
+        self.depth = 0
+
+    def values(self):
+        """Get values to store this attempt."""
+        return {
+            "login": self.login,
+            "remote": self.remote,
+            "result": self.result,
+            "create_date": self.create_date,
+        }
+
+
+def current():
+    """Get the attempt running in this thread, if any."""
+    return getattr(_local, "attempt", None)
+
+
+def enter(attempt):
+    """Make an attempt current, or nest it once more if it is already."""
+    _local.attempt = attempt
+    attempt.depth += 1
+
+
+def leave(attempt):
+    """Exit one nesting level, finishing the attempt after the last one."""
+    attempt.depth -= 1
+    if attempt.depth:
+        return
+    _local.attempt = None
+    with _stats_lock:
+        _stats["attempts"] += 1
+        _stats["queries"] += attempt.queries
+    _logger.debug(
+        "Authentication attempt of %r from %s: %s, %d queries",
+        attempt.login,
+        attempt.remote,
+        attempt.result,
+        attempt.queries,
+    )
+
+
+def stats():
+    """Get finished attempts and queries they cost in this process.
+
+    :return dict:
+        ``attempts``, ``queries`` and ``queries_per_attempt``.
+    """
+    with _stats_lock:
+        result = dict(_stats)
+    result["queries_per_attempt"] = (
+        result["queries"] / result["attempts"] if result["attempts"] else 0.0)
+    return result
@@ -0,0 +1,241 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+"""Ban table shared by all workers through a memory-mapped file.
+
+When a worker finds that a remote or remote+login pair is banned, it stores
+it here, so any other worker can reject it without asking PostgreSQL. Since
+it lives in a file under the data dir, it survives worker recycling too.
+
+The table is a fixed-size open addressing hash table. Readers never lock;
+they use a sequence counter (seqlock) to detect and retry torn reads.
+Writers serialize through a lock between threads, and ``flock()`` between
+processes. Entries expire after some time, so
+the attempts table stays the single source of truth.
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from odoo.tools import config
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_logger = logging.getLogger(__name__)
+
+FILE_NAME = "auth_brute_force.bans"
+MAGIC = b"ABFBAN01"
+# Magic, sequence and amount of slots
+HEADER = struct.Struct("<8sQQ")
+# Key hash, database hash and expiration timestamp; key hash 0 means empty
+SLOT = struct.Struct("<QQd")
+SLOTS = 1 << 16
+# Slots visited when looking for a key
+MAX_PROBES = 32
+# Seconds a ban is trusted without checking the database again
+TTL = 300
+# Times a reader retries before giving up and letting the database answer
+MAX_RETRIES = 100
+
+
+def _hash(*parts):
+    """Get a non-zero 64 bits hash of some strings."""
+    digest = hashlib.sha1("\0".join(parts).encode("utf-8")).digest()
+    return struct.unpack("<Q", digest[:8])[0] | 1
+
+
+class BanTable(object):
+    """Bans shared among processes through a memory-mapped file."""
+
+    #: Whether other workers see bans stored here
+    shared = True
+
+    def __init__(self, path, slots=SLOTS):
+        self.path = path
+        self.slots = slots
+        self.size = HEADER.size + SLOT.size * slots
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # flock() locks belong to the file, shared by threads of a process
+        self.lock = threading.Lock()
+        with self._locked():
+            if os.fstat(self.fd).st_size != self.size or \
+                    os.pread(self.fd, len(MAGIC), 0) != MAGIC:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, self.size)
+                os.pwrite(self.fd, HEADER.pack(MAGIC, 0, slots), 0)
+        self.map = mmap.mmap(self.fd, self.size)
+
+    def _locked(self):
+        return _FileLock(self.fd)
+
+    def _seq(self):
+        return HEADER.unpack_from(self.map, 0)[1]
+
+    def _set_seq(self, seq):
+        struct.pack_into("<Q", self.map, len(MAGIC), seq)
+
+    def _probes(self, key_hash):
+        start = key_hash % self.slots
+        for n in range(MAX_PROBES):
+            index = (start + n) % self.slots
+            yield index, HEADER.size + index * SLOT.size
+
+    def _read(self, fn, default):
+        """Run a reader function until it gets a consistent view."""
+        for _n in range(MAX_RETRIES):
+            seq = self._seq()
+            if seq % 2:
+                time.sleep(0)
+                continue
+            result = fn()
+            if self._seq() == seq:
+                return result
+        return default
+
+    def _write(self, fn):
+        """Run a writer function, making readers retry meanwhile."""
+        with self.lock, self._locked():
+            # Sequence is still odd if last writer died while writing
+            seq = self._seq() | 1
+            self._set_seq(seq)
+            try:
+                return fn()
+            finally:
+                self._set_seq(seq + 1)
+
+    @staticmethod
+    def _key_hash(namespace, dbname, remote, login):
+        if login is None:
+            return _hash(namespace, dbname, remote)
+        return _hash(namespace, dbname, remote, login)
+
+    def banned(self, dbname, remote, login=None, namespace="ban"):
+        """Know if a remote or remote+login pair is banned.
+
+        :param str dbname:
+            Database where the ban applies.
+
+        :param str remote:
+            Remote IP.
+
+        :param str login:
+            Supply it to check the remote+login combination.
+
+        :param str namespace:
+            Kind of ban, to keep several of them for the same key.
+        """
+        key_hash = self._key_hash(namespace, dbname, remote, login)
+
+        def _find():
+            for index, offset in self._probes(key_hash):
+                found, _db_hash, expires = SLOT.unpack_from(self.map, offset)
+                if not found:
+                    return 0
+                if found == key_hash:
+                    return expires
+            return 0
+
+        return self._read(_find, 0) > time.time()
+
+    def ban(self, dbname, remote, login=None, ttl=TTL, namespace="ban"):
+        """Ban a remote or remote+login pair for some time."""
+        key_hash = self._key_hash(namespace, dbname, remote, login)
+        db_hash = _hash(dbname)
+        now = time.time()
+
+        def _store():
+            target = oldest = None
+            for index, offset in self._probes(key_hash):
+                found, _db_hash, expires = SLOT.unpack_from(self.map, offset)
+                if found == key_hash:
+                    target = offset
+                    break
+                if target is None and (not found or expires <= now):
+                    target = offset
+                if not found:
+                    break
+                if oldest is None or expires < oldest[1]:
+                    oldest = offset, expires
+            if target is None:
+                target = oldest[0]
+            SLOT.pack_into(self.map, target, key_hash, db_hash, now + ttl)
+
+        self._write(_store)
+
+    def clear(self, dbname):
+        """Lift all bans of a database, of any kind."""
+        db_hash = _hash(dbname)
+
+        def _clear():
+            data = self.map[HEADER.size:]
+            for index, slot in enumerate(SLOT.iter_unpack(data)):
+                if slot[0] and slot[1] == db_hash and slot[2]:
+                    SLOT.pack_into(
+                        self.map, HEADER.size + index * SLOT.size,
+                        slot[0], slot[1], 0)
+
+        self._write(_clear)
+
+
+class _FileLock(object):
+    """Exclusive ``flock()`` as a context manager."""
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def __enter__(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+class _NullTable(object):
+    """Used when bans cannot be shared; workers use only the database."""
+
+    shared = False
+
+    def banned(self, dbname, remote, login=None, namespace="ban"):
+        return False
+
+    def ban(self, dbname, remote, login=None, ttl=TTL, namespace="ban"):
+        pass
+
+    def clear(self, dbname):
+        pass
+
+
+_table = None
+_table_pid = None
+_table_lock = threading.Lock()
+
+
+def get():
+    """Get the ban table of this process.
+
+    It is opened again after forking, because ``flock()`` locks are shared
+    by file descriptors inherited from the parent process.
+    """
+    global _table, _table_pid
+    pid = os.getpid()
+    if _table_pid == pid:
+        return _table
+    with _table_lock:
+        if _table_pid != pid:
+            table = _NullTable()
+            if fcntl is not None:
+                try:
+                    os.makedirs(config["data_dir"], exist_ok=True)
+                    table = BanTable(
+                        os.path.join(config["data_dir"], FILE_NAME))
+                except (OSError, ValueError):
+                    _logger.warning(
+                        "Cannot share bans among workers", exc_info=True)
+            _table, _table_pid = table, pid
+    return _table
@@ -0,0 +1,61 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+import hmac
+
+from werkzeug.exceptions import NotFound
+
+from odoo import _, http
+from odoo.addons.web.controllers.main import Home
+from odoo.http import request
+from odoo.tools import config
+
+from .. import metrics, remote
+from ..whitelist import WhitelistIndex
+
+
+class MetricsController(http.Controller):
+    @http.route("/auth_brute_force/metrics", type="http", auth="none")
+    def metrics(self):
+        """Export authentication metrics for Prometheus.
+
+        Only requests with the ``auth_brute_force_metrics_token`` server
+        option as bearer token, or from remotes in the
+        ``auth_brute_force_metrics_remotes`` one, can read them. Nothing is
+        allowed by default, not even local remotes, which may be proxies.
+        """
+        if not self._metrics_allowed():
+            raise NotFound()
+        return http.Response(
+            metrics.render(),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+
+    @staticmethod
+    def _metrics_allowed():
+        """Know if the current request can read metrics."""
+        token = config.get("auth_brute_force_metrics_token")
+        if token:
+            header = request.httprequest.headers.get("Authorization", "")
+            scheme, _space, value = header.partition(" ")
+            if scheme.lower() == "bearer" and hmac.compare_digest(
+                    value.strip().encode(), token.encode()):
+                return True
+        remotes = config.get("auth_brute_force_metrics_remotes")
+        # Resolved through trusted proxies, see `remote.resolve()`
+        return bool(remotes) and remote.get() in WhitelistIndex(
+            remotes.split(","))
+
+
+class LoginController(Home):
+    @http.route()
+    def web_login(self, redirect=None, **kw):
+        """Ask to retry later instead of reporting a wrong password."""
+        response = super(LoginController, self).web_login(
+            redirect=redirect, **kw)
+        qcontext = getattr(response, "qcontext", None)
+        if qcontext is not None and \
+                getattr(request, "auth_brute_force_delayed", False):
+            qcontext["error"] = _(
+                "Too many failed attempts. Wait a moment before logging in "
+                "again.")
+        return response
@@ -0,0 +1,598 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+"""In-memory failure counters used to answer ban checks without searches.
+
+Each worker keeps one :class:`AttemptCounters` per database. It tracks, for
+every remote and remote+login pair seen recently, the failures recorded
+since the last successful (or unbanned) attempt. That is exactly what
+``res.authentication.attempt._hits_limit`` used to compute with 2 queries.
+
+Counters are filled lazily from the attempts table the first time a key is
+asked for, and kept current by :meth:`AttemptCounters.sync`, that reads only
+the attempts newer than the last seen one, plus those that were missing or
+still waiting for a result. Applying an attempt is idempotent, so reading it
+twice is harmless.
+
+Attempts of this worker are counted as soon as they finish, through
+:meth:`AttemptCounters.record`, even before they get stored. They keep a
+provisional id until :meth:`AttemptCounters.confirm` is called, after they
+are committed; syncs that read them before are told their ids beforehand by
+:meth:`AttemptCounters.expect`.
+
+Changes other than new attempts, like unbanning or deleting them, bump the
+:data:`GENERATION_SEQUENCE`. Syncs read it together with new attempts, and
+rebuild all counters when it changes.
+
+Failures are also aggregated by the networks that contain each remote, for
+the configured prefix lengths, except for whitelisted remotes. Those
+counters cover a sliding time window instead, and are seeded from the
+attempts stored within that window, aggregated by remote and minute.
+Unbanned attempts reset the counters of the networks overlapping their
+remote, which may be a network itself (see ``bulk_unban()``).
+"""
+
+import heapq
+import ipaddress
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+OK_RESULTS = ("successful", "unbanned")
+# Attempts rejected while backing off; neither failures nor successes
+NEUTRAL_RESULTS = ("delayed",)
+
+# Seconds to wait for a missing or pending attempt to get its result
+PENDING_TIMEOUT = 60
+# Missing ids tracked at once; bigger gaps come from rollbacks, not attempts
+MAX_GAP = 10000
+# Seconds after which all counters are dropped and rebuilt from database
+MAX_AGE = 300
+# Amount of remote and remote+login keys kept per database
+MAX_KEYS = 10000
+# Failures tracked per key; higher limits would never be reached
+MAX_FAILURES = 10000
+# Ids for attempts not stored yet; they sort after any stored one
+PROVISIONAL = 1 << 62
+# Sequence bumped when counters of all workers must be rebuilt
+GENERATION_SEQUENCE = "res_authentication_attempt_generation_seq"
+
+# Tie breaker of network failures with the same timestamp
+_order = itertools.count()
+
+
+class _KeyState(object):
+    """Failures of one remote or remote+login pair since its last success.
+
+    :attr:`last_ok` is the id of the last stored success. Successes of this
+    worker that are not stored yet drop the failures counted so far, but
+    leave it alone: failures of other workers synced meanwhile may be older
+    or newer, and are counted until the success gets its real id.
+    """
+
+    __slots__ = ("loaded", "last_ok", "failures", "last_failure")
+
+    def __init__(self):
+        self.loaded = False
+        self.last_ok = 0
+        self.failures = set()
+        # Timestamp of the newest failure
+        self.last_failure = 0
+
+    def apply(self, attempt_id, result, timestamp=0):
+        """Account one attempt that already has a result."""
+        if attempt_id <= self.last_ok or result in NEUTRAL_RESULTS:
+            return
+        if result in OK_RESULTS:
+            if attempt_id < PROVISIONAL:
+                self.last_ok = attempt_id
+            self.failures = {f for f in self.failures if f > attempt_id}
+        elif result:
+            self.failures.add(attempt_id)
+            self.last_failure = max(self.last_failure, timestamp)
+            if len(self.failures) > MAX_FAILURES:
+                self.failures.discard(min(self.failures))
+
+    def confirm(self, provisional_id, attempt_id, result):
+        """Replace the provisional id of an attempt that got stored."""
+        if result in OK_RESULTS:
+            self.apply(attempt_id, result)
+        elif provisional_id in self.failures:
+            self.failures.discard(provisional_id)
+            if attempt_id > self.last_ok:
+                self.failures.add(attempt_id)
+
+
+class _WindowState(object):
+    """Failures of one network within a sliding time window.
+
+    Failures are kept in a heap sorted by time, whatever order they are
+    added in, so expired ones are always dropped first.
+    """
+
+    __slots__ = ("heap", "ids", "total")
+
+    def __init__(self):
+        # ``[timestamp, order, attempt_id, amount]`` entries
+        self.heap = []
+        # Entries of single failures, by attempt id
+        self.ids = {}
+        self.total = 0
+
+    def add(self, attempt_id, timestamp, amount=1):
+        """Account some failures.
+
+        :param int attempt_id:
+            Id of the failure, or ``None`` for an aggregate of several ones
+            that will never be confirmed nor added again.
+        """
+        if attempt_id is not None:
+            if attempt_id in self.ids:
+                return
+            entry = self.ids[attempt_id] = [
+                timestamp, next(_order), attempt_id, amount]
+        else:
+            entry = [timestamp, next(_order), None, amount]
+        heapq.heappush(self.heap, entry)
+        self.total += amount
+        if len(self.heap) > MAX_FAILURES:
+            self._pop()
+
+    def _pop(self):
+        """Drop the oldest entry."""
+        _timestamp, _order, attempt_id, amount = heapq.heappop(self.heap)
+        self.ids.pop(attempt_id, None)
+        self.total -= amount
+
+    def confirm(self, provisional_id, attempt_id):
+        """Replace the provisional id of an attempt that got stored."""
+        entry = self.ids.pop(provisional_id, None)
+        if entry is not None:
+            entry[2] = attempt_id
+            self.ids[attempt_id] = entry
+
+    def count(self, since):
+        """Count failures newer than a timestamp."""
+        while self.heap and self.heap[0][0] < since:
+            self._pop()
+        return self.total
+
+    def reset(self, until):
+        """Forget failures up to a timestamp, i.e. because of an unban."""
+        kept = [entry for entry in self.heap if entry[0] > until]
+        heapq.heapify(kept)
+        self.heap = kept
+        self.ids = {
+            entry[2]: entry for entry in kept if entry[2] is not None}
+        self.total = sum(entry[3] for entry in kept)
+
+
+def networks(remote, prefixes):
+    """Get networks that contain a remote.
+
+    :param str remote:
+        Remote IP.
+
+    :param dict prefixes:
+        Prefix lengths to use, by IP version.
+
+    :return list:
+        Networks in CIDR notation; empty if the remote is not a valid IP.
+    """
+    try:
+        address = ipaddress.ip_address(remote)
+    except ValueError:
+        return []
+    return [
+        str(ipaddress.ip_network((remote, prefix), strict=False))
+        for prefix in prefixes.get(address.version, ())
+    ]
+
+
+class AttemptCounters(object):
+    """Failure counters for one database."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # Never reset, so attempts queued before clear() keep unique ids
+        self.last_provisional = PROVISIONAL
+        self.clear()
+
+    def clear(self):
+        """Forget everything; counters will be rebuilt from database."""
+        with self.lock:
+            self.created = time.monotonic()
+            self.generation = None
+            self.last_id = None
+            self.pending = OrderedDict()
+            self.unconfirmed = {}
+            self.expected = {}
+            self.keys = OrderedDict()
+            self.prefixes = {}
+            self.window = 0
+            self.whitelist = ()
+            self.nets = {}
+            self.seeded = False
+            # Last attempt id aggregated by the seed
+            self.seed_id = 0
+
+    def configure(self, prefixes, window, whitelist=()):
+        """Set networks to aggregate failures by.
+
+        :param dict prefixes:
+            Prefix lengths by IP version, i.e. ``{4: (24, 16)}``.
+
+        :param float window:
+            Seconds during which network failures count.
+
+        :param whitelist:
+            Remotes whose failures never count for their networks, i.e. a
+            :class:`~odoo.addons.auth_brute_force.whitelist.WhitelistIndex`.
+        """
+        with self.lock:
+            if (prefixes, window) != (self.prefixes, self.window) or (
+                    whitelist is not self.whitelist and
+                    whitelist != self.whitelist):
+                self.prefixes, self.window = prefixes, window
+                self.whitelist = whitelist
+                self.nets = {}
+                self.seeded = False
+
+    def _rebuild(self):
+        """Forget everything but the configuration.
+
+        Must be called with :attr:`lock` held.
+        """
+        config = self.prefixes, self.window, self.whitelist
+        self.clear()
+        self.configure(*config)
+
+    def _networks(self, remote):
+        """Networks of a remote, for the configured prefixes."""
+        if not self.prefixes or remote in self.whitelist:
+            return []
+        return networks(remote, self.prefixes)
+
+    @staticmethod
+    def _keys(remote, login):
+        return (remote,), (remote, login)
+
+    def _state(self, key):
+        """Get the state of a key, creating it if needed.
+
+        Must be called with :attr:`lock` held.
+        """
+        state = self.keys.get(key)
+        if state is None:
+            state = self.keys[key] = _KeyState()
+            while len(self.keys) > MAX_KEYS:
+                self.keys.popitem(last=False)
+        return state
+
+    def _apply_networks(self, attempt_id, remote, result, timestamp,
+                        amount=1):
+        """Account failures for the networks of their remote.
+
+        Must be called with :attr:`lock` held.
+        """
+        if result in OK_RESULTS or result in NEUTRAL_RESULTS:
+            return
+        for network in self._networks(remote):
+            state = self.nets.get(network)
+            if state is None:
+                if len(self.nets) >= MAX_KEYS:
+                    continue
+                state = self.nets[network] = _WindowState()
+            state.add(attempt_id, timestamp, amount)
+
+    def _reset_networks(self, remote, timestamp):
+        """Forget failures of networks overlapping an unbanned remote.
+
+        Must be called with :attr:`lock` held.
+
+        :param str remote:
+            Remote IP or network in CIDR notation.
+
+        :param float timestamp:
+            Time of the unban; later failures are kept.
+        """
+        try:
+            unbanned = ipaddress.ip_network(remote, strict=False)
+        except ValueError:
+            return
+        for network, state in self.nets.items():
+            network = ipaddress.ip_network(network)
+            if network.version == unbanned.version and \
+                    network.overlaps(unbanned):
+                state.reset(timestamp)
+
+    def _apply(self, rows):
+        """Apply attempt rows ``(id, remote, login, result, timestamp)``.
+
+        Rows must be sorted by id. Must be called with :attr:`lock` held.
+        """
+        now = time.monotonic()
+        for attempt_id, remote, login, result, timestamp in rows:
+            if self.last_id is not None and attempt_id > self.last_id:
+                # Lower ids may belong to attempts not committed yet
+                gap = range(
+                    max(self.last_id + 1, attempt_id - MAX_GAP), attempt_id)
+                for missing in gap:
+                    self.pending.setdefault(missing, now)
+            if self.last_id is None or attempt_id > self.last_id:
+                self.last_id = attempt_id
+            if not result:
+                self.pending.setdefault(attempt_id, now)
+                continue
+            self.pending.pop(attempt_id, None)
+            provisional_id = self.expected.pop(attempt_id, None)
+            if provisional_id is not None:
+                # Counted already by this worker
+                self._confirm(provisional_id, attempt_id)
+                continue
+            for key in self._keys(remote, login):
+                state = self.keys.get(key)
+                if state is not None:
+                    state.apply(attempt_id, result, timestamp)
+            if self.seeded and attempt_id > self.seed_id:
+                if result == "unbanned":
+                    self._reset_networks(remote, timestamp)
+                self._apply_networks(attempt_id, remote, result, timestamp)
+        # Give up on attempts that never appeared or got a result
+        while self.pending:
+            attempt_id, since = next(iter(self.pending.items()))
+            if now - since < PENDING_TIMEOUT:
+                break
+            del self.pending[attempt_id]
+
+    def sync(self, cr):
+        """Apply attempts stored since last sync.
+
+        :param cr:
+            Database cursor to read attempts from.
+        """
+        with self.lock:
+            if time.monotonic() - self.created > MAX_AGE:
+                self._rebuild()
+            last_id, pending = self.last_id, tuple(self.pending)
+            seeded = self.seeded or not self.prefixes
+        if not seeded:
+            self._seed(cr)
+        if last_id is None:
+            cr.execute("SELECT MAX(id) FROM res_authentication_attempt")
+            last_id = cr.fetchone()[0] or 0
+            with self.lock:
+                if self.last_id is None:
+                    self.last_id = last_id
+        # Always returns a row, with the current generation
+        cr.execute(
+            """SELECT a.id, a.remote, a.login, a.result,
+                      EXTRACT(EPOCH FROM a.create_date)::float,
+                      g.last_value
+               FROM {} g
+               LEFT JOIN res_authentication_attempt a
+                   ON a.id > %s OR a.id IN %s
+               ORDER BY a.id""".format(GENERATION_SEQUENCE),
+            (last_id, pending or (0,)),
+        )
+        rows = cr.fetchall()
+        with self.lock:
+            generation = rows[0][5]
+            stale = self.generation not in (None, generation)
+            if stale:
+                self._rebuild()
+            else:
+                self.generation = generation
+                self._apply([row[:5] for row in rows if row[0] is not None])
+        if stale:
+            self.sync(cr)
+
+    def _seed(self, cr):
+        """Read network failures within the window from database.
+
+        They are aggregated by remote and minute, each aggregate expiring
+        with its newest failure. Later attempts are counted one by one.
+        Unbans done within the window drop failures done before them.
+        """
+        with self.lock:
+            window = self.window
+        cr.execute(
+            """SELECT remote, COUNT(*), MAX(id),
+                      EXTRACT(EPOCH FROM MAX(create_date))::float
+               FROM res_authentication_attempt
+               WHERE create_date >= (now() at time zone 'UTC') -
+                                    %s * interval '1 second'
+                     AND result NOT IN %s
+               GROUP BY remote, date_trunc('minute', create_date)""",
+            (window, OK_RESULTS + NEUTRAL_RESULTS),
+        )
+        rows = cr.fetchall()
+        cr.execute(
+            """SELECT remote, EXTRACT(EPOCH FROM MAX(write_date))::float
+               FROM res_authentication_attempt
+               WHERE result = 'unbanned'
+                     AND write_date >= (now() at time zone 'UTC') -
+                                       %s * interval '1 second'
+               GROUP BY remote""",
+            (window,),
+        )
+        unbans = cr.fetchall()
+        with self.lock:
+            if self.seeded or self.window != window:
+                return
+            for remote, amount, last_id, timestamp in rows:
+                self._apply_networks(None, remote, None, timestamp, amount)
+                self.seed_id = max(self.seed_id, last_id)
+            for remote, timestamp in unbans:
+                self._reset_networks(remote, timestamp)
+            self.seeded = True
+
+    def network_failures(self, network):
+        """Count failures of a network within the configured window.
+
+        :param str network:
+            Network in CIDR notation, as returned by :func:`networks`.
+        """
+        with self.lock:
+            state = self.nets.get(network)
+            if state is None:
+                return 0
+            return state.count(time.time() - self.window)
+
+    def record(self, remote, login, result):
+        """Account a finished attempt that is not stored yet.
+
+        :return int:
+            Provisional id of the attempt. Once stored, pass it to
+            :meth:`confirm` with its real id.
+        """
+        with self.lock:
+            self.last_provisional += 1
+            provisional_id = self.last_provisional
+            self.unconfirmed[provisional_id] = remote, login, result
+            now = time.time()
+            for key in self._keys(remote, login):
+                self._state(key).apply(provisional_id, result, now)
+            if self.seeded:
+                self._apply_networks(provisional_id, remote, result, now)
+        return provisional_id
+
+    def expect(self, stored):
+        """Know the ids attempts of this worker are being stored with.
+
+        :param list stored:
+            ``(provisional_id, attempt_id)`` pairs.
+        """
+        with self.lock:
+            for provisional_id, attempt_id in stored:
+                if provisional_id in self.unconfirmed:
+                    self.expected[attempt_id] = provisional_id
+
+    def unexpect(self, attempt_ids):
+        """Forget ids passed to :meth:`expect`, if they were not stored."""
+        with self.lock:
+            for attempt_id in attempt_ids:
+                self.expected.pop(attempt_id, None)
+
+    def confirm(self, stored):
+        """Replace provisional ids of attempts just committed.
+
+        :param list stored:
+            ``(provisional_id, attempt_id)`` pairs.
+        """
+        with self.lock:
+            for provisional_id, attempt_id in stored:
+                self.expected.pop(attempt_id, None)
+                self._confirm(provisional_id, attempt_id)
+
+    def _confirm(self, provisional_id, attempt_id):
+        """Replace the provisional id of one attempt.
+
+        Must be called with :attr:`lock` held.
+        """
+        try:
+            remote, login, result = self.unconfirmed.pop(provisional_id)
+        except KeyError:
+            return  # Counters were cleared, or a sync confirmed it already
+        for key in self._keys(remote, login):
+            state = self.keys.get(key)
+            if state is not None:
+                state.confirm(provisional_id, attempt_id, result)
+        for network in self._networks(remote):
+            state = self.nets.get(network)
+            if state is not None:
+                state.confirm(provisional_id, attempt_id)
+
+    def _load(self, cr, remote, login):
+        """Read failures since last success for a key from database."""
+        where = "remote = %(remote)s"
+        if login is not None:
+            where += " AND login = %(login)s"
+        cr.execute(
+            """SELECT id, result, EXTRACT(EPOCH FROM create_date)::float
+               FROM res_authentication_attempt
+               WHERE {where}
+                     AND (result IS NULL OR result NOT IN %(neutral)s)
+                     AND id >= COALESCE(
+                   (SELECT MAX(id)
+                    FROM res_authentication_attempt
+                    WHERE {where} AND result IN %(ok)s),
+                   0)
+               ORDER BY id DESC
+               LIMIT %(limit)s""".format(where=where),
+            {
+                "remote": remote,
+                "login": login,
+                "ok": OK_RESULTS,
+                "neutral": NEUTRAL_RESULTS,
+                "limit": MAX_FAILURES + 1,
+            },
+        )
+        return cr.fetchall()[::-1]
+
+    def failures(self, cr, remote, login=None):
+        """Count failures since last success.
+
+        :param cr:
+            Database cursor, used only if the key is not loaded yet.
+
+        :param str remote:
+            Remote IP.
+
+        :param str login:
+            Supply it to count failures of the remote+login combination.
+
+        :return int:
+            Amount of failures.
+        """
+        key = (remote,) if login is None else (remote, login)
+        with self.lock:
+            state = self.keys.get(key)
+            if state is not None and state.loaded:
+                self.keys.move_to_end(key)
+                return len(state.failures)
+        rows = self._load(cr, remote, login)
+        with self.lock:
+            state = self._state(key)
+            now = time.monotonic()
+            for attempt_id, result, timestamp in rows:
+                if result:
+                    state.apply(attempt_id, result, timestamp)
+                else:
+                    self.pending.setdefault(attempt_id, now)
+            state.loaded = True
+            return len(state.failures)
+
+    def last_failure(self, cr, remote, login=None):
+        """Get the time of the last failure since last success.
+
+        :return float:
+            Timestamp, or ``0`` if there are no failures.
+        """
+        if not self.failures(cr, remote, login):
+            return 0
+        key = (remote,) if login is None else (remote, login)
+        with self.lock:
+            state = self.keys.get(key)
+            return state.last_failure if state is not None else 0
+
+
+_counters = {}
+_counters_lock = threading.Lock()
+
+
+def get(dbname):
+    """Get the failure counters of a database."""
+    with _counters_lock:
+        try:
+            return _counters[dbname]
+        except KeyError:
+            counters = _counters[dbname] = AttemptCounters()
+            return counters
+
+
+def clear(dbname):
+    """Drop the failure counters of a database."""
+    with _counters_lock:
+        counters = _counters.get(dbname)
+    if counters is not None:
+        counters.clear()
@@ -0,0 +1,14 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from odoo.exceptions import AccessDenied
+
+
+class LoginDelayed(AccessDenied):
+    """The remote and login combination must wait before retrying.
+
+    Credentials were not checked, so callers must not report them as wrong.
+    """
+
+    def __init__(self):
+        super(LoginDelayed, self).__init__()
+        self.args = ("Too many failed attempts; retry later",)
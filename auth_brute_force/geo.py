@@ -0,0 +1,312 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+"""Geolocation of remote IPs, to display their metadata.
+
+Lookups are answered from a local database when configured, which can be:
+
+* A MaxMind ``.mmdb`` file, if the ``maxminddb`` library is installed.
+* A CSV file whose first 2 columns are the first and last IP of a range,
+  and the rest are metadata, named by the header row.
+
+The public HTTP API is used only as a fallback, in a background thread, so
+rendering attempts never waits for it; its answers appear once fetched.
+"""
+
+import abc
+import bisect
+import csv
+import ipaddress
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from urllib.request import urlopen
+
+try:
+    import maxminddb
+except ImportError:
+    maxminddb = None
+
+_logger = logging.getLogger(__name__)
+
+GEOLOCALISATION_URL = u"http://ip-api.com/json/{}"
+# Lookups remembered per backend
+CACHE_SIZE = 4096
+# Seconds to wait for the HTTP API
+HTTP_TIMEOUT = 5
+# Seconds before fetching again IPs the HTTP API failed for
+HTTP_RETRY_DELAY = 60
+
+
+class _LRU(object):
+    """Minimal thread-safe LRU mapping."""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.data.move_to_end(key)
+            except KeyError:
+                return default
+            return self.data[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+
+def _public(ips):
+    """Filter out IPs that geolocation cannot know about."""
+    for ip in ips:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            continue
+        if address.is_global:
+            yield ip, address
+
+
+class GeoBackend(abc.ABC):
+    """Base geolocation backend."""
+
+    @abc.abstractmethod
+    def lookup_many(self, ips):
+        """Get metadata for several IPs.
+
+        :param iterable ips:
+            IPs as strings.
+
+        :return dict:
+            Metadata for each IP, for those found.
+        """
+
+
+class LocalBackend(GeoBackend):
+    """Local database, with a cache of results."""
+
+    def __init__(self):
+        self.cache = _LRU()
+
+    @abc.abstractmethod
+    def lookup(self, address):
+        """Get metadata for an IP address.
+
+        :param ipaddress._BaseAddress address:
+            Address to look for.
+
+        :return dict:
+            Metadata; empty if unknown.
+        """
+
+    def lookup_many(self, ips):
+        result = {}
+        for ip, address in _public(set(ips)):
+            data = self.cache.get(ip)
+            if data is None:
+                data = self.lookup(address)
+                self.cache.set(ip, data)
+            if data:
+                result[ip] = data
+        return result
+
+
+class CsvRangeBackend(LocalBackend):
+    """IP ranges read from a CSV file, searched by bisection."""
+
+    def __init__(self, path):
+        super(CsvRangeBackend, self).__init__()
+        ranges = {4: [], 6: []}
+        with open(path, newline="") as csv_file:
+            reader = csv.reader(csv_file)
+            self.columns = next(reader)[2:]
+            for row in reader:
+                try:
+                    first = ipaddress.ip_address(row[0])
+                    last = ipaddress.ip_address(row[1])
+                except (IndexError, ValueError):
+                    continue
+                ranges[first.version].append(
+                    (int(first), int(last), tuple(row[2:])))
+        self.starts, self.ends, self.rows = {}, {}, {}
+        for version, version_ranges in ranges.items():
+            version_ranges.sort()
+            self.starts[version] = [one[0] for one in version_ranges]
+            self.ends[version] = [one[1] for one in version_ranges]
+            self.rows[version] = [one[2] for one in version_ranges]
+
+    def lookup(self, address):
+        number = int(address)
+        index = bisect.bisect_right(self.starts[address.version], number) - 1
+        if index < 0 or self.ends[address.version][index] < number:
+            return {}
+        row = self.rows[address.version][index]
+        return OrderedDict(zip(self.columns, row))
+
+
+class MmdbBackend(LocalBackend):
+    """MaxMind database."""
+
+    def __init__(self, path):
+        super(MmdbBackend, self).__init__()
+        self.reader = maxminddb.open_database(path)
+
+    @classmethod
+    def _flatten(cls, data, prefix=""):
+        for key, value in sorted(data.items()):
+            if isinstance(value, dict):
+                if key == "names":
+                    value = {"name": value.get("en")}
+                    key = ""
+                yield from cls._flatten(value, prefix + key + "_" * bool(key))
+            elif not isinstance(value, list):
+                yield prefix + key, value
+
+    def lookup(self, address):
+        data = self.reader.get(str(address)) or {}
+        return OrderedDict(self._flatten(data))
+
+
+class HttpBackend(GeoBackend):
+    """Public HTTP API, queried in the background.
+
+    Answers are cached; failures are not, so their IPs are fetched again
+    after :data:`HTTP_RETRY_DELAY`.
+    """
+
+    def __init__(self):
+        self.cache = _LRU()
+        # Time of the last failure, by IP
+        self.failures = _LRU()
+        self.queue = deque(maxlen=CACHE_SIZE)
+        self.condition = threading.Condition()
+        self.pid = None
+
+    def lookup_many(self, ips):
+        result = {}
+        for ip, _address in _public(set(ips)):
+            data = self.cache.get(ip)
+            if data is None:
+                failed = self.failures.get(ip)
+                if failed is None or time.time() - failed >= HTTP_RETRY_DELAY:
+                    self._schedule(ip)
+            elif data:
+                result[ip] = data
+        return result
+
+    def _schedule(self, ip):
+        """Fetch an IP in the background."""
+        pid = os.getpid()
+        with self.condition:
+            if ip not in self.queue:
+                self.queue.append(ip)
+            if self.pid != pid:
+                threading.Thread(
+                    target=self._run,
+                    name="auth_brute_force.geo",
+                    daemon=True,
+                ).start()
+                self.pid = pid
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                ip = self.queue.popleft()
+            url = GEOLOCALISATION_URL.format(ip)
+            try:
+                data = json.loads(
+                    urlopen(url, timeout=HTTP_TIMEOUT).read().decode("utf-8"),
+                    object_pairs_hook=OrderedDict,
+                )
+            except Exception:
+                _logger.warning(
+                    "Couldn't fetch details from %s",
+                    url,
+                    exc_info=True,
+                )
+                self.failures.set(ip, time.time())
+                continue
+            self.cache.set(ip, data)
+
+
+class ChainBackend(GeoBackend):
+    """Ask a local backend, then fall back to another one."""
+
+    def __init__(self, local, fallback):
+        self.local, self.fallback = local, fallback
+
+    def lookup_many(self, ips):
+        ips = set(ips)
+        result = self.local.lookup_many(ips)
+        result.update(self.fallback.lookup_many(ips - set(result)))
+        return result
+
+
+# Local backends and the mtime of their file, by path
+_local_backends = {}
+_http_backend = None
+_backends_lock = threading.Lock()
+
+
+def _local_backend(path):
+    """Load a local database, once per file version."""
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        _logger.warning("Geolocation database %s not found", path)
+        return None
+    with _backends_lock:
+        loaded = _local_backends.get(path)
+        if loaded is not None and loaded[0] == mtime:
+            return loaded[1]
+        if path.endswith(".mmdb") and maxminddb is None:
+            _logger.warning("Install maxminddb to read %s", path)
+            return None
+        try:
+            if path.endswith(".mmdb"):
+                backend = MmdbBackend(path)
+            else:
+                backend = CsvRangeBackend(path)
+        except Exception:
+            _logger.warning(
+                "Cannot read geolocation database %s", path,
+                exc_info=True)
+            return None
+        # Replaces older versions of this file
+        _local_backends[path] = mtime, backend
+        return backend
+
+
+def get(path=None, http=False):
+    """Get the geolocation backend for some configuration.
+
+    :param str path:
+        Local database path, if any.
+
+    :param bool http:
+        Use the HTTP API for IPs not found locally.
+
+    :return GeoBackend:
+        The backend, or ``None`` if geolocation is disabled.
+    """
+    local = _local_backend(path) if path else None
+    if not http:
+        return local
+    global _http_backend
+    with _backends_lock:
+        if _http_backend is None:
+            _http_backend = HttpBackend()
+        remote = _http_backend
+    if local is None:
+        return remote
+    return ChainBackend(local, remote)
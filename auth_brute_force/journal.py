@@ -0,0 +1,176 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+"""Store finished authentication attempts in batches.
+
+Recording attempts one by one costs a cursor and a commit per row. Instead,
+finished attempts are counted right away by :mod:`.counters`, so ban
+decisions do not wait for them, and queued here. A background thread
+stores them in bulk every :data:`FLUSH_INTERVAL` seconds, or sooner when
+:data:`FLUSH_SIZE` attempts are waiting.
+
+Batches that cannot be stored are queued again, and retried after
+:data:`RETRY_INTERVAL` seconds. Meanwhile, their attempts stay counted under
+provisional ids.
+
+In test mode attempts are stored synchronously, so tests can find them.
+"""
+
+import atexit
+import logging
+import os
+import threading
+from collections import deque
+
+from psycopg2.extras import execute_values
+
+from odoo import SUPERUSER_ID
+
+from . import counters
+
+_logger = logging.getLogger(__name__)
+
+# Seconds between flushes
+FLUSH_INTERVAL = 0.2
+# Queued attempts that trigger a flush without waiting
+FLUSH_SIZE = 200
+# Queued attempts kept if database is unreachable; older ones are dropped
+MAX_QUEUE = 100000
+# Seconds to wait before storing again after a failure
+RETRY_INTERVAL = 5
+
+
+class AttemptJournal(object):
+    """Queue of finished attempts waiting to be stored."""
+
+    def __init__(self):
+        self.queue = deque(maxlen=MAX_QUEUE)
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def append(self, registry, values):
+        """Count and queue a finished attempt.
+
+        :param registry:
+            Registry of the database where the attempt happened.
+
+        :param dict values:
+            Attempt values: ``login``, ``remote``, ``result`` and
+            ``create_date``.
+        """
+        provisional_id = counters.get(registry.db_name).record(
+            values["remote"], values["login"], values["result"])
+        with self.condition:
+            self.queue.append((registry, provisional_id, values))
+            if len(self.queue) >= FLUSH_SIZE:
+                self.condition.notify()
+        if registry.in_test_mode():
+            self.flush()
+        else:
+            self._ensure_thread()
+
+    def _ensure_thread(self):
+        """Start the flusher thread in this process, if not running."""
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        with self.condition:
+            if self.pid != pid:
+                self.thread = threading.Thread(
+                    target=self._run,
+                    name="auth_brute_force.journal",
+                    daemon=True,
+                )
+                self.thread.start()
+                self.pid = pid
+
+    def _run(self):
+        interval = FLUSH_INTERVAL
+        while True:
+            with self.condition:
+                if interval > FLUSH_INTERVAL or len(self.queue) < FLUSH_SIZE:
+                    self.condition.wait(interval)
+            interval = FLUSH_INTERVAL if self.flush() else RETRY_INTERVAL
+
+    def flush(self):
+        """Store all queued attempts now.
+
+        :return bool:
+            Whether all of them got stored. Those that did not are queued
+            again, before newer ones.
+        """
+        with self.flush_lock:
+            batches = {}
+            with self.condition:
+                while self.queue:
+                    registry, provisional_id, values = self.queue.popleft()
+                    batches.setdefault(registry.db_name, (registry, []))[1] \
+                        .append((provisional_id, values))
+            failed = []
+            for registry, batch in batches.values():
+                try:
+                    self._store(registry, batch)
+                except Exception:
+                    _logger.exception(
+                        "Cannot store %d authentication attempts, "
+                        "they will be retried",
+                        len(batch),
+                    )
+                    failed.extend(
+                        (registry, provisional_id, values)
+                        for provisional_id, values in batch)
+            if failed:
+                with self.condition:
+                    # Oldest attempts are dropped if the queue overflows
+                    self.queue = deque(
+                        failed + list(self.queue), maxlen=MAX_QUEUE)
+            return not failed
+
+    def _store(self, registry, batch):
+        """Insert a batch of attempts in one query.
+
+        Counters know the ids the attempts are getting before commit, and
+        confirm them only once committed.
+        """
+        synced = counters.get(registry.db_name)
+        ids = ()
+        try:
+            with registry.cursor() as cr:
+                # Ids are reserved first to know which one each attempt gets
+                cr.execute(
+                    """SELECT nextval('res_authentication_attempt_id_seq')
+                       FROM generate_series(1, %s)""",
+                    (len(batch),),
+                )
+                ids = sorted(row[0] for row in cr.fetchall())
+                stored = [
+                    (provisional_id, attempt_id)
+                    for attempt_id, (provisional_id, _values)
+                    in zip(ids, batch)
+                ]
+                # Syncs that see them before confirmation must not count
+                # them twice
+                synced.expect(stored)
+                execute_values(
+                    cr,
+                    """INSERT INTO res_authentication_attempt
+                       (id, login, remote, result, create_date, write_date,
+                        create_uid, write_uid)
+                       VALUES %s""",
+                    [
+                        (attempt_id, values["login"], values["remote"],
+                         values["result"], values["create_date"],
+                         values["create_date"], SUPERUSER_ID, SUPERUSER_ID)
+                        for attempt_id, (_pid, values) in zip(ids, batch)
+                    ],
+                    page_size=len(batch),
+                )
+        except Exception:
+            synced.unexpect(ids)
+            raise
+        synced.confirm(stored)
+
+
+journal = AttemptJournal()
+# Do not lose queued attempts when a worker is recycled
+atexit.register(journal.flush)
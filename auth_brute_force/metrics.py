@@ -0,0 +1,133 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+"""Time and queries spent by each addon while checking credentials.
+
+Every addon that overrides ``res.users.check_credentials`` adds a layer to
+the chain of ``super()`` calls. Addons decorate their override with
+:func:`instrument`, or wrap blocks with :func:`measure`, which accounts for
+the wall time and queries of that layer alone, excluding the measured
+layers it calls. Addons that cannot depend on this one call the
+``res.users`` ``_auth_measure()`` hook instead, when it exists. Layers that
+are not measured are accounted to the nearest measured one that calls
+them.
+
+Totals are kept per process and exported in Prometheus text format by
+:func:`render`. Measuring costs 2 clock reads and a locked dict update per
+layer, so it is always enabled.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from . import attempt
+
+_local = threading.local()
+# Calls, seconds and queries, by (database, layer)
+_totals = {}
+_totals_lock = threading.Lock()
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+@contextmanager
+def measure(layer, cr):
+    """Account the time and queries of a block to a layer.
+
+    Blocks can be nested: each one is accounted without its inner ones.
+
+    :param str layer:
+        Name of the layer, usually the addon running the block.
+
+    :param cr:
+        Cursor whose queries are counted.
+    """
+    stack = _stack()
+    # Start time, start queries, seconds and queries of inner blocks
+    frame = [time.perf_counter(), getattr(cr, "sql_log_count", 0), 0.0, 0]
+    stack.append(frame)
+    try:
+        yield
+    finally:
+        stack.pop()
+        seconds = time.perf_counter() - frame[0]
+        queries = getattr(cr, "sql_log_count", 0) - frame[1]
+        if stack:
+            stack[-1][2] += seconds
+            stack[-1][3] += queries
+        key = cr.dbname, layer
+        with _totals_lock:
+            totals = _totals.setdefault(key, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += seconds - frame[2]
+            totals[2] += queries - frame[3]
+
+
+def instrument(layer):
+    """Decorate a model method to :func:`measure` it."""
+
+    def _decorator(method):
+        @wraps(method)
+        def _wrapper(self, *args, **kwargs):
+            with measure(layer, self.env.cr):
+                return method(self, *args, **kwargs)
+
+        return _wrapper
+
+    return _decorator
+
+
+def reset():
+    """Forget all totals."""
+    with _totals_lock:
+        _totals.clear()
+
+
+def _labels(**labels):
+    return ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\")
+                     .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in sorted(labels.items())
+    )
+
+
+def render():
+    """Export totals in Prometheus text format.
+
+    :return str:
+        Metrics, one per line.
+    """
+    with _totals_lock:
+        totals = sorted((key, list(values)) for key, values in _totals.items())
+    lines = []
+    metrics = (
+        ("calls_total", "counter", "Calls to each credentials check layer."),
+        ("seconds_total", "counter",
+         "Wall time spent in each credentials check layer alone."),
+        ("queries_total", "counter",
+         "SQL queries run by each credentials check layer alone."),
+    )
+    for index, (name, kind, description) in enumerate(metrics):
+        name = "odoo_auth_layer_" + name
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for (dbname, layer), values in totals:
+            lines.append("%s{%s} %r" % (
+                name, _labels(db=dbname, layer=layer), values[index]))
+    stats = attempt.stats()
+    for name, key, description in (
+        ("odoo_auth_attempts_total", "attempts",
+         "Authentication attempts tracked by auth_brute_force."),
+        ("odoo_auth_attempt_queries_total", "queries",
+         "SQL queries run while checking credentials of tracked attempts."),
+    ):
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s counter" % name)
+        lines.append("%s %r" % (name, stats[key]))
+    return "\n".join(lines) + "\n"
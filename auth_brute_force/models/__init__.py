@@ -1,2 +1,3 @@
 from . import res_authentication_attempt
 from . import res_users
+from . import res_authentication_attempt_report
@@ -1,30 +1,39 @@
 # Copyright 2015 GRAP - Sylvain LE GAL
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
-import json
+from datetime import datetime, timedelta
 from distutils import util
-import logging
 import ipaddress
-from urllib.request import urlopen
-from odoo import api, fields, models
+import logging
+import time
+from threading import current_thread
+from odoo import api, fields, models, tools
 
-GEOLOCALISATION_URL = u"http://ip-api.com/json/{}"
+from .. import bans, counters, geo
+from ..whitelist import WhitelistIndex
 
 _logger = logging.getLogger(__name__)
 
+# Function casting remotes to inet, or to NULL if they are not IPs
+INET = "auth_brute_force_inet"
+# Condition of attempts that are not markers of unbanned networks
+ATTEMPTS = "COALESCE(strpos(remote, '/'), 0) = 0"
+
 
 class ResAuthenticationAttempt(models.Model):
     _name = 'res.authentication.attempt'
     _order = 'create_date desc'
 
     login = fields.Char(string='Tried Login', index=True)
-    remote = fields.Char(string='Remote IP', index=True)
+    # Indexed by `init()` together with `id`
+    remote = fields.Char(string='Remote IP')
     result = fields.Selection(
         string='Authentication Result',
         selection=[
             ('successful', 'Successful'),
             ('failed', 'Failed'),
             ('banned', 'Banned'),
+            ('delayed', 'Delayed'),
             ('unbanned', 'Unbanned')
         ],
         index=True,
@@ -38,47 +47,238 @@ class ResAuthenticationAttempt(models.Model):
         compute="_compute_whitelisted",
     )
 
+    @api.model_cr
+    def init(self):
+        """Create indexes matching queries of failure counters and pruning.
+
+        Also create the function casting remotes to ``inet`` for unbans.
+        """
+        ok = "result IN ('successful', 'unbanned')"
+        indexes = (
+            ("remote_id", "(remote, id)", None),
+            ("remote_login_id", "(remote, login, id)", None),
+            ("remote_id_ok", "(remote, id)", ok),
+            ("remote_login_id_ok", "(remote, login, id)", ok),
+            ("create_date", "(create_date)", None),
+        )
+        for suffix, columns, where in indexes:
+            name = "%s_%s_idx" % (self._table, suffix)
+            self.env.cr.execute(
+                "SELECT 1 FROM pg_indexes WHERE indexname = %s", (name,))
+            if self.env.cr.fetchone():
+                continue
+            self.env.cr.execute("CREATE INDEX {} ON {} {}{}".format(
+                name,
+                self._table,
+                columns,
+                " WHERE %s" % where if where else "",
+            ))
+        # Remotes are not typed, and may not be IPs
+        self.env.cr.execute(
+            """CREATE OR REPLACE FUNCTION {}(value text) RETURNS inet AS $$
+               BEGIN
+                   RETURN value::inet;
+               EXCEPTION WHEN invalid_text_representation THEN
+                   RETURN NULL;
+               END
+               $$ LANGUAGE plpgsql IMMUTABLE STRICT""".format(INET))
+        # Bumped when stored results change, see `_invalidate_counters()`
+        self.env.cr.execute(
+            """SELECT 1 FROM pg_class
+               WHERE relname = %s AND relkind = 'S'""",
+            (counters.GENERATION_SEQUENCE,),
+        )
+        if not self.env.cr.fetchone():
+            self.env.cr.execute("CREATE SEQUENCE {}".format(
+                counters.GENERATION_SEQUENCE))
+            self.env.cr.execute(
+                "SELECT nextval(%s)", (counters.GENERATION_SEQUENCE,))
+
+    @api.multi
+    def write(self, vals):
+        # Login flow sets results only once; changing them afterwards (i.e.
+        # unbanning) alters failure streaks that workers have counted
+        changed = "result" in vals and self.filtered("result")
+        result = super(ResAuthenticationAttempt, self).write(vals)
+        if changed:
+            self._invalidate_counters()
+            self.env["res.authentication.attempt.report"]._refresh_hours(
+                changed.mapped("create_date"))
+        return result
+
+    @api.multi
+    def unlink(self):
+        result = super(ResAuthenticationAttempt, self).unlink()
+        self._invalidate_counters()
+        return result
+
+    @api.model
+    def _invalidate_counters(self):
+        """Make all workers rebuild failure counters and lift shared bans.
+
+        This worker does it right away. Other ones do it on their next sync
+        after the transaction commits, when they find a new generation.
+        """
+        dbname = self.env.cr.dbname
+        counters.clear(dbname)
+        bans.get().clear(dbname)
+        registry = self.pool
+
+        def _committed():
+            try:
+                with registry.cursor() as cr:
+                    cr.execute(
+                        "SELECT nextval(%s)", (counters.GENERATION_SEQUENCE,))
+                # Rebuilt meanwhile from uncommitted changes
+                counters.clear(dbname)
+                bans.get().clear(dbname)
+            except Exception:
+                _logger.exception("Cannot invalidate failure counters")
+
+        self.env.cr.after("commit", _committed)
+
     @api.multi
     @api.depends('remote')
     def _compute_metadata(self):
-        if not util.strtobool(self.env["ir.config_parameter"].sudo().get_param(
-            'auth_brute_force.check_remote', 'True'
-        )):
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        backend = geo.get(
+            get_param("auth_brute_force.geo_database"),
+            util.strtobool(get_param("auth_brute_force.check_remote", "True")),
+        )
+        if backend is None:
             return
+        found = backend.lookup_many(self.mapped("remote"))
         for item in self:
-            url = GEOLOCALISATION_URL.format(item.remote)
-            try:
-                res = json.loads(urlopen(url, timeout=5).read())
-            except Exception:
-                _logger.warning(
-                    "Couldn't fetch details from %s",
-                    url,
-                    exc_info=True,
-                )
-            else:
-                item.remote_metadata = "\n".join(
-                    '%s: %s' % pair for pair in res.items())
+            data = found.get(item.remote)
+            item.remote_metadata = data and "\n".join(
+                '%s: %s' % pair for pair in data.items())
+
+    @api.model
+    @tools.ormcache("whitelist")
+    def _whitelist_index(self, whitelist):
+        """Compile a whitelist.
+
+        Cached by its value, and cleared when any parameter changes.
+
+        :param str whitelist:
+            Comma-separated whitelisted networks.
+
+        :return odoo.addons.auth_brute_force.whitelist.WhitelistIndex:
+            Compiled whitelist.
+        """
+        return WhitelistIndex(whitelist.split(","))
+
+    @api.model
+    def _current_whitelist_index(self):
+        """Get the compiled current whitelist."""
+        return self._whitelist_index(
+            self.env["ir.config_parameter"].sudo().get_param(
+                "auth_brute_force.whitelist_remotes",
+                "",
+            ),
+        )
 
     @api.model
     def _is_whitelisted(self, ip):
-        for whitelist in self._whitelist_remotes():
-            try:
-                if (
-                    whitelist and
-                    ipaddress.ip_address(ip) in ipaddress.ip_network(whitelist)
-                ):
-                    return True
-            except ValueError:
-                continue
-        return False
+        return ip in self._current_whitelist_index()
 
     @api.multi
     def _compute_whitelisted(self):
+        index = self._current_whitelist_index()
         for one in self:
-            one.whitelisted = self._is_whitelisted(one.remote)
+            one.whitelisted = one.remote in index
 
     @api.model
-    def _hits_limit(self, limit, remote, login=None):
+    @tools.ormcache("ipv4", "ipv6")
+    def _subnet_limits(self, ipv4, ipv6):
+        """Parse subnet limits.
+
+        Cached by their value, and cleared when any parameter changes.
+
+        :param str ipv4:
+            Comma-separated ``prefix:limit`` pairs for IPv4, i.e.
+            ``24:200,16:1000``.
+
+        :param str ipv6:
+            Same, for IPv6.
+
+        :return dict:
+            Sorted ``(prefix, limit)`` pairs, by IP version.
+        """
+        result = {}
+        for version, pairs, bits in ((4, ipv4, 32), (6, ipv6, 128)):
+            limits = {}
+            for pair in pairs.split(","):
+                try:
+                    prefix, limit = (int(part) for part in pair.split(":"))
+                except ValueError:
+                    continue
+                if 0 <= prefix <= bits and limit > 0:
+                    limits[prefix] = limit
+            if limits:
+                result[version] = tuple(sorted(limits.items(), reverse=True))
+        return result
+
+    @api.model
+    def _current_subnet_limits(self):
+        """Get the parsed current subnet limits."""
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        return self._subnet_limits(
+            get_param("auth_brute_force.max_by_ipv4_subnet", ""),
+            get_param("auth_brute_force.max_by_ipv6_subnet", ""),
+        )
+
+    @api.model
+    def _counters(self):
+        """Get failure counters for this database, synced with it.
+
+        :return odoo.addons.auth_brute_force.counters.AttemptCounters:
+            Counters that know about all attempts stored so far.
+        """
+        result = counters.get(self.env.cr.dbname)
+        limits = self._current_subnet_limits()
+        result.configure(
+            {
+                version: tuple(prefix for prefix, _limit in pairs)
+                for version, pairs in limits.items()
+            },
+            int(self.env["ir.config_parameter"].sudo().get_param(
+                "auth_brute_force.subnet_window", 3600)),
+            self._current_whitelist_index(),
+        )
+        result.sync(self.env.cr)
+        return result
+
+    @api.model
+    def _banned_subnet(self, remote, synced):
+        """Get the banned network of a remote, if any.
+
+        :param str remote:
+            Remote IP.
+
+        :param synced:
+            Result of :meth:`_counters`.
+
+        :return str:
+            First network containing the remote that hit its limit, or
+            ``None``.
+        """
+        dbname = self.env.cr.dbname
+        shared = bans.get()
+        limits = self._current_subnet_limits()
+        for network in counters.networks(remote, synced.prefixes):
+            if shared.banned(dbname, network):
+                return network
+            version = 6 if ":" in network else 4
+            prefix = int(network.rsplit("/", 1)[1])
+            limit = dict(limits.get(version, ())).get(prefix)
+            if limit and synced.network_failures(network) >= limit:
+                shared.ban(dbname, network)
+                return network
+        return None
+
+    @api.model
+    def _hits_limit(self, limit, remote, login=None, synced=None):
         """Know if a given remote hits a given limit.
 
         :param int limit:
@@ -90,28 +290,14 @@ class ResAuthenticationAttempt(models.Model):
         :param str login:
             If you want to check the IP+login combination limit, supply the
             login.
-        """
-        domain = [
-            ("remote", "=", remote),
-        ]
-        if login is not None:
-            domain += [("login", "=", login)]
-        # Find last successful login
-        last_ok = self.search(
-            domain + [("result", "in", ["successful", "unbanned"])],
-            order='create_date desc',
-            limit=1,
-        )
 
-        if last_ok:
-            domain += [("id", ">", last_ok.id)]
-        # Count failures since last success, if any
-        recent_failures = self.search_count(
-            domain + [
-                ("result", "not in", ["successful", "unbanned", False]),
-            ])
-        # Did we hit the limit?
-        return recent_failures >= limit
+        :param synced:
+            Result of :meth:`_counters`, if you have it already.
+        """
+        if synced is None:
+            synced = self._counters()
+        # Count failures since last success, if any, and check the limit
+        return synced.failures(self.env.cr, remote, login) >= limit
 
     @api.model
     def _trusted(self, remote, login):
@@ -124,18 +310,44 @@ class ResAuthenticationAttempt(models.Model):
             User login that is being tried.
 
         :return bool:
-            ``True`` means it is trusted. ``False`` means that it is banned.
+            ``True`` means it is trusted. ``False`` means that it is banned
+            or must wait.
+        """
+        return not self._ban_reason(remote, login)
+
+    @api.model
+    def _ban_reason(self, remote, login):
+        """Get why the remote or remote+login must be rejected, if so.
+
+        :param str remote:
+            Remote IP from which the login attempt is taking place.
+
+        :param str login:
+            User login that is being tried.
+
+        :return str:
+            ``"banned"``, ``"delayed"`` if it must wait before retrying
+            (see :meth:`_backoff`), or ``None`` if it is trusted.
         """
         # Cannot ban without remote
         if not remote:
-            return True
+            return None
         get_param = self.env["ir.config_parameter"].sudo().get_param
         # Whitelisted remotes always pass
         if self._is_whitelisted(remote):
-            return True
+            return None
+        # Bans found by any worker are known without asking the database
+        dbname = self.env.cr.dbname
+        shared = bans.get()
         # Check if remote is banned
-        limit = int(get_param("auth_brute_force.max_by_ip", 50))
-        if self._hits_limit(limit, remote):
+        banned = shared.banned(dbname, remote)
+        if not banned:
+            synced = self._counters()
+            limit = int(get_param("auth_brute_force.max_by_ip", 50))
+            banned = self._hits_limit(limit, remote, synced=synced)
+            if banned:
+                shared.ban(dbname, remote)
+        if banned:
             _logger.warning(
                 "Authentication failed from remote '%s'. "
                 "The remote has been banned. "
@@ -143,10 +355,27 @@ class ResAuthenticationAttempt(models.Model):
                 remote,
                 login,
             )
-            return False
+            return "banned"
+        # Check if remote's networks are banned
+        network = self._banned_subnet(remote, synced)
+        if network:
+            _logger.warning(
+                "Authentication failed from remote '%s'. "
+                "The remote's network %s has been banned. "
+                "Login tried: %r.",
+                remote,
+                network,
+                login,
+            )
+            return "banned"
         # Check if remote + login combination is banned
-        limit = int(get_param("auth_brute_force.max_by_ip_user", 10))
-        if self._hits_limit(limit, remote, login):
+        banned = shared.banned(dbname, remote, login)
+        if not banned:
+            limit = int(get_param("auth_brute_force.max_by_ip_user", 10))
+            banned = self._hits_limit(limit, remote, login, synced=synced)
+            if banned:
+                shared.ban(dbname, remote, login)
+        if banned:
             _logger.warning(
                 "Authentication failed from remote '%s'. "
                 "The remote and login combination has been banned. "
@@ -154,9 +383,112 @@ class ResAuthenticationAttempt(models.Model):
                 remote,
                 login,
             )
-            return False
+            return "banned"
+        # Check if remote + login combination must still wait
+        if shared.shared:
+            delayed = shared.banned(dbname, remote, login, namespace="backoff")
+        else:
+            # This worker only knows about its own and synced failures
+            failures = synced.failures(self.env.cr, remote, login)
+            delayed = time.time() < self._backoff_delay(failures) + \
+                synced.last_failure(self.env.cr, remote, login)
+        if delayed:
+            _logger.warning(
+                "Authentication failed from remote '%s'. "
+                "The remote and login combination must wait before retrying. "
+                "Login tried: %r.",
+                remote,
+                login,
+            )
+            return "delayed"
         # If you get here, you are a good boy (for now)
-        return True
+        return None
+
+    @api.model
+    def _backoff_delay(self, failures):
+        """Get seconds to wait before retrying after some failures.
+
+        :param int failures:
+            Failures since last success, including the last one.
+
+        :return float:
+            Seconds to wait; 0 if back-off is disabled.
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        base = float(get_param("auth_brute_force.backoff", 0))
+        if base <= 0 or failures <= 0:
+            return 0
+        return min(
+            float(get_param("auth_brute_force.backoff_max", 300)),
+            base * 2 ** min(failures - 1, 32),
+        )
+
+    @api.model
+    def _backoff(self, remote, login):
+        """Make a remote+login combination wait after a failure.
+
+        Attempts done while waiting are rejected without checking
+        credentials, and stored as ``delayed``. They do not count as
+        failures, so they do not make the wait longer nor lead to bans.
+
+        Without shared bans, waits are computed from the time of the last
+        failure instead, see :meth:`_ban_reason`.
+
+        :param str remote:
+            Remote IP that just failed.
+
+        :param str login:
+            Login that was tried.
+        """
+        if not remote or self._is_whitelisted(remote):
+            return
+        # Counters were synced while checking if it was trusted
+        dbname = self.env.cr.dbname
+        failures = counters.get(dbname).failures(self.env.cr, remote, login)
+        delay = self._backoff_delay(failures + 1)
+        shared = bans.get()
+        if delay and shared.shared:
+            shared.ban(dbname, remote, login, ttl=delay, namespace="backoff")
+
+    @api.model
+    def _cron_prune(self, chunk_size=10000):
+        """Delete attempts older than the configured retention.
+
+        Rows are deleted in chunks, committing after each one to avoid
+        holding locks for long.
+
+        :param int chunk_size:
+            Rows deleted per transaction.
+        """
+        days = int(self.env["ir.config_parameter"].sudo().get_param(
+            "auth_brute_force.retention_days", 365))
+        if days <= 0:
+            return
+        limit = fields.Datetime.to_string(
+            datetime.now() - timedelta(days=days))
+        total = 0
+        while True:
+            self.env.cr.execute(
+                """DELETE FROM res_authentication_attempt
+                   WHERE id IN (
+                       SELECT id FROM res_authentication_attempt
+                       WHERE create_date < %s
+                       ORDER BY id
+                       LIMIT %s)""",
+                (limit, chunk_size),
+            )
+            deleted = self.env.cr.rowcount
+            total += deleted
+            if not getattr(current_thread(), "testing", False):
+                self.env.cr.commit()
+            if deleted < chunk_size:
+                break
+        self.invalidate_cache()
+        _logger.info(
+            "Pruned %d authentication attempts older than %d days",
+            total,
+            days,
+        )
 
     def _whitelist_remotes(self):
         """Get whitelisted remotes.
@@ -170,30 +502,152 @@ class ResAuthenticationAttempt(models.Model):
         )
         return set(whitelist.split(","))
 
-    @api.multi
-    def action_whitelist_add(self):
-        """Add current remotes to whitelist."""
+    @api.model
+    def bulk_whitelist(self, remotes, remove=False):
+        """Add or remove remotes from whitelist at once.
+
+        :param list remotes:
+            IPs or networks in CIDR notation.
+
+        :param bool remove:
+            Remove them instead of adding them.
+        """
         whitelist = self._whitelist_remotes()
-        whitelist |= set(self.mapped("remote"))
+        remotes = {remote.strip() for remote in remotes}
+        if remove:
+            whitelist -= remotes
+        else:
+            whitelist |= remotes
+        whitelist.discard("")
         self.env["ir.config_parameter"].set_param(
             "auth_brute_force.whitelist_remotes",
-            ",".join(whitelist),
+            ",".join(sorted(whitelist)),
+        )
+
+    @api.multi
+    def action_whitelist_add(self):
+        """Add current remotes to whitelist."""
+        self.bulk_whitelist(self.mapped("remote"))
+
+    @api.model
+    def bulk_unban(self, remotes=None, date_from=None, date_to=None):
+        """Unban attempts at once.
+
+        :param list remotes:
+            IPs or networks in CIDR notation. Attempts from any remote are
+            unbanned if empty. Bans of networks overlapping the given
+            networks, or the unbanned IPs, are lifted too, see
+            :meth:`_unban_networks`.
+
+        :param str date_from:
+            Unban only attempts done since this UTC datetime.
+
+        :param str date_to:
+            Unban only attempts done before this UTC datetime.
+
+        :return int:
+            Amount of unbanned attempts.
+        """
+        where, params = [], {}
+        marked = False
+        if remotes:
+            networks = []
+            for remote in remotes:
+                try:
+                    networks.append(
+                        ipaddress.ip_network(remote.strip(), strict=False))
+                except ValueError:
+                    continue
+            marked = self._unban_networks(networks)
+            # Remotes are not typed; those that are not IPs never match
+            where.append(
+                "{}(remote) <<= ANY(%(networks)s::inet[])".format(INET))
+            params["networks"] = [str(network) for network in networks]
+        if date_from:
+            where.append("create_date >= %(date_from)s")
+            params["date_from"] = date_from
+        if date_to:
+            where.append("create_date < %(date_to)s")
+            params["date_to"] = date_to
+        return self._unban(where, params, invalidate=marked)
+
+    @api.model
+    def _unban_networks(self, networks):
+        """Lift bans of networks overlapping some others.
+
+        Banned attempts may not exist for them, i.e. if the network was
+        banned after failures only. So an unbanned attempt is stored for
+        each one, as a marker that resets network failure counters. Single
+        IPs get none: their unbanned attempts, if any, reset them already.
+        Markers are left out of views and analysis, see :data:`ATTEMPTS`.
+
+        :param list networks:
+            ``ipaddress`` networks.
+
+        :return bool:
+            Whether markers were stored; counters must be rebuilt then.
+        """
+        networks = {
+            str(network) for network in networks
+            if network.prefixlen < network.max_prefixlen
+        }
+        if not networks:
+            return False
+        self.check_access_rights("create")
+        self.env.cr.execute(
+            """INSERT INTO res_authentication_attempt
+               (remote, result, create_date, write_date, create_uid,
+                write_uid)
+               SELECT unnest(%(networks)s), 'unbanned',
+                      now() at time zone 'UTC', now() at time zone 'UTC',
+                      %(uid)s, %(uid)s""",
+            {"networks": sorted(networks), "uid": self.env.uid},
         )
+        return True
+
+    @api.model
+    def _unban(self, where, params, invalidate=False):
+        """Unban attempts matching some conditions in one query.
+
+        Failure counters and bans of all workers are rebuilt afterwards.
+
+        :param list where:
+            SQL conditions.
+
+        :param dict params:
+            Their parameters.
+
+        :param bool invalidate:
+            Rebuild counters even if no attempt is unbanned.
+
+        :return int:
+            Amount of unbanned attempts.
+        """
+        self.check_access_rights("write")
+        self.env.cr.execute(
+            """UPDATE res_authentication_attempt
+               SET result = 'unbanned',
+                   write_uid = %(uid)s,
+                   write_date = now() at time zone 'UTC'
+               WHERE {}
+               RETURNING date_trunc('hour', create_date)""".format(
+                " AND ".join(["result = 'banned'"] + where)),
+            dict(params, uid=self.env.uid),
+        )
+        hours = [row[0] for row in self.env.cr.fetchall()]
+        if hours or invalidate:
+            self.invalidate_cache()
+            self._invalidate_counters()
+        if hours:
+            self.env["res.authentication.attempt.report"]._refresh_hours(
+                set(hours))
+        return len(hours)
 
     @api.multi
     def action_unban(self):
-        self.ensure_one()
-        if self.result == 'banned':
-            self.write({
-                'result': 'unbanned',
-            })
+        self._unban(["id IN %(ids)s"], {"ids": tuple(self.ids) or (None,)})
 
     @api.multi
     def action_whitelist_remove(self):
         """Remove current remotes from whitelist."""
-        whitelist = self._whitelist_remotes()
-        whitelist -= set(self.mapped("remote"))
-        self.env["ir.config_parameter"].set_param(
-            "auth_brute_force.whitelist_remotes",
-            ",".join(whitelist),
-        )
+        self.bulk_whitelist(self.mapped("remote"), remove=True)
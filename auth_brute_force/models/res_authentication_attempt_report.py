@@ -0,0 +1,148 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+import logging
+
+from odoo import api, fields, models
+
+from .res_authentication_attempt import ATTEMPTS
+
+_logger = logging.getLogger(__name__)
+
+
+class ResAuthenticationAttemptReport(models.Model):
+    """Hourly rollup of authentication attempts.
+
+    Analysis reads this table instead of grouping the attempts table, which
+    is written on every login.
+    """
+    _name = "res.authentication.attempt.report"
+    _description = "Authentication Attempts Analysis"
+    _order = "hour desc"
+    _log_access = False
+
+    hour = fields.Datetime(readonly=True, index=True)
+    remote = fields.Char(string="Remote IP", readonly=True)
+    login = fields.Char(string="Tried Login", readonly=True)
+    result = fields.Selection(
+        selection=lambda self: self.env["res.authentication.attempt"]
+        ._fields["result"].selection,
+        string="Authentication Result",
+        readonly=True,
+    )
+    count = fields.Integer(string="Attempts", readonly=True)
+
+    @api.model_cr
+    def init(self):
+        """Make rows unique per group, so refreshes never duplicate them."""
+        name = "%s_group_uniq" % self._table
+        self.env.cr.execute(
+            "SELECT 1 FROM pg_indexes WHERE indexname = %s", (name,))
+        if self.env.cr.fetchone():
+            return
+        # Rolled up again from scratch by the next refresh
+        self.env.cr.execute("DELETE FROM {}".format(self._table))
+        self.env.cr.execute(
+            """CREATE UNIQUE INDEX {} ON {}
+               (hour, COALESCE(remote, ''), COALESCE(login, ''), result)
+            """.format(name, self._table))
+
+    @api.model
+    def _lock(self, wait=True):
+        """Serialize refreshes of the rollup among transactions.
+
+        :param bool wait:
+            Wait for other refreshes to end, instead of giving up.
+
+        :return bool:
+            Whether the lock was taken; it is released at transaction end.
+        """
+        self.env.cr.execute(
+            "SELECT {}(%s::regclass::oid::bigint)".format(
+                "pg_advisory_xact_lock" if wait
+                else "pg_try_advisory_xact_lock"),
+            (self._table,),
+        )
+        return wait or self.env.cr.fetchone()[0]
+
+    @api.model
+    def _refresh(self, since=None):
+        """Update the rollup with attempts stored since last refresh.
+
+        The last hour already rolled up is computed again, together with
+        the previous one, to include attempts committed late.
+
+        :param str since:
+            Roll up again attempts created since this UTC datetime, i.e.
+            because their results changed.
+        """
+        if not self._lock(wait=bool(since)):
+            _logger.debug("Attempts are being rolled up already")
+            return
+        if not since:
+            self.env.cr.execute(
+                """SELECT MAX(hour) - interval '1 hour'
+                   FROM res_authentication_attempt_report""")
+            since = self.env.cr.fetchone()[0]
+        since = since or "-infinity"
+        self.env.cr.execute(
+            """DELETE FROM res_authentication_attempt_report
+               WHERE hour >= date_trunc('hour', %(since)s::timestamp)""",
+            {"since": since},
+        )
+        self.env.cr.execute(
+            """INSERT INTO res_authentication_attempt_report
+               (hour, remote, login, result, count)
+               SELECT date_trunc('hour', create_date), remote, login,
+                      result, COUNT(*)
+               FROM res_authentication_attempt
+               WHERE create_date >= date_trunc('hour', %(since)s::timestamp)
+                     AND result IS NOT NULL AND {}
+               GROUP BY 1, 2, 3, 4
+               ON CONFLICT DO NOTHING""".format(ATTEMPTS),
+            {"since": since},
+        )
+        _logger.debug(
+            "Rolled up %d groups of authentication attempts since %s",
+            self.env.cr.rowcount,
+            since,
+        )
+        self.invalidate_cache()
+
+    @api.model
+    def _refresh_hours(self, hours):
+        """Roll up again some hours only, i.e. because results changed.
+
+        :param list hours:
+            UTC datetimes of the hours, as strings or not, truncated or not.
+        """
+        if not hours:
+            return
+        self._lock()
+        params = {"hours": sorted({
+            (fields.Datetime.from_string(hour) if isinstance(hour, str)
+             else hour).replace(minute=0, second=0, microsecond=0)
+            for hour in hours
+        })}
+        self.env.cr.execute(
+            """DELETE FROM res_authentication_attempt_report
+               WHERE hour = ANY(%(hours)s::timestamp[])""",
+            params,
+        )
+        self.env.cr.execute(
+            """INSERT INTO res_authentication_attempt_report
+               (hour, remote, login, result, count)
+               SELECT h.hour, a.remote, a.login, a.result, COUNT(*)
+               FROM unnest(%(hours)s::timestamp[]) AS h(hour)
+               JOIN res_authentication_attempt a
+                   ON a.create_date >= h.hour
+                      AND a.create_date < h.hour + interval '1 hour'
+               WHERE a.result IS NOT NULL AND {}
+               GROUP BY 1, 2, 3, 4
+               ON CONFLICT DO NOTHING""".format(ATTEMPTS),
+            params,
+        )
+        self.invalidate_cache()
+
+    @api.model
+    def _cron_refresh(self):
+        self._refresh()
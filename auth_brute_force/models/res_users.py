@@ -4,10 +4,13 @@
 
 import logging
 from contextlib import contextmanager
-from threading import current_thread
-from odoo import api, models, SUPERUSER_ID
+from odoo import api, fields, models
 from odoo.exceptions import AccessDenied
-from odoo.service import wsgi_server
+from odoo.http import request
+
+from .. import attempt as attempts, metrics, remote
+from ..exceptions import LoginDelayed
+from ..journal import journal
 
 _logger = logging.getLogger(__name__)
 
@@ -20,31 +23,22 @@ class ResUsers(models.Model):
     @api.model_cr
     def _register_hook(self):
         """🐒-patch XML-RPC controller to know remote address."""
-        original_fn = wsgi_server.application_unproxied
-
-        def _patch(environ, start_response):
-            current_thread().environ = environ
-            return original_fn(environ, start_response)
-
-        wsgi_server.application_unproxied = _patch
+        remote.install()
+        return super(ResUsers, self)._register_hook()
 
     # Helpers to track authentication attempts
     @classmethod
     @contextmanager
     def _auth_attempt(cls, login):
         """Start an authentication attempt and track its state."""
-        try:
-            # Check if this call is nested
-            attempt_id = current_thread().auth_attempt_id
-        except AttributeError:
-            # Not nested; create a new attempt
-            attempt_id = cls._auth_attempt_new(login)
-        if not attempt_id:
+        # Nested calls share the running attempt
+        running = attempts.current() or cls._auth_attempt_new(login)
+        if not running:
             # No attempt was created, so there's nothing to do here
             yield
             return
+        attempts.enter(running)
         try:
-            current_thread().auth_attempt_id = attempt_id
             result = "successful"
             try:
                 yield
@@ -54,10 +48,7 @@ class ResUsers(models.Model):
             finally:
                 cls._auth_attempt_update({"result": result})
         finally:
-            try:
-                del current_thread().auth_attempt_id
-            except AttributeError:
-                pass  # It was deleted already
+            attempts.leave(running)
 
     @classmethod
     def _auth_attempt_force_raise(cls, login, method):
@@ -74,38 +65,53 @@ class ResUsers(models.Model):
 
     @classmethod
     def _auth_attempt_new(cls, login):
-        """Store one authentication attempt, not knowing the result."""
+        """Start one authentication attempt, not knowing the result.
+
+        It is kept in memory until it gets a result.
+
+        :return odoo.addons.auth_brute_force.attempt.AttemptContext:
+            The new attempt, or ``False`` if it cannot be tracked.
+        """
         # Get the right remote address
-        try:
-            remote_addr = current_thread().environ["REMOTE_ADDR"]
-        except (KeyError, AttributeError):
-            remote_addr = False
+        remote_addr = remote.get()
         # Exit if it doesn't make sense to store this attempt
         if not remote_addr:
             return False
-        # Use a separate cursor to keep changes always
-        with cls.pool.cursor() as cr:
-            env = api.Environment(cr, SUPERUSER_ID, {})
-            attempt = env["res.authentication.attempt"].create({
-                "login": login,
-                "remote": remote_addr,
-            })
-            return attempt.id
+        return attempts.AttemptContext(
+            login, remote_addr, fields.Datetime.now())
 
     @classmethod
     def _auth_attempt_update(cls, values):
-        """Update a given auth attempt if we still ignore its result."""
-        auth_id = getattr(current_thread(), "auth_attempt_id", False)
-        if not auth_id:
+        """Update a given auth attempt if we still ignore its result.
+
+        Once it gets a result, it is counted and queued to be stored.
+        """
+        running = attempts.current()
+        if not running:
             return {}  # No running auth attempt; nothing to do
-        # Use a separate cursor to keep changes always
-        with cls.pool.cursor() as cr:
-            env = api.Environment(cr, SUPERUSER_ID, {})
-            attempt = env["res.authentication.attempt"].browse(auth_id)
-            # Update only on 1st call
-            if not attempt.result:
-                attempt.write(values)
-            return attempt.copy_data()[0] if attempt else {}
+        # Update only on 1st call
+        if not running.result:
+            for name, value in values.items():
+                setattr(running, name, value)
+            if running.result:
+                journal.append(cls.pool, running.values())
+        return running.values()
+
+    @api.model
+    def _auth_measure(self, layer):
+        """Measure the credentials check of another addon.
+
+        Auth addons call this hook around their override of
+        :meth:`check_credentials`, if it exists, so they need not depend
+        on this one. See :mod:`odoo.addons.auth_brute_force.metrics`.
+
+        :param str layer:
+            Name of the addon.
+
+        :return:
+            Context manager measuring the block it wraps.
+        """
+        return metrics.measure(layer, self.env.cr)
 
     # Override all auth-related core methods
     @classmethod
@@ -124,6 +130,7 @@ class ResUsers(models.Model):
         )
 
     @api.model
+    @metrics.instrument("auth_brute_force")
     def check_credentials(self, password):
         """This is the most important and specific auth check method.
 
@@ -135,16 +142,38 @@ class ResUsers(models.Model):
         login = self.env.user.login
         with self._auth_attempt(login):
             # Update login, just in case we stored the UID before
-            attempt = self._auth_attempt_update({"login": login})
-            remote = attempt.get("remote")
-            # Fail if the remote is banned
-            trusted = self.env["res.authentication.attempt"]._trusted(
-                remote,
-                login,
-            )
-            if not trusted:
-                error = AccessDenied()
-                error.reason = "banned"
-                raise error
-            # Continue with other auth systems
-            return super(ResUsers, self).check_credentials(password)
+            self._auth_attempt_update({"login": login})
+            running = attempts.current()
+            if not running:
+                # Untracked attempts cannot be banned
+                return super(ResUsers, self).check_credentials(password)
+            queries = getattr(self.env.cr, "sql_log_count", 0)
+            try:
+                # Fail if the remote is banned; nested calls decided already
+                key = running.remote, login
+                try:
+                    reason = running.decisions[key]
+                except KeyError:
+                    reason = running.decisions[key] = self.env[
+                        "res.authentication.attempt"]._ban_reason(*key)
+                if reason == "delayed":
+                    # Let the login form tell users to retry later
+                    if request:
+                        request.auth_brute_force_delayed = True
+                    error = LoginDelayed()
+                    error.reason = reason
+                    raise error
+                if reason:
+                    error = AccessDenied()
+                    error.reason = reason
+                    raise error
+                # Continue with other auth systems
+                try:
+                    return super(ResUsers, self).check_credentials(password)
+                except AccessDenied:
+                    # Slow down further attempts, if configured
+                    self.env["res.authentication.attempt"]._backoff(*key)
+                    raise
+            finally:
+                running.queries += (
+                    getattr(self.env.cr, "sql_log_count", 0) - queries)
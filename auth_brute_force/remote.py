@@ -0,0 +1,121 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+"""Remote address of the request being served.
+
+XML-RPC requests have no ``odoo.http.request``, so the WSGI entry point is
+wrapped once per process by :func:`install`, to remember the remote address
+of every HTTP, XML-RPC and JSON-RPC request until it ends. Only that string
+is kept, never the WSGI environ.
+
+The address is local to the running context: a ``contextvars.ContextVar``
+where available, or else a ``threading.local``, which gevent patches to be
+greenlet-local for longpolling.
+
+When ``proxy_mode`` is enabled, the ``auth_brute_force_trusted_proxies``
+server option can list the networks of your reverse proxies, comma-separated.
+Then the remote is the last address of the ``X-Forwarded-For`` chain that
+does not belong to them, instead of the one chosen by werkzeug's
+``ProxyFix``, that always trusts one proxy.
+"""
+
+import threading
+from functools import wraps
+
+from odoo.service import wsgi_server
+from odoo.tools import config
+
+from .whitelist import WhitelistIndex
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
+if ContextVar is not None:
+    _remote = ContextVar("auth_brute_force_remote", default=None)
+
+    def get():
+        """Get the remote address of the current request, if any."""
+        return _remote.get()
+
+    def _set(remote):
+        return _remote.set(remote)
+
+    def _reset(token):
+        _remote.reset(token)
+else:
+    _local = threading.local()
+
+    def get():
+        """Get the remote address of the current request, if any."""
+        return getattr(_local, "remote", None)
+
+    def _set(remote):
+        token = get()
+        _local.remote = remote
+        return token
+
+    def _reset(token):
+        _local.remote = token
+
+
+_proxies = {}
+
+
+def _trusted_proxies():
+    """Compile the trusted proxies server option, once per value."""
+    option = config.get("auth_brute_force_trusted_proxies") or ""
+    try:
+        return _proxies[option]
+    except KeyError:
+        index = _proxies[option] = WhitelistIndex(option.split(","))
+        return index
+
+
+def resolve(environ):
+    """Get the remote address of a WSGI request.
+
+    :param dict environ:
+        WSGI environ.
+
+    :return str:
+        Remote IP, or ``None`` if unknown.
+    """
+    remote = environ.get("REMOTE_ADDR")
+    if not config.get("proxy_mode"):
+        return remote
+    proxies = _trusted_proxies()
+    if not proxies:
+        return remote
+    # Address of the actual peer, before ProxyFix replaced it
+    peer = environ.get("werkzeug.proxy_fix.orig_remote_addr", remote)
+    hops = [
+        hop.strip()
+        for hop in environ.get("HTTP_X_FORWARDED_FOR", "").split(",")
+        if hop.strip()
+    ]
+    hops.append(peer)
+    while len(hops) > 1 and hops[-1] in proxies:
+        hops.pop()
+    return hops[-1]
+
+
+def wrap(application):
+    """Make a WSGI application remember the remote while serving."""
+
+    @wraps(application)
+    def _wrapper(environ, start_response):
+        token = _set(resolve(environ))
+        try:
+            return application(environ, start_response)
+        finally:
+            _reset(token)
+
+    _wrapper.auth_brute_force_remote = True
+    return _wrapper
+
+
+def install():
+    """Wrap Odoo's WSGI entry point, unless done already."""
+    current = wsgi_server.application_unproxied
+    if not getattr(current, "auth_brute_force_remote", False):
+        wsgi_server.application_unproxied = wrap(current)
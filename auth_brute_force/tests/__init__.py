@@ -1 +1,8 @@
+from . import test_bans
 from . import test_brute_force
+from . import test_counters
+from . import test_geo
+from . import test_report
+from . import test_remote
+from . import test_load
+from . import test_metrics
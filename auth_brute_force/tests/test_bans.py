@@ -0,0 +1,145 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from odoo.tests.common import TransactionCase
+
+from .. import bans
+
+
+class BansCase(TransactionCase):
+    def setUp(self):
+        super(BansCase, self).setUp()
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, bans.FILE_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        super(BansCase, self).tearDown()
+
+    def colliding(self, table, amount):
+        """Get remotes whose bans start probing at the same slot."""
+        found, start = [], None
+        for number in range(10000):
+            remote = "10.0.%d.%d" % divmod(number, 256)
+            index = table._key_hash("ban", "db", remote, None) % table.slots
+            if start is None:
+                start = index
+            if index == start:
+                found.append(remote)
+                if len(found) == amount:
+                    return found
+
+    def test_probing(self):
+        """Colliding keys are kept in the next slots."""
+        table = bans.BanTable(self.path, slots=8)
+        remotes = self.colliding(table, 3)
+        for remote in remotes:
+            table.ban("db", remote)
+        for remote in remotes:
+            self.assertTrue(table.banned("db", remote))
+        self.assertFalse(table.banned("db", "192.168.0.1"))
+        self.assertFalse(table.banned("other", remotes[0]))
+        self.assertFalse(table.banned("db", remotes[0], "admin"))
+
+    def test_full(self):
+        """The ban that expires first is replaced when probes are full."""
+        table = bans.BanTable(self.path, slots=2)
+        table.ban("db", "10.0.0.1", ttl=100)
+        table.ban("db", "10.0.0.2", ttl=200)
+        table.ban("db", "10.0.0.3", ttl=300)
+        self.assertFalse(table.banned("db", "10.0.0.1"))
+        self.assertTrue(table.banned("db", "10.0.0.2"))
+        self.assertTrue(table.banned("db", "10.0.0.3"))
+
+    def test_ttl(self):
+        """Bans expire, and expired slots are reused."""
+        table = bans.BanTable(self.path, slots=8)
+        table.ban("db", "10.0.0.1", ttl=0)
+        self.assertFalse(table.banned("db", "10.0.0.1"))
+        table.ban("db", "10.0.0.1", ttl=60)
+        self.assertTrue(table.banned("db", "10.0.0.1"))
+
+    def test_clear(self):
+        """Bans are lifted for one database only."""
+        table = bans.BanTable(self.path, slots=8)
+        table.ban("db", "10.0.0.1")
+        table.ban("db", "10.0.0.1", "admin")
+        table.ban("other", "10.0.0.1")
+        table.clear("db")
+        self.assertFalse(table.banned("db", "10.0.0.1"))
+        self.assertFalse(table.banned("db", "10.0.0.1", "admin"))
+        self.assertTrue(table.banned("other", "10.0.0.1"))
+
+    def test_shared(self):
+        """Tables opened on the same file see the same bans."""
+        table = bans.BanTable(self.path, slots=8)
+        table.ban("db", "10.0.0.1")
+        self.assertTrue(bans.BanTable(self.path, slots=8).banned(
+            "db", "10.0.0.1"))
+
+    def test_reinit(self):
+        """Corrupt files, or files of another size, are started again."""
+        with open(self.path, "wb") as ban_file:
+            ban_file.write(b"garbage")
+        table = bans.BanTable(self.path, slots=8)
+        self.assertEqual(os.path.getsize(self.path), table.size)
+        table.ban("db", "10.0.0.1")
+        self.assertTrue(table.banned("db", "10.0.0.1"))
+        table = bans.BanTable(self.path, slots=16)
+        self.assertEqual(os.path.getsize(self.path), table.size)
+        self.assertFalse(table.banned("db", "10.0.0.1"))
+        with open(self.path, "r+b") as ban_file:
+            ban_file.write(b"CORRUPT!")
+        table = bans.BanTable(self.path, slots=16)
+        self.assertEqual(table.map[:len(bans.MAGIC)], bans.MAGIC)
+
+    def test_seqlock(self):
+        """Readers retry while written, and give up if it takes long."""
+        table = bans.BanTable(self.path, slots=8)
+        calls = []
+
+        def _read():
+            calls.append(True)
+            if len(calls) == 1:
+                # A writer ran meanwhile
+                table._set_seq(table._seq() + 2)
+            return len(calls)
+
+        self.assertEqual(table._read(_read, 0), 2)
+        table.ban("db", "10.0.0.1")
+        # A writer is running, or died while writing
+        table._set_seq(table._seq() + 1)
+        self.assertFalse(table.banned("db", "10.0.0.1"))
+        # The next writer fixes the sequence
+        table.ban("db", "10.0.0.2")
+        self.assertEqual(table._seq() % 2, 0)
+        self.assertTrue(table.banned("db", "10.0.0.1"))
+
+    def test_threads(self):
+        """Writers of the same process do not run at once."""
+        table = bans.BanTable(self.path, slots=8)
+        running, overlaps = [], []
+
+        def _write():
+            running.append(True)
+            overlaps.append(len(running) > 1)
+            time.sleep(0.001)
+            running.pop()
+
+        def _run():
+            for _n in range(20):
+                table._write(_write)
+
+        threads = [threading.Thread(target=_run) for _n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(overlaps), 80)
+        self.assertFalse(any(overlaps))
+        self.assertEqual(table._seq(), 160)
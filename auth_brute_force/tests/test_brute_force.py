@@ -1,8 +1,6 @@
 # Copyright 2017 Tecnativa - Jairo Llopis
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
-from threading import current_thread
-
 from decorator import decorator
 from mock import patch
 from werkzeug.utils import redirect
@@ -11,11 +9,13 @@ from odoo import http
 from odoo.tests.common import at_install, HttpCase, post_install
 from odoo.tools import mute_logger
 
+from .. import geo
 from ..models import res_authentication_attempt, res_users
 
 
 GARBAGE_LOGGERS = (
     "werkzeug",
+    geo.__name__,
     res_authentication_attempt.__name__,
     res_users.__name__,
 )
@@ -110,18 +110,10 @@ def patch_cursor(func):
 # Skip specific browser forgery on redirections
 @patch(http.__name__ + ".redirect_with_hash", side_effect=redirect)
 # Faster tests without calls to geolocation API
-@patch(res_authentication_attempt.__name__ + ".urlopen", return_value="")
+@patch(geo.__name__ + ".urlopen", return_value="")
 class BruteForceCase(HttpCase):
     def setUp(self):
         super(BruteForceCase, self).setUp()
-        # Some tests could retain environ from last test and produce fake
-        # results without this patch
-        # HACK https://github.com/odoo/odoo/issues/24183
-        # TODO Remove in v12
-        try:
-            del current_thread().environ
-        except AttributeError:
-            pass
         # Complex password to avoid conflicts with `password_security`
         self.good_password = "Admin$%02584"
         self.data_demo = {
@@ -142,6 +134,11 @@ class BruteForceCase(HttpCase):
                 ("login", "=", self.data_demo["login"]),
             ]).password = self.data_demo["password"]
 
+    def tearDown(self):
+        # Forget bans found here, whose attempts are rolled back
+        self.env["res.authentication.attempt"]._invalidate_counters()
+        super(BruteForceCase, self).tearDown()
+
     # HACK https://github.com/odoo/odoo/pull/24833
     def addons_installed(self, *addons):
         """Know if the specified addons are installed."""
@@ -355,6 +352,32 @@ class BruteForceCase(HttpCase):
             ])
             self.assertEqual(len(banned), 0)
 
+    @skip_unless_addons_installed("web")
+    @mute_logger(*GARBAGE_LOGGERS)
+    @patch_cursor
+    def test_web_login_delayed(self, *args):
+        """Users waiting to retry are not told their password is wrong."""
+        with self.cursor() as cr:
+            env = self.env(cr)
+            env["ir.config_parameter"].set_param(
+                "auth_brute_force.backoff", 60)
+        data1 = {
+            "login": "admin",
+            "password": "1234",  # Wrong
+        }
+        self.url_open("/web/session/logout", timeout=30)
+        response = self.url_open("/web/login", data1, 30)
+        self.assertIn("Wrong login/password", response.text)
+        # Right password, but too soon
+        data1["password"] = self.good_password
+        response = self.url_open("/web/login", data1, 30)
+        self.assertTrue(
+            response.url.endswith("/web/login"),
+            "Unexpected URL %s" % response.url,
+        )
+        self.assertIn("Wait a moment", response.text)
+        self.assertNotIn("Wrong login/password", response.text)
+
     @mute_logger(*GARBAGE_LOGGERS)
     @patch_cursor
     def test_xmlrpc_login_existing(self, *args):
@@ -0,0 +1,341 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from mock import patch
+
+from odoo import fields
+from odoo.tests.common import TransactionCase
+
+from .. import attempt, bans, counters, journal as journal_module, remote
+from ..journal import journal
+
+
+class CountersCase(TransactionCase):
+    def setUp(self):
+        super(CountersCase, self).setUp()
+        self.Attempt = self.env["res.authentication.attempt"]
+        # Start from scratch; this also drops counters from other tests
+        self.Attempt.search([]).unlink()
+
+    def tearDown(self):
+        # Forget bans found here, whose attempts are rolled back
+        self.Attempt._invalidate_counters()
+        super(CountersCase, self).tearDown()
+
+    def attempt(self, result, remote="10.0.0.1", login="admin"):
+        return self.Attempt.create({
+            "login": login,
+            "remote": remote,
+            "result": result,
+        })
+
+    def failures(self, remote="10.0.0.1", login=None):
+        synced = self.Attempt._counters()
+        return synced.failures(self.env.cr, remote, login)
+
+    def test_cold_start(self):
+        """Counters are rebuilt from stored attempts."""
+        self.attempt("failed")
+        self.attempt("successful")
+        self.attempt("failed")
+        self.attempt("failed", login="demo")
+        self.assertEqual(self.failures(), 2)
+        self.assertEqual(self.failures(login="admin"), 1)
+        self.assertEqual(self.failures(login="demo"), 1)
+        self.assertEqual(self.failures("10.0.0.2"), 0)
+
+    def test_incremental(self):
+        """Counters follow new attempts without reloading keys."""
+        self.assertEqual(self.failures(), 0)
+        self.assertEqual(self.failures(login="admin"), 0)
+        self.attempt("failed")
+        self.attempt("banned")
+        self.assertEqual(self.failures(), 2)
+        self.assertEqual(self.failures(login="admin"), 2)
+        self.attempt("successful", login="demo")
+        self.assertEqual(self.failures(), 0)
+        self.assertEqual(self.failures(login="admin"), 2)
+
+    def test_pending(self):
+        """Attempts count once they get their result."""
+        self.assertEqual(self.failures(), 0)
+        pending = self.attempt(False)
+        self.assertEqual(self.failures(), 0)
+        pending.result = "failed"
+        self.assertEqual(self.failures(), 1)
+
+    def test_journal_retry(self):
+        """Attempts that cannot be stored are retried, and counted once."""
+        values = {
+            "login": "admin",
+            "remote": "10.0.0.1",
+            "result": "failed",
+            "create_date": fields.Datetime.now(),
+        }
+        self.assertEqual(self.failures(), 0)
+        with patch.object(journal_module, "execute_values",
+                          side_effect=Exception("Database is down")):
+            journal.append(self.registry, values)
+        self.assertEqual(len(journal.queue), 1)
+        self.assertEqual(self.failures(), 1)
+        self.assertFalse(self.Attempt.search([]))
+        self.assertTrue(journal.flush())
+        self.assertFalse(journal.queue)
+        self.assertEqual(len(self.Attempt.search([])), 1)
+        self.assertEqual(self.failures(), 1)
+
+    def test_provisional_clear(self):
+        """Attempts recorded after a rebuild never reuse provisional ids."""
+        synced = counters.AttemptCounters()
+        old_id = synced.record("10.0.0.1", "admin", "failed")
+        synced.clear()
+        new_id = synced.record("10.0.0.1", "admin", "failed")
+        self.assertGreater(new_id, old_id)
+        # A late confirmation of the old attempt leaves the new one alone
+        synced.confirm([(old_id, 100)])
+        self.assertIn(new_id, synced.unconfirmed)
+
+    def test_provisional_success(self):
+        """Failures of other workers count until a success is stored."""
+        synced = counters.AttemptCounters()
+        synced.last_id = 100
+        state = synced._state(("10.0.0.1",))
+        state.loaded = True
+        provisional_id = synced.record("10.0.0.1", "admin", "successful")
+        synced._apply([
+            (attempt_id, "10.0.0.1", "demo", "failed", 0)
+            for attempt_id in (101, 102, 103)
+        ])
+        self.assertEqual(len(state.failures), 3)
+        synced.confirm([(provisional_id, 104)])
+        self.assertEqual(len(state.failures), 0)
+        self.assertEqual(state.last_ok, 104)
+
+    def test_unban(self):
+        """Unbanning resets the streak."""
+        self.env["ir.config_parameter"].set_param(
+            "auth_brute_force.max_by_ip", 2)
+        self.attempt("failed")
+        banned = self.attempt("banned")
+        self.assertFalse(self.Attempt._trusted("10.0.0.1", "admin"))
+        shared = bans.get()
+        self.assertTrue(shared.banned(self.env.cr.dbname, "10.0.0.1"))
+        banned.action_unban()
+        self.assertFalse(shared.banned(self.env.cr.dbname, "10.0.0.1"))
+        self.assertEqual(self.failures(), 0)
+        self.assertTrue(self.Attempt._trusted("10.0.0.1", "admin"))
+
+    def test_generation(self):
+        """Counters are rebuilt when another worker changes results."""
+        banned = self.attempt("banned")
+        self.assertEqual(self.failures(), 1)
+        self.env.cr.execute(
+            """UPDATE res_authentication_attempt SET result = 'unbanned'
+               WHERE id = %s""",
+            (banned.id,),
+        )
+        self.assertEqual(self.failures(), 1)
+        # Parameters changes are not enough
+        self.env["ir.config_parameter"].set_param(
+            "auth_brute_force.max_by_ip", 20)
+        self.assertEqual(self.failures(), 1)
+        self.env.cr.execute(
+            "SELECT nextval(%s)", (counters.GENERATION_SEQUENCE,))
+        self.assertEqual(self.failures(), 0)
+
+    def test_prune(self):
+        """Old attempts are pruned according to retention."""
+        old = self.attempt("failed")
+        new = self.attempt("failed")
+        self.env.cr.execute(
+            """UPDATE res_authentication_attempt
+               SET create_date = create_date - interval '400 days'
+               WHERE id = %s""",
+            (old.id,),
+        )
+        self.Attempt._cron_prune()
+        self.assertFalse(old.exists())
+        self.assertTrue(new.exists())
+        # Disabled retention keeps everything
+        self.env["ir.config_parameter"].set_param(
+            "auth_brute_force.retention_days", 0)
+        self.env.cr.execute(
+            """UPDATE res_authentication_attempt
+               SET create_date = create_date - interval '400 days'
+               WHERE id = %s""",
+            (new.id,),
+        )
+        self.Attempt._cron_prune()
+        self.assertTrue(new.exists())
+
+    def test_whitelist(self):
+        """Whitelisted networks are compiled and follow parameter changes."""
+        self.env["ir.config_parameter"].set_param(
+            "auth_brute_force.whitelist_remotes",
+            "10.0.0.0/8,192.168.1.5,invalid,2001:db8::/32",
+        )
+        self.assertTrue(self.Attempt._is_whitelisted("10.20.30.40"))
+        self.assertTrue(self.Attempt._is_whitelisted("192.168.1.5"))
+        self.assertTrue(self.Attempt._is_whitelisted("2001:db8::1"))
+        self.assertFalse(self.Attempt._is_whitelisted("192.168.1.6"))
+        self.assertFalse(self.Attempt._is_whitelisted("invalid"))
+        attempt = self.attempt("failed", remote="192.168.1.6")
+        self.assertFalse(attempt.whitelisted)
+        attempt.action_whitelist_add()
+        attempt.invalidate_cache()
+        self.assertTrue(attempt.whitelisted)
+        self.assertTrue(self.Attempt._is_whitelisted("192.168.1.6"))
+
+    def test_attempt_context(self):
+        """Nested auth calls share one attempt and its ban decision."""
+        Users = self.env["res.users"]
+        password = "Admin$%02584"
+        self.env.user.password = password
+        with patch.object(remote, "get", return_value="10.0.0.9"):
+            before = attempt.stats()["attempts"]
+            with patch.object(journal, "append") as append, \
+                    patch.object(type(self.Attempt), "_ban_reason",
+                                 return_value=None) as trusted:
+                with Users._auth_attempt("admin"):
+                    running = attempt.current()
+                    with Users._auth_attempt("admin"):
+                        self.assertIs(attempt.current(), running)
+                        Users.check_credentials(password)
+                        Users.check_credentials(password)
+                    self.assertIs(attempt.current(), running)
+            self.assertIsNone(attempt.current())
+            self.assertEqual(trusted.call_count, 1)
+            self.assertEqual(append.call_count, 1)
+            self.assertEqual(running.result, "successful")
+            self.assertEqual(attempt.stats()["attempts"], before + 1)
+
+    def test_backoff(self):
+        """Failures make the remote+login combination wait."""
+        self.assertEqual(self.Attempt._backoff_delay(1), 0)
+        self.env["ir.config_parameter"].set_param(
+            "auth_brute_force.backoff", 60)
+        self.assertEqual(self.Attempt._backoff_delay(1), 60)
+        self.assertEqual(self.Attempt._backoff_delay(3), 240)
+        self.assertEqual(self.Attempt._backoff_delay(100), 300)
+        self.assertTrue(self.Attempt._trusted("10.0.0.1", "admin"))
+        self.Attempt._backoff("10.0.0.1", "admin")
+        self.assertEqual(
+            self.Attempt._ban_reason("10.0.0.1", "admin"), "delayed")
+        self.assertTrue(self.Attempt._trusted("10.0.0.1", "demo"))
+        # Rejections while waiting are not failures
+        self.attempt("delayed")
+        self.assertEqual(self.failures(), 0)
+        self.assertEqual(self.failures(login="admin"), 0)
+
+    def test_backoff_unshared(self):
+        """Failures make the combination wait, even without shared bans."""
+        self.env["ir.config_parameter"].set_param(
+            "auth_brute_force.backoff", 60)
+        with patch.object(bans, "get", return_value=bans._NullTable()):
+            self.assertTrue(self.Attempt._trusted("10.0.0.1", "admin"))
+            self.attempt("failed")
+            self.assertEqual(
+                self.Attempt._ban_reason("10.0.0.1", "admin"), "delayed")
+            self.assertTrue(self.Attempt._trusted("10.0.0.1", "demo"))
+            self.attempt("successful")
+            self.assertTrue(self.Attempt._trusted("10.0.0.1", "admin"))
+
+    def test_subnet(self):
+        """Failures from a whole network ban it, even if IPs change."""
+        set_param = self.env["ir.config_parameter"].set_param
+        set_param("auth_brute_force.max_by_ipv4_subnet", "24:3,16:100")
+        self.attempt("failed", remote="10.0.0.1")
+        self.attempt("successful", remote="10.0.0.2")
+        self.attempt("failed", remote="10.0.0.3")
+        self.assertTrue(self.Attempt._trusted("10.0.0.4", "admin"))
+        synced = self.Attempt._counters()
+        self.assertEqual(synced.network_failures("10.0.0.0/24"), 2)
+        self.assertEqual(synced.network_failures("10.0.0.0/16"), 2)
+        # Successes do not reset network counters
+        self.attempt("successful", remote="10.0.0.3")
+        self.attempt("failed", remote="10.0.0.5")
+        self.assertFalse(self.Attempt._trusted("10.0.0.6", "admin"))
+        self.assertTrue(self.Attempt._trusted("10.0.1.1", "admin"))
+        # Other IP versions are not affected
+        self.attempt("failed", remote="::1")
+        self.assertTrue(self.Attempt._trusted("::1", "admin"))
+        # Disabled by default
+        set_param("auth_brute_force.max_by_ipv4_subnet", "")
+        self.assertTrue(self.Attempt._trusted("10.0.0.6", "admin"))
+
+    def test_subnet_unban(self):
+        """Network bans are lifted by unbanning the network."""
+        set_param = self.env["ir.config_parameter"].set_param
+        set_param("auth_brute_force.max_by_ipv4_subnet", "24:2,16:100")
+        self.attempt("failed", remote="10.0.0.1")
+        self.attempt("failed", remote="10.0.0.2")
+        self.assertFalse(self.Attempt._trusted("10.0.0.3", "admin"))
+        # No banned attempts to unban, but the network is lifted anyway
+        self.assertEqual(self.Attempt.bulk_unban(["10.0.0.0/24"]), 0)
+        self.assertTrue(self.Attempt._trusted("10.0.0.3", "admin"))
+        synced = self.Attempt._counters()
+        self.assertEqual(synced.network_failures("10.0.0.0/24"), 0)
+        self.assertEqual(synced.network_failures("10.0.0.0/16"), 0)
+        marker = self.Attempt.search([("remote", "=", "10.0.0.0/24")])
+        self.assertEqual(marker.result, "unbanned")
+        # Single IPs get no markers
+        self.Attempt.bulk_unban(["10.0.0.1"])
+        self.assertFalse(self.Attempt.search([("remote", "like", "/")]) -
+                         marker)
+        # Later failures count again
+        self.attempt("failed", remote="10.0.0.4")
+        synced = self.Attempt._counters()
+        self.assertEqual(synced.network_failures("10.0.0.0/24"), 1)
+
+    def test_subnet_whitelist(self):
+        """Whitelisted remotes do not count for their networks."""
+        set_param = self.env["ir.config_parameter"].set_param
+        set_param("auth_brute_force.max_by_ipv4_subnet", "24:2")
+        set_param("auth_brute_force.whitelist_remotes", "10.0.0.1")
+        for _n in range(3):
+            self.attempt("failed", remote="10.0.0.1")
+        self.attempt("failed", remote="10.0.0.2")
+        self.assertTrue(self.Attempt._trusted("10.0.0.3", "admin"))
+        synced = self.Attempt._counters()
+        self.assertEqual(synced.network_failures("10.0.0.0/24"), 1)
+
+    def test_window_order(self):
+        """Network failures expire by time, whatever order they come in."""
+        state = counters._WindowState()
+        state.add(counters.PROVISIONAL + 1, 100)
+        state.add(None, 50, amount=3)
+        state.add(7, 200)
+        state.confirm(counters.PROVISIONAL + 1, 8)
+        self.assertEqual(state.count(0), 5)
+        self.assertEqual(state.count(60), 2)
+        self.assertEqual(state.count(150), 1)
+        state.add(7, 200)
+        self.assertEqual(state.count(150), 1)
+
+    def test_bulk_unban(self):
+        """Attempts are unbanned by network and time range at once."""
+        self.attempt("banned", remote="10.0.0.1")
+        self.attempt("banned", remote="10.0.1.1")
+        other = self.attempt("banned", remote="192.168.0.1")
+        # Remotes that look like IPs but are not do not break unbanning
+        for remote in ("abc", "1.2.3", "::::"):
+            self.attempt("banned", remote=remote)
+        self.assertEqual(self.failures("10.0.0.1"), 1)
+        self.assertEqual(self.Attempt.bulk_unban(["10.0.0.0/16"]), 2)
+        self.assertEqual(self.failures("10.0.0.1"), 0)
+        self.assertEqual(other.result, "banned")
+        self.assertEqual(self.Attempt.bulk_unban(["nonsense"]), 0)
+        self.assertEqual(self.Attempt.bulk_unban(["192.168.0.1"]), 1)
+        self.assertEqual(other.result, "unbanned")
+        other.result = "banned"
+        self.assertEqual(
+            self.Attempt.bulk_unban(date_to="2000-01-01 00:00:00"), 0)
+        other.action_unban()
+        self.assertEqual(other.result, "unbanned")
+
+    def test_bulk_whitelist(self):
+        """Networks are whitelisted at once."""
+        self.Attempt.bulk_whitelist(["10.0.0.0/24", "192.168.0.1"])
+        self.assertTrue(self.Attempt._is_whitelisted("10.0.0.5"))
+        self.Attempt.bulk_whitelist(["10.0.0.0/24"], remove=True)
+        self.assertFalse(self.Attempt._is_whitelisted("10.0.0.5"))
+        self.assertTrue(self.Attempt._is_whitelisted("192.168.0.1"))
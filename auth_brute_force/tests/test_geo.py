@@ -0,0 +1,141 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+import os
+import shutil
+import tempfile
+import time
+
+from mock import Mock, patch
+
+from odoo.tests.common import TransactionCase
+
+from .. import geo
+
+CSV = os.path.join(os.path.dirname(__file__), "geo.csv")
+
+
+class GeoCase(TransactionCase):
+    def setUp(self):
+        super(GeoCase, self).setUp()
+        self.csv = geo.CsvRangeBackend(CSV)
+
+    def test_csv_boundaries(self):
+        """Ranges include their first and last IPs only."""
+        found = self.csv.lookup_many([
+            "1.0.0.0", "1.0.0.255", "8.8.7.255", "8.8.8.0", "8.8.8.255",
+            "8.8.9.0", "2001:4860::1", "2001:4861::",
+        ])
+        self.assertEqual(
+            sorted(found), ["1.0.0.0", "1.0.0.255", "2001:4860::1",
+                            "8.8.8.0", "8.8.8.255"])
+        self.assertEqual(
+            dict(found["8.8.8.0"]),
+            {"country": "US", "city": "Mountain View"})
+        self.assertEqual(list(found["1.0.0.0"]), ["country", "city"])
+
+    def test_csv_misses(self):
+        """Unknown, private and invalid IPs get no metadata."""
+        self.assertEqual(self.csv.lookup_many([
+            "9.9.9.9", "10.0.0.1", "127.0.0.1", "::1", "invalid", "",
+        ]), {})
+        # Rows with invalid IPs, or too short, are skipped
+        self.assertEqual(self.csv.lookup_many(["1.1.1.1"]), {})
+
+    def test_lru(self):
+        """Least recently used entries are evicted first."""
+        cache = geo._LRU(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("d", 4)
+        self.assertIsNone(cache.get("c"))
+        self.assertEqual(list(cache.data), ["a", "d"])
+
+    def test_cache(self):
+        """Lookups, including misses, are cached per IP."""
+        self.csv.cache = geo._LRU(2)
+        with patch.object(
+                self.csv, "lookup", wraps=self.csv.lookup) as lookup:
+            self.csv.lookup_many(["1.0.0.1", "9.9.9.9"])
+            self.csv.lookup_many(["1.0.0.1", "9.9.9.9"])
+            self.assertEqual(lookup.call_count, 2)
+            self.csv.lookup_many(["8.8.8.8"])
+            self.assertEqual(lookup.call_count, 3)
+            self.assertEqual(len(self.csv.cache.data), 2)
+
+    def test_mmdb(self):
+        """MaxMind records are flattened, with English names."""
+        backend = geo.MmdbBackend.__new__(geo.MmdbBackend)
+        geo.LocalBackend.__init__(backend)
+        backend.reader = Mock()
+        backend.reader.get.side_effect = lambda ip: {
+            "8.8.8.8": {
+                "country": {"iso_code": "US", "names": {"en": "USA"}},
+                "location": {"latitude": 37.7, "longitude": -122.4},
+                "subdivisions": [{"iso_code": "CA"}],
+            },
+        }.get(ip)
+        found = backend.lookup_many(["8.8.8.8", "9.9.9.9"])
+        self.assertEqual(list(found), ["8.8.8.8"])
+        self.assertEqual(dict(found["8.8.8.8"]), {
+            "country_iso_code": "US",
+            "country_name": "USA",
+            "location_latitude": 37.7,
+            "location_longitude": -122.4,
+        })
+
+    def test_chain(self):
+        """Only IPs missing locally are asked to the fallback."""
+        fallback = Mock()
+        fallback.lookup_many.return_value = {"9.9.9.9": {"country": "CH"}}
+        chain = geo.ChainBackend(self.csv, fallback)
+        found = chain.lookup_many(["8.8.8.8", "9.9.9.9"])
+        fallback.lookup_many.assert_called_once_with({"9.9.9.9"})
+        self.assertEqual(sorted(found), ["8.8.8.8", "9.9.9.9"])
+        self.assertEqual(found["8.8.8.8"]["country"], "US")
+
+    def test_http_failures(self):
+        """HTTP failures are not cached, and retried after a delay."""
+        backend = geo.HttpBackend()
+        backend.queue.append("8.8.8.8")
+        with patch.object(geo, "urlopen", side_effect=IOError), \
+                patch.object(backend.condition, "wait",
+                             side_effect=StopIteration), \
+                self.assertRaises(StopIteration):
+            backend._run()
+        self.assertIsNone(backend.cache.get("8.8.8.8"))
+        with patch.object(backend, "_schedule") as schedule:
+            self.assertEqual(backend.lookup_many(["8.8.8.8"]), {})
+            schedule.assert_not_called()
+            backend.failures.set(
+                "8.8.8.8", time.time() - geo.HTTP_RETRY_DELAY)
+            backend.lookup_many(["8.8.8.8"])
+            schedule.assert_called_once_with("8.8.8.8")
+
+    def test_get(self):
+        """Local databases are loaded once per file version."""
+        self.assertIsNone(geo.get())
+        self.assertIsNone(geo.get("/nonexistent/geo.csv"))
+        backend = geo.get(CSV)
+        self.assertIsInstance(backend, geo.CsvRangeBackend)
+        self.assertIs(geo.get(CSV), backend)
+        self.assertIsInstance(geo.get(CSV, http=True), geo.ChainBackend)
+
+    def test_get_new_version(self):
+        """Newer versions of local databases replace older ones."""
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, "geo.csv")
+            shutil.copy(CSV, path)
+            remote = geo.get(http=True)
+            backend = geo.get(path)
+            os.utime(path, (1, 1))
+            self.assertIsNot(geo.get(path), backend)
+            self.assertIs(geo.get(path), geo._local_backends[path][1])
+            self.assertIs(geo.get(http=True), remote)
+        finally:
+            geo._local_backends.pop(path, None)
+            shutil.rmtree(folder)
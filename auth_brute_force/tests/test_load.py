@@ -0,0 +1,334 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+"""Latency and queries of logins, with the installed authentication addons.
+
+Skipped unless the ``AUTH_LOAD_LOGINS`` environment variable says how many
+logins to do per entry point, i.e.::
+
+    AUTH_LOAD_LOGINS=200 odoo -d test --test-enable -i auth_brute_force
+
+Each entry point is measured sequentially, to count queries per login, and
+then from ``AUTH_LOAD_THREADS`` threads at once (4 by default), each with
+its own connection, to measure latencies under contention. In test mode all
+requests share one cursor, so database work is serialized anyway; in-memory
+counters, bans and the journal are not.
+
+When ``web`` is installed, logins are also done posting a big field, to
+measure the memory allocated by the server while handling them and still
+allocated after them.
+
+The test fails if the last logins of an entry point cost more queries than
+the first ones, i.e. if queries grow with stored attempts. This needs no
+baseline, so it runs everywhere.
+
+Results are logged and compared with those in ``load_baseline.json`` for the
+same set of installed addons: the test fails if a login costs more queries
+than there, beyond :data:`QUERY_TOLERANCE`, while slower latencies and more
+retained memory are only logged, as they depend on the machine. It is
+skipped after logging results if there is no baseline for those addons. Set
+``AUTH_LOAD_BASELINE_OUTPUT`` to a file path to write that baseline updated
+with current results there instead, i.e. to review and copy it over
+``load_baseline.json``.
+"""
+
+import gc
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from functools import partial
+from xmlrpc.client import ServerProxy
+
+import requests
+from mock import patch
+from werkzeug.utils import redirect
+
+from odoo import http
+from odoo.tests.common import at_install, HOST, HttpCase, PORT, post_install
+from odoo.tools import mute_logger
+
+from .test_brute_force import GARBAGE_LOGGERS
+
+_logger = logging.getLogger(__name__)
+
+BASELINE = os.path.join(os.path.dirname(__file__), "load_baseline.json")
+# Addons whose overrides are measured, when installed
+ADDONS = (
+    "auth_brute_force",
+    "auth_saml",
+    "auth_session_timeout",
+    "auth_totp",
+    "password_security",
+)
+PERCENTILES = (50, 95, 99)
+# Latency or memory ratio over baseline that gets logged as a regression
+TOLERANCE = 1.5
+# Extra queries per login over baseline, or over the first logins, that fail
+QUERY_TOLERANCE = 1
+# Bytes of the field posted along logins when measuring memory
+UPLOAD_SIZE = 1 << 20
+# Stack frames kept by allocation, to tell those done by the server
+MEMORY_FRAMES = 64
+
+
+def median(values):
+    """Upper median of some values."""
+    return sorted(values)[len(values) // 2]
+
+
+def percentile(values, rank):
+    """Nearest-rank percentile of some sorted values."""
+    index = max(0, -(-len(values) * rank // 100) - 1)
+    return values[index]
+
+
+@at_install(False)
+@post_install(True)
+# Skip CSRF validation on tests
+@patch(http.__name__ + ".WebRequest.validate_csrf", return_value=True)
+# Skip specific browser forgery on redirections
+@patch(http.__name__ + ".redirect_with_hash", side_effect=redirect)
+class LoadCase(HttpCase):
+    def setUp(self):
+        super(LoadCase, self).setUp()
+        self.logins = int(os.environ.get("AUTH_LOAD_LOGINS") or 0)
+        if not self.logins:
+            self.skipTest("Set AUTH_LOAD_LOGINS to run load tests")
+        self.threads = int(os.environ.get("AUTH_LOAD_THREADS") or 4)
+        # Complex password to avoid conflicts with `password_security`
+        self.password = "Admin$%02584"
+        with self.cursor() as cr:
+            env = self.env(cr)
+            env.user.password = self.password
+            self.installed = sorted(env["ir.module.module"].search([
+                ("name", "in", ADDONS),
+                ("state", "=", "installed"),
+            ]).mapped("name"))
+
+    def tearDown(self):
+        self.env["res.authentication.attempt"]._invalidate_counters()
+        super(LoadCase, self).tearDown()
+
+    @staticmethod
+    def latencies(values):
+        """Percentiles of some latencies, in milliseconds."""
+        values = sorted(values)
+        return {
+            "p%d" % rank: round(percentile(values, rank) * 1000, 2)
+            for rank in PERCENTILES
+        }
+
+    def measure(self, client):
+        """Run some logins in a row, returning latency and queries stats.
+
+        :param client:
+            Function that returns a ``(login, prepare)`` pair of functions
+            sharing a new connection; ``prepare`` may be ``None``.
+        """
+        login, prepare = client()
+        latencies, queries = [], []
+        # All requests share this cursor in test mode
+        cr = self.registry.test_cr
+        for _n in range(self.logins):
+            if prepare:
+                prepare()
+            before = cr.sql_log_count
+            start = time.perf_counter()
+            login()
+            latencies.append(time.perf_counter() - start)
+            queries.append(cr.sql_log_count - before)
+        result = self.latencies(latencies)
+        result["queries"] = median(queries)
+        quarter = max(1, len(queries) // 4)
+        self.assertLessEqual(
+            median(queries[-quarter:]),
+            median(queries[:quarter]) + QUERY_TOLERANCE,
+            "Queries per login grow with stored attempts")
+        return result
+
+    def measure_concurrent(self, client):
+        """Run some logins from several threads at once.
+
+        Each thread does :attr:`logins` logins with its own connection.
+
+        :return dict:
+            Latency stats of all logins.
+        """
+        latencies, errors = [], []
+        start_all = threading.Barrier(self.threads)
+
+        def _run():
+            try:
+                login, prepare = client()
+                start_all.wait()
+                for _n in range(self.logins):
+                    if prepare:
+                        prepare()
+                    start = time.perf_counter()
+                    login()
+                    latencies.append(time.perf_counter() - start)
+            except Exception as error:
+                errors.append(error)
+                # Release threads waiting for this one to start
+                start_all.abort()
+
+        threads = [
+            threading.Thread(target=_run) for _n in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return self.latencies(latencies)
+
+    def measure_memory(self, client):
+        """Run some logins in a row, returning the memory they retained.
+
+        Only allocations done while the server handles requests are
+        counted, not those of the client in this thread.
+
+        :return dict:
+            KiB allocated by the server and still allocated after all
+            logins ended.
+        """
+        login, prepare = client()
+        gc.collect()
+        tracemalloc.start(MEMORY_FRAMES)
+        try:
+            for _n in range(self.logins):
+                if prepare:
+                    prepare()
+                login()
+            gc.collect()
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(
+            True, "*/odoo/service/wsgi_server.py", all_frames=True)])
+        retained = sum(
+            stat.size for stat in snapshot.statistics("filename"))
+        return {"retained_kb": round(retained / 1024, 2)}
+
+    @staticmethod
+    def url(path):
+        return "http://%s:%s%s" % (HOST, PORT, path)
+
+    def web_client(self, upload=0):
+        session = requests.Session()
+        data = {"login": "admin", "password": self.password}
+        if upload:
+            data["upload"] = "x" * upload
+
+        def _login():
+            response = session.post(
+                self.url("/web/login"), data, timeout=30)
+            assert response.url.endswith("/web"), response.url
+
+        def _logout():
+            session.get(self.url("/web/session/logout"), timeout=30)
+
+        return _login, _logout
+
+    def xmlrpc_client(self):
+        common = ServerProxy(self.url("/xmlrpc/2/common"))
+        dbname = self.env.cr.dbname
+
+        def _login():
+            assert common.authenticate(dbname, "admin", self.password, {})
+
+        return _login, None
+
+    def saml_client(self):
+        session = requests.Session()
+        relay = json.dumps({"d": self.env.cr.dbname})
+
+        def _login():
+            # Without an identity provider, this measures rejections only
+            session.post(self.url("/auth_saml/signin"), {
+                "SAMLResponse": "",
+                "RelayState": relay,
+            }, timeout=30)
+
+        return _login, None
+
+    def compare(self, results):
+        """Compare results with the baseline, or write an updated one."""
+        key = ",".join(self.installed)
+        with open(BASELINE) as baseline_file:
+            baseline = json.load(baseline_file)
+        output = os.environ.get("AUTH_LOAD_BASELINE_OUTPUT")
+        if output:
+            baseline[key] = results
+            with open(output, "w") as baseline_file:
+                json.dump(baseline, baseline_file, indent=4, sort_keys=True)
+                baseline_file.write("\n")
+            _logger.info("Load baseline for %s written to %s", key, output)
+            return
+        if key not in baseline:
+            self.skipTest(
+                "No load baseline for %s to compare with; record one with "
+                "AUTH_LOAD_BASELINE_OUTPUT" % key)
+        expected = baseline[key]
+        for name, result in sorted(results.items()):
+            if name not in expected:
+                _logger.warning("No load baseline for %s with %s", name, key)
+                continue
+            for rank in PERCENTILES:
+                field = "p%d" % rank
+                if field not in result or field not in expected[name]:
+                    continue
+                if result[field] > expected[name][field] * TOLERANCE:
+                    _logger.warning(
+                        "%s %s latency regressed: %.2f ms, baseline %.2f ms",
+                        name, field, result[field], expected[name][field])
+            if "retained_kb" in expected[name] and result["retained_kb"] > \
+                    expected[name]["retained_kb"] * TOLERANCE:
+                _logger.warning(
+                    "%s retained memory regressed: %.2f KiB, baseline "
+                    "%.2f KiB", name, result["retained_kb"],
+                    expected[name]["retained_kb"])
+            if "queries" in expected[name]:
+                self.assertLessEqual(
+                    result["queries"],
+                    expected[name]["queries"] + QUERY_TOLERANCE,
+                    "%s costs more queries than its baseline" % name)
+
+    @mute_logger(*GARBAGE_LOGGERS)
+    def test_load(self, *args):
+        """Measure logins through every entry point."""
+        scenarios = [("xmlrpc_authenticate", self.xmlrpc_client)]
+        with self.cursor() as cr:
+            env = self.env(cr)
+            installed = set(env["ir.module.module"].search([
+                ("name", "in", ["web", "auth_saml"]),
+                ("state", "=", "installed"),
+            ]).mapped("name"))
+        if "web" in installed:
+            scenarios.append(("web_login", self.web_client))
+        if "auth_saml" in installed:
+            scenarios.append(("saml_signin", self.saml_client))
+        results = {}
+        for name, client in scenarios:
+            results[name] = result = self.measure(client)
+            _logger.info(
+                "%s with %s: p50 %.2f ms, p95 %.2f ms, p99 %.2f ms, "
+                "%d queries per login",
+                name, ",".join(self.installed), result["p50"],
+                result["p95"], result["p99"], result["queries"])
+            concurrent = "%s_%d_threads" % (name, self.threads)
+            results[concurrent] = result = self.measure_concurrent(client)
+            _logger.info(
+                "%s with %s: p50 %.2f ms, p95 %.2f ms, p99 %.2f ms",
+                concurrent, ",".join(self.installed), result["p50"],
+                result["p95"], result["p99"])
+        if "web" in installed:
+            name = "web_login_upload_memory"
+            results[name] = result = self.measure_memory(
+                partial(self.web_client, UPLOAD_SIZE))
+            _logger.info(
+                "%s with %s: %.2f KiB retained after %d logins",
+                name, ",".join(self.installed), result["retained_kb"],
+                self.logins)
+        self.compare(results)
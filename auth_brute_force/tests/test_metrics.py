@@ -0,0 +1,83 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from mock import patch
+
+from odoo.tests.common import at_install, HttpCase, post_install
+from odoo.tests.common import TransactionCase
+from odoo.tools import config
+
+from .. import metrics
+
+
+class MetricsCase(TransactionCase):
+    def setUp(self):
+        super(MetricsCase, self).setUp()
+        metrics.reset()
+
+    def test_nested(self):
+        """Layers are measured without the layers they call."""
+        cr = self.env.cr
+        with metrics.measure("outer", cr):
+            cr.execute("SELECT 1")
+            with metrics.measure("inner", cr):
+                cr.execute("SELECT 1")
+                cr.execute("SELECT 1")
+        text = metrics.render()
+        labels = '{db="%s",layer="%%s"}' % cr.dbname
+        self.assertIn(
+            "odoo_auth_layer_calls_total%s 1\n" % labels % "outer", text)
+        self.assertIn(
+            "odoo_auth_layer_queries_total%s 1\n" % labels % "outer", text)
+        self.assertIn(
+            "odoo_auth_layer_queries_total%s 2\n" % labels % "inner", text)
+        self.assertIn("# TYPE odoo_auth_attempts_total counter\n", text)
+
+    def test_instrumented(self):
+        """Credentials checks of this addon are measured."""
+        self.env.user.password = "Admin$%02584"
+        self.env["res.users"].check_credentials("Admin$%02584")
+        self.assertIn('layer="auth_brute_force"', metrics.render())
+        # Other layers are measured only if they instrument themselves
+        self.assertNotIn('layer="base"', metrics.render())
+
+    def test_hook(self):
+        """Other auth addons measure themselves through a hook."""
+        users = self.env["res.users"]
+        cr = self.env.cr
+        with users._auth_measure("auth_totp"):
+            cr.execute("SELECT 1")
+            with metrics.measure("auth_brute_force", cr):
+                cr.execute("SELECT 1")
+        text = metrics.render()
+        labels = '{db="%s",layer="%%s"}' % cr.dbname
+        self.assertIn(
+            "odoo_auth_layer_queries_total%s 1\n" % labels % "auth_totp",
+            text)
+        self.assertIn(
+            "odoo_auth_layer_queries_total%s 1\n" % labels
+            % "auth_brute_force", text)
+
+
+@at_install(False)
+@post_install(True)
+class MetricsRouteCase(HttpCase):
+    def test_access(self):
+        """Metrics need a token or an allowed remote, even locally."""
+        url = "/auth_brute_force/metrics"
+        with patch.dict(config.options, {
+            "auth_brute_force_metrics_token": "s3cret",
+            "auth_brute_force_metrics_remotes": "",
+        }):
+            self.assertEqual(self.url_open(url).status_code, 404)
+            self.opener.headers["Authorization"] = "Bearer wrong"
+            self.assertEqual(self.url_open(url).status_code, 404)
+            self.opener.headers["Authorization"] = "Bearer s3cret"
+            response = self.url_open(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("odoo_auth_attempts_total", response.text)
+        del self.opener.headers["Authorization"]
+        with patch.dict(config.options, {
+            "auth_brute_force_metrics_token": "",
+            "auth_brute_force_metrics_remotes": "127.0.0.1",
+        }):
+            self.assertEqual(self.url_open(url).status_code, 200)
@@ -0,0 +1,52 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from mock import patch
+
+from odoo.tests.common import TransactionCase
+from odoo.tools import config
+
+from .. import remote
+
+
+class RemoteCase(TransactionCase):
+    def resolve(self, proxies=None, **environ):
+        options = {
+            "proxy_mode": proxies is not None,
+            "auth_brute_force_trusted_proxies": proxies,
+        }
+        with patch.dict(config.options, options):
+            return remote.resolve(environ)
+
+    def test_resolve(self):
+        """Remote is the last untrusted hop."""
+        environ = {
+            "REMOTE_ADDR": "10.0.0.2",
+            "HTTP_X_FORWARDED_FOR": "1.1.1.1, 2.2.2.2, 10.0.0.1",
+        }
+        self.assertEqual(self.resolve(**environ), "10.0.0.2")
+        # Without trusted proxies, rely on ProxyFix
+        self.assertEqual(self.resolve("", **environ), "10.0.0.2")
+        self.assertEqual(self.resolve("10.0.0.0/8", **environ), "2.2.2.2")
+        self.assertEqual(
+            self.resolve("10.0.0.0/8,2.2.2.2", **environ), "1.1.1.1")
+        # Spoofed headers from untrusted peers are ignored
+        self.assertEqual(
+            self.resolve("192.168.0.0/16", **environ), "10.0.0.2")
+        # ProxyFix replaced the peer address
+        environ["werkzeug.proxy_fix.orig_remote_addr"] = "10.0.0.3"
+        environ["REMOTE_ADDR"] = "10.0.0.1"
+        self.assertEqual(self.resolve("10.0.0.0/8", **environ), "2.2.2.2")
+
+    def test_wrap(self):
+        """Remote is known only while serving the request."""
+        seen = []
+
+        def application(environ, start_response):
+            seen.append(remote.get())
+            raise ValueError()
+
+        wrapped = remote.wrap(application)
+        with self.assertRaises(ValueError):
+            wrapped({"REMOTE_ADDR": "10.0.0.1"}, None)
+        self.assertEqual(seen, ["10.0.0.1"])
+        self.assertIsNone(remote.get())
@@ -0,0 +1,89 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from psycopg2 import IntegrityError
+
+from odoo.tests.common import TransactionCase
+from odoo.tools import mute_logger
+from odoo.tools.safe_eval import safe_eval
+
+
+class ReportCase(TransactionCase):
+    def setUp(self):
+        super(ReportCase, self).setUp()
+        self.Attempt = self.env["res.authentication.attempt"]
+        self.Report = self.env["res.authentication.attempt.report"]
+        self.Attempt.search([]).unlink()
+        self.Report._refresh(since="1970-01-01")
+
+    def tearDown(self):
+        self.Attempt._invalidate_counters()
+        super(ReportCase, self).tearDown()
+
+    def counts(self):
+        return {
+            (one.remote, one.login, one.result): one.count
+            for one in self.Report.search([])
+        }
+
+    def test_refresh(self):
+        """Attempts are rolled up incrementally."""
+        for result in ("failed", "failed", "banned"):
+            self.Attempt.create({
+                "login": "admin",
+                "remote": "10.0.0.1",
+                "result": result,
+            })
+        self.Report._cron_refresh()
+        self.assertEqual(self.counts(), {
+            ("10.0.0.1", "admin", "failed"): 2,
+            ("10.0.0.1", "admin", "banned"): 1,
+        })
+        # Hours rolled up already are computed again on next refresh
+        self.Attempt.create({
+            "login": "demo",
+            "remote": "10.0.0.1",
+            "result": "failed",
+        })
+        self.Report._cron_refresh()
+        self.assertEqual(len(self.counts()), 3)
+        self.assertEqual(
+            self.counts()[("10.0.0.1", "admin", "failed")], 2)
+        # Unbanning updates it right away
+        self.Attempt.search([("result", "=", "banned")]).action_unban()
+        self.assertEqual(self.counts(), {
+            ("10.0.0.1", "admin", "failed"): 2,
+            ("10.0.0.1", "admin", "unbanned"): 1,
+            ("10.0.0.1", "demo", "failed"): 1,
+        })
+
+    def test_network_markers(self):
+        """Markers of unbanned networks are not attempts to analyse."""
+        self.Attempt.create({
+            "login": "admin",
+            "remote": "10.0.0.1",
+            "result": "banned",
+        })
+        self.Attempt.bulk_unban(["10.0.0.0/24"])
+        self.Report._cron_refresh()
+        self.assertEqual(self.counts(), {
+            ("10.0.0.1", "admin", "unbanned"): 1,
+        })
+        action = self.env.ref(
+            "auth_brute_force.action_res_authentication_attempt")
+        domain = safe_eval(action.domain)
+        self.assertEqual(self.Attempt.search(domain).mapped("remote"),
+                         ["10.0.0.1"])
+
+    @mute_logger("odoo.sql_db")
+    def test_unique(self):
+        """Concurrent refreshes cannot store a group twice."""
+        self.Attempt.create({"remote": "10.0.0.1", "result": "failed"})
+        self.Report._cron_refresh()
+        self.assertTrue(self.Report._lock(wait=False))
+        with self.assertRaises(IntegrityError), self.env.cr.savepoint():
+            self.env.cr.execute(
+                """INSERT INTO res_authentication_attempt_report
+                   (hour, remote, login, result, count)
+                   SELECT hour, remote, login, result, count
+                   FROM res_authentication_attempt_report""")
+        self.assertEqual(self.counts(), {("10.0.0.1", False, "failed"): 1})
@@ -0,0 +1,59 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+"""Compiled whitelist of remotes.
+
+Whitelisted networks are merged into sorted, non-overlapping integer ranges
+per IP version, so checking an IP is a bisection, no matter how many
+networks are whitelisted.
+"""
+
+import bisect
+import ipaddress
+
+
+class WhitelistIndex(object):
+    """Set of IP networks that supports fast membership checks."""
+
+    def __init__(self, networks):
+        """Compile some networks.
+
+        :param iterable networks:
+            Networks, as strings in CIDR notation, or single IPs. Invalid
+            ones are ignored.
+        """
+        ranges = {4: [], 6: []}
+        for network in networks:
+            try:
+                network = ipaddress.ip_network(network)
+            except ValueError:
+                continue
+            ranges[network.version].append((
+                int(network.network_address),
+                int(network.broadcast_address),
+            ))
+        self.starts, self.ends = {}, {}
+        for version, version_ranges in ranges.items():
+            starts, ends = self.starts[version], self.ends[version] = [], []
+            for start, end in sorted(version_ranges):
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+
+    def __contains__(self, ip):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        number = int(address)
+        index = bisect.bisect_right(self.starts[address.version], number) - 1
+        return index >= 0 and self.ends[address.version][index] >= number
+
+    def __eq__(self, other):
+        return isinstance(other, WhitelistIndex) and (
+            (self.starts, self.ends) == (other.starts, other.ends))
+
+    __hash__ = None
+
+    def __len__(self):
+        return sum(len(starts) for starts in self.starts.values())
@@ -2,6 +2,8 @@
 # Copyright 2014-2018 'ACSONE SA/NV'
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl)
 
+from contextlib import ExitStack
+
 from odoo import fields, models
 from .. import utils
 
@@ -18,7 +20,10 @@ class Users(models.Model):
 
     def check_credentials(self, password):
         """Check credentials for SSO user"""
-        res = self.sudo().search([('id', '=', self._uid),
-                                  ('sso_key', '=', password)])
-        if not res:
-            return super(Users, self).check_credentials(password)
+        # Measured by auth_brute_force, if installed
+        measure = getattr(self, '_auth_measure', None)
+        with measure('auth_from_http_remote_user') if measure else ExitStack():
+            res = self.sudo().search([('id', '=', self._uid),
+                                      ('sso_key', '=', password)])
+            if not res:
+                return super(Users, self).check_credentials(password)
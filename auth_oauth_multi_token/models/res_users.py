@@ -2,6 +2,7 @@
 # Copyright 2017 Camptocamp
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl)
 import uuid
+from contextlib import ExitStack
 
 from odoo import api, fields, models, exceptions
 
@@ -72,16 +73,19 @@ class ResUsers(models.Model):
     @api.model
     def check_credentials(self, password):
         """Override to check credentials against multi tokens."""
-        try:
-            return super(ResUsers, self).check_credentials(password)
-        except exceptions.AccessDenied:
-            res = self.multi_token_model.sudo().search([
-                ('user_id', '=', self.env.uid),
-                ('oauth_access_token', '=', password),
-                ('active_token', '=', True),
-            ])
-            if not res:
-                raise
+        # Measured by auth_brute_force, if installed
+        measure = getattr(self, '_auth_measure', None)
+        with measure('auth_oauth_multi_token') if measure else ExitStack():
+            try:
+                return super(ResUsers, self).check_credentials(password)
+            except exceptions.AccessDenied:
+                res = self.multi_token_model.sudo().search([
+                    ('user_id', '=', self.env.uid),
+                    ('oauth_access_token', '=', password),
+                    ('active_token', '=', True),
+                ])
+                if not res:
+                    raise
 
     def _get_session_token_fields(self):
         res = super(ResUsers, self)._get_session_token_fields()
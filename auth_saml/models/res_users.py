@@ -3,6 +3,7 @@
 
 import logging
 import passlib
+from contextlib import ExitStack
 
 from odoo import api, fields, models, _, SUPERUSER_ID
 from odoo.exceptions import ValidationError, AccessDenied
@@ -201,23 +202,25 @@ class ResUser(models.Model):
         but we are more interested in the case when they are tokens
         and the interesting code is inside the "except" clause.
         """
-
-        try:
-            # Attempt a regular login (via other auth addons) first.
-            super(ResUser, self).check_credentials(token)
-
-        except (AccessDenied, passlib.exc.PasswordSizeError):
-            # since normal auth did not succeed we now try to find if the user
-            # has an active token attached to his uid
-            res = self.env['auth_saml.token'].sudo().search(
-                [('user_id', '=', self.env.user.id),
-                 ('saml_access_token', '=', token)])
-
-            # if the user is not found we re-raise the AccessDenied
-            if not res:
-                # TODO: maybe raise a defined exception instead of the last
-                # exception that occurred in our execution frame
-                raise
+        # Measured by auth_brute_force, if installed
+        measure = getattr(self, '_auth_measure', None)
+        with measure('auth_saml') if measure else ExitStack():
+            try:
+                # Attempt a regular login (via other auth addons) first.
+                super(ResUser, self).check_credentials(token)
+
+            except (AccessDenied, passlib.exc.PasswordSizeError):
+                # since normal auth did not succeed we now try to find if the
+                # user has an active token attached to his uid
+                res = self.env['auth_saml.token'].sudo().search(
+                    [('user_id', '=', self.env.user.id),
+                     ('saml_access_token', '=', token)])
+
+                # if the user is not found we re-raise the AccessDenied
+                if not res:
+                    # TODO: maybe raise a defined exception instead of the last
+                    # exception that occurred in our execution frame
+                    raise
 
     @api.multi
     def write(self, vals):
@@ -2,6 +2,7 @@
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
 
 from collections import defaultdict
+from contextlib import ExitStack
 from uuid import uuid4
 from odoo import _, api, fields, models
 from odoo.exceptions import ValidationError
@@ -76,27 +77,32 @@ class ResUsers(models.Model):
               prevent auth while updating session to indicate that MFA login
               process can now commence.
         """
-        if not self.env.user.mfa_enabled:
-            return super(ResUsers, self).check_credentials(password)
-
-        self._mfa_uid_cache[self.env.cr.dbname].add(self.env.uid)
-
-        if request:
-            if request.session.get('mfa_login_active') == self.env.uid:
+        # Measured by auth_brute_force, if installed
+        measure = getattr(self, '_auth_measure', None)
+        with measure('auth_totp') if measure else ExitStack():
+            if not self.env.user.mfa_enabled:
                 return super(ResUsers, self).check_credentials(password)
 
-            cookie_key = 'trusted_devices_%d' % self.env.uid
-            device_cook = request.httprequest.cookies.get(cookie_key)
-            if device_cook:
-                secret = self.env.user.trusted_device_cookie_key
-                device_cook = JsonSecureCookie.unserialize(device_cook, secret)
-                if device_cook:
+            self._mfa_uid_cache[self.env.cr.dbname].add(self.env.uid)
+
+            if request:
+                if request.session.get('mfa_login_active') == self.env.uid:
                     return super(ResUsers, self).check_credentials(password)
 
-        super(ResUsers, self).check_credentials(password)
-        if request:
-            request.session['mfa_login_needed'] = True
-        raise MfaLoginNeeded
+                cookie_key = 'trusted_devices_%d' % self.env.uid
+                device_cook = request.httprequest.cookies.get(cookie_key)
+                if device_cook:
+                    secret = self.env.user.trusted_device_cookie_key
+                    device_cook = JsonSecureCookie.unserialize(
+                        device_cook, secret)
+                    if device_cook:
+                        return super(ResUsers, self).check_credentials(
+                            password)
+
+            super(ResUsers, self).check_credentials(password)
+            if request:
+                request.session['mfa_login_needed'] = True
+            raise MfaLoginNeeded
 
     @api.multi
     def validate_mfa_confirmation_code(self, confirmation_code):
@@ -3,7 +3,7 @@
 {
     "name": "Keychain",
     "summary": "Store accounts and credentials",
-    "version": "11.0.3.0.0",
+    "version": "11.0.3.2.0",
     "category": "Uncategorized",
     "website": "https://akretion.com/",
     "author": "Akretion, Odoo Community Association (OCA)",
@@ -21,6 +21,7 @@
     ],
     "data": [
         "security/ir.model.access.csv",
+        "data/ir_cron.xml",
         'views/keychain_view.xml'
     ],
 }
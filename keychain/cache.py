@@ -0,0 +1,218 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Caches of decrypted passwords and parsed data.
+
+Parsed data is always cached, see :class:`DataCache`.
+
+The cache of decrypted passwords is disabled unless a TTL is set in Odoo's
+config file, for all namespaces or for one of them::
+
+    keychain_cache_ttl = 60
+    keychain_cache_size = 128
+    keychain_cache_ttl_roulier_laposte = 300
+    keychain_cache_size_roulier_laposte = 16
+
+Secrets are kept as ``bytearray`` and overwritten with zeros when evicted.
+This is best effort: strings returned to callers are out of reach.
+"""
+
+import importlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from types import MappingProxyType
+
+from odoo.tools.config import config
+
+_logger = logging.getLogger(__name__)
+
+# Default amount of secrets kept per namespace
+SIZE = 128
+# Amount of parsed data kept
+DATA_SIZE = 1024
+
+
+class SecretCache(object):
+    """Thread-safe LRU mapping whose entries expire."""
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _wipe(secret):
+        for index in range(len(secret)):
+            secret[index] = 0
+
+    def _evict(self, key):
+        """Remove an entry. Must be called with :attr:`lock` held."""
+        self._wipe(self.data.pop(key)[1])
+
+    def get(self, key):
+        """Get a secret, or ``None`` if unknown or expired."""
+        with self.lock:
+            try:
+                expires, secret = self.data[key]
+            except KeyError:
+                return None
+            if expires < time.monotonic():
+                self._evict(key)
+                return None
+            self.data.move_to_end(key)
+            return secret.decode('utf-8')
+
+    def set(self, key, value):
+        """Remember a secret for :attr:`ttl` seconds."""
+        with self.lock:
+            if key in self.data:
+                self._evict(key)
+            self.data[key] = (
+                time.monotonic() + self.ttl,
+                bytearray(value.encode('utf-8')),
+            )
+            while len(self.data) > self.size:
+                self._evict(next(iter(self.data)))
+
+    def invalidate(self, match):
+        """Forget secrets whose key matches a predicate."""
+        with self.lock:
+            for key in [key for key in self.data if match(key)]:
+                self._evict(key)
+
+    def clear(self):
+        """Forget all secrets."""
+        self.invalidate(lambda key: True)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def _option(name, namespace, default):
+    value = config.get('%s_%s' % (name, namespace))
+    if value in (None, False, ''):
+        value = config.get(name)
+    if value in (None, False, ''):
+        return default
+    return type(default)(value)
+
+
+def get(namespace):
+    """Get the cache of a namespace, or ``None`` if disabled."""
+    ttl = _option('keychain_cache_ttl', namespace, 0.0)
+    size = _option('keychain_cache_size', namespace, SIZE)
+    if ttl <= 0 or size <= 0:
+        return None
+    with _caches_lock:
+        cache = _caches.get(namespace)
+        if cache is None or (cache.ttl, cache.size) != (ttl, size):
+            if cache is not None:
+                cache.clear()
+            cache = _caches[namespace] = SecretCache(ttl, size)
+        return cache
+
+
+def invalidate(dbname, ids):
+    """Forget secrets of some accounts, in all namespaces."""
+    ids = set(ids)
+    with _caches_lock:
+        caches = list(_caches.values())
+    for cache in caches:
+        cache.invalidate(lambda key: key[1] == dbname and key[2] in ids)
+
+
+def clear():
+    """Forget all secrets."""
+    with _caches_lock:
+        caches = list(_caches.values())
+    for cache in caches:
+        cache.clear()
+
+
+def freeze(value):
+    """Make parsed JSON immutable: objects become read-only mappings and
+    arrays become tuples."""
+    if isinstance(value, dict):
+        return MappingProxyType({
+            key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    """Get a mutable copy of a :func:`freeze` result."""
+    if isinstance(value, MappingProxyType):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+_loads = {}
+
+
+def json_loads():
+    """Get the JSON parsing function.
+
+    Set the ``keychain_json_backend`` config option to the name of a module
+    with a compatible ``loads()`` function, such as ``ujson`` or
+    ``orjson``, to use it instead of the standard library.
+    """
+    name = config.get('keychain_json_backend') or 'json'
+    try:
+        return _loads[name]
+    except KeyError:
+        try:
+            loads = importlib.import_module(name).loads
+        except (ImportError, AttributeError):
+            _logger.warning("Cannot use %s to parse JSON", name)
+            loads = json.loads
+        _loads[name] = loads
+        return loads
+
+
+class DataCache(object):
+    """Parsed data of accounts, frozen, by database and account id.
+
+    Entries remember the raw data they were parsed from, and are used only
+    while it matches.
+    """
+
+    def __init__(self, size=DATA_SIZE):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, raw):
+        with self.lock:
+            try:
+                cached = self.data[key]
+            except KeyError:
+                return None
+            if cached[0] != raw:
+                return None
+            self.data.move_to_end(key)
+            return cached[1]
+
+    def set(self, key, raw, parsed):
+        with self.lock:
+            self.data[key] = (raw, parsed)
+            self.data.move_to_end(key)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def invalidate(self, dbname, ids):
+        with self.lock:
+            for account_id in ids:
+                self.data.pop((dbname, account_id), None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+data_cache = DataCache()
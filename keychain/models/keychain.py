@@ -1,15 +1,24 @@
 # © 2016 Akretion Mourad EL HADJ MIMOUNE, David BEAL, Raphaël REVERDY
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
-from functools import wraps
+from functools import partial, wraps
 
+import hashlib
 import logging
 import json
+import threading
+import time
+import uuid
+
+from psycopg2.extras import execute_values
 
 from odoo import models, fields, api
 from odoo.exceptions import ValidationError
 from odoo.tools.config import config
 from odoo.tools.translate import _
 
+from .. import cache as secret_cache
+from .. import stores
+
 _logger = logging.getLogger(__name__)
 
 try:
@@ -17,6 +26,12 @@ try:
 except ImportError as err:
     _logger.debug(err)
 
+# Ciphers by environments and fingerprint of their keys
+_ciphers = {}
+_ciphers_lock = threading.Lock()
+# Ciphers kept at once; more only happens when keys change often
+CIPHERS_SIZE = 32
+
 
 def implemented_by_keychain(func):
     """Call a prefixed function based on 'namespace'."""
@@ -63,36 +78,235 @@ class KeychainAccount(models.Model):
 
     def _get_password(self):
         """Password in clear text."""
-        try:
-            return self._decode_password(self.password)
-        except Warning as warn:
-            raise Warning(_(
-                "%s \n"
-                "Account: %s %s %s " % (
-                    warn,
-                    self.login, self.name, self.technical_name
-                )
-            ))
+        return self.get_passwords()[self.id]
+
+    @api.multi
+    def get_passwords(self):
+        """Passwords in clear text, decrypted at once.
+
+        Decrypted passwords are cached shortly if enabled, see
+        :mod:`odoo.addons.keychain.cache`.
+
+        :return dict:
+            Password of each account, by id.
+        """
+        result = {}
+        if not self:
+            return result
+        cipher = self._get_cipher()
+        dbname = self.env.cr.dbname
+        for account in self:
+            cache = account.id and secret_cache.get(account.namespace)
+            if cache:
+                # Write dates have one second resolution, tokens change
+                key = (cipher, dbname, account.id, hashlib.sha256(
+                    (account.password or '').encode()).digest())
+                password = cache.get(key)
+                if password is not None:
+                    result[account.id] = password
+                    continue
+            try:
+                result[account.id] = self._decode_password(
+                    account._get_token(), cipher)
+            except Warning as warn:
+                raise Warning(_(
+                    "%s \n"
+                    "Account: %s %s %s " % (
+                        warn,
+                        account.login, account.name, account.technical_name
+                    )
+                ))
+            if cache:
+                cache.set(key, result[account.id])
+        return result
 
     def get_data(self):
-        """Data in dict form."""
-        return self._parse_data(self.data)
+        """Data in dict form.
+
+        It is parsed once per version of the account, and shared: you get
+        a read-only mapping, whose lists are tuples, which ``json.dumps()``
+        does not accept. Use :meth:`get_mutable_data` to get a copy you can
+        modify or serialize.
+        """
+        if not self.id:
+            return secret_cache.freeze(self._parse_data(self.data))
+        key = (self.env.cr.dbname, self.id)
+        parsed = secret_cache.data_cache.get(key, self.data)
+        if parsed is None:
+            parsed = secret_cache.freeze(self._parse_data(self.data))
+            secret_cache.data_cache.set(key, self.data, parsed)
+        return parsed
+
+    def get_mutable_data(self):
+        """Data in dict form, as a copy made of dicts and lists."""
+        return secret_cache.thaw(self.get_data())
+
+    @api.multi
+    def get_data_many(self):
+        """Data of several accounts.
+
+        :return dict:
+            Data of each account, as returned by :meth:`get_data`, by id.
+        """
+        return {account.id: account.get_data() for account in self}
 
     @api.constrains('data')
     def _check_data(self):
         """Ensure valid input in data field."""
         for account in self:
             if account.data:
-                parsed = account._parse_data(account.data)
+                parsed = account.get_data()
                 if not account._validate_data(parsed):
                     raise ValidationError(_("Data not valid"))
 
     def _inverse_set_password(self):
         """Encode password from clear text."""
         # inverse function
+        store = stores.get()
         for rec in self:
-            rec.password = rec._encode_password(
+            token = rec._encode_password(
                 rec.clear_password, rec.environment)
+            if store:
+                old = rec.password or ''
+                rec.password = stores.PREFIX + self._stage_tokens(
+                    store, [token.decode()])[0]
+                if old.startswith(stores.PREFIX):
+                    self._discard_refs(store, [old[len(stores.PREFIX):]])
+            else:
+                rec.password = token
+        secret_cache.invalidate(self.env.cr.dbname, self.ids)
+
+    @api.model
+    def _store_owner(self):
+        """Prefix of the store references created by this database.
+
+        Duplicated databases get a new ``database.uuid``, so they never
+        delete the tokens of the database they were copied from.
+        """
+        return self.env['ir.config_parameter'].sudo().get_param(
+            'database.uuid')
+
+    @api.model
+    def _stage_tokens(self, store, tokens):
+        """Put tokens in the store at once, under new references.
+
+        Each version of a password gets its own reference, so the one in
+        use is never overwritten before the transaction commits. The new
+        references are removed if the transaction rolls back.
+
+        :return list:
+            References of the tokens, in the same order.
+        """
+        owner = self._store_owner()
+        refs = ['%s/%s' % (owner, uuid.uuid4().hex) for token in tokens]
+        if refs:
+            store.put_many(dict(zip(refs, tokens)))
+            self.env.cr.after('rollback', partial(stores.delete, store, refs))
+        return refs
+
+    @api.model
+    def _discard_refs(self, store, refs):
+        """Remove tokens from the store once the transaction commits.
+
+        Tokens created by other databases are left alone.
+        """
+        prefix = self._store_owner() + '/'
+        refs = [ref for ref in refs if ref.startswith(prefix)]
+        if refs:
+            self.env.cr.after('commit', partial(stores.delete, store, refs))
+
+    def _get_token(self):
+        """Encrypted password, from the database or the store."""
+        password = self.password or ''
+        if not password.startswith(stores.PREFIX):
+            return password
+        store = stores.get()
+        if store is None:
+            raise Warning(_(
+                "Password is kept in an external store, but no "
+                "'keychain_store' is set in config file."
+            ))
+        token = store.get(password[len(stores.PREFIX):])
+        if token is None:
+            raise Warning(_("Password is missing from the external store."))
+        return token
+
+    @api.model
+    def _move_to_store(self, chunk_size=1000):
+        """Move encrypted passwords from the database to the store.
+
+        Afterwards, the ``password`` column only holds references. Rows of
+        a chunk are locked before their tokens are staged, so a password
+        changed meanwhile is neither lost nor left behind in the store.
+
+        :return int:
+            Amount of passwords moved.
+        """
+        store = stores.get()
+        if store is None:
+            raise Warning(_("No 'keychain_store' is set in config file."))
+        testing = getattr(threading.current_thread(), 'testing', False)
+        done = 0
+        while True:
+            self.env.cr.execute(
+                """SELECT id, password FROM keychain_account
+                   WHERE password IS NOT NULL AND password NOT LIKE %s
+                   ORDER BY id LIMIT %s FOR UPDATE""",
+                (stores.PREFIX + '%', chunk_size))
+            rows = self.env.cr.fetchall()
+            if not rows:
+                break
+            refs = self._stage_tokens(
+                store, [password for _account_id, password in rows])
+            values = [
+                (account_id, stores.PREFIX + ref)
+                for (account_id, _password), ref in zip(rows, refs)
+            ]
+            execute_values(
+                self.env.cr,
+                """UPDATE keychain_account SET password = new.password
+                   FROM (VALUES %s) AS new (id, password)
+                   WHERE keychain_account.id = new.id""",
+                values,
+            )
+            done += len(rows)
+            if not testing:
+                self.env.cr.commit()
+            _logger.info("Moved %d keychain passwords to the store", done)
+        self.invalidate_cache(['password'])
+        return done
+
+    @api.model_cr
+    def init(self):
+        """Index lookups by technical name, and make it unique per env.
+
+        Also create the table where key rotations save their progress.
+        Parameters would clear caches of all workers on each chunk.
+        """
+        self.env.cr.execute(
+            """CREATE TABLE IF NOT EXISTS keychain_rotation_progress (
+                   last_id integer NOT NULL)""")
+        indexes = (
+            ("keychain_account_namespace_technical_name_env_idx", "",
+             "(namespace, technical_name, environment)"),
+            ("keychain_account_technical_name_env_uniq", "UNIQUE",
+             "(technical_name, COALESCE(environment, ''))"),
+        )
+        for name, kind, columns in indexes:
+            self.env.cr.execute(
+                "SELECT 1 FROM pg_indexes WHERE indexname = %s", (name,))
+            if self.env.cr.fetchone():
+                continue
+            try:
+                with self.env.cr.savepoint():
+                    self.env.cr.execute(
+                        "CREATE {} INDEX {} ON keychain_account {}".format(
+                            kind, name, columns))
+            except Exception:
+                _logger.warning(
+                    "Cannot create index %s; fix duplicated technical "
+                    "names per environment and update this module",
+                    name, exc_info=True)
 
     @api.model
     def retrieve(self, domain):
@@ -103,16 +317,81 @@ class KeychainAccount(models.Model):
         Use user.has_group() and suspend_security() before
         calling this method.
         """
+        found = self._retrieve_by_technical_name(domain)
+        if found is not None:
+            return found
         domain.append(['environment', 'in', self._retrieve_env()])
         return self.search(domain)
 
+    @api.model
+    def _retrieve_by_technical_name(self, domain):
+        """Fast path of :meth:`retrieve` for lookups by technical name.
+
+        Domains made only of ``=`` or ``in`` conditions on
+        ``technical_name`` and ``namespace`` are answered with one indexed
+        query, without building a generic search.
+
+        :return:
+            Accounts found, or ``None`` if the domain is not supported.
+        """
+        values = {}
+        for leaf in domain:
+            if not isinstance(leaf, (list, tuple)) or len(leaf) != 3:
+                return None
+            field, operator, value = leaf
+            if field not in ('technical_name', 'namespace') or \
+                    field in values:
+                return None
+            if operator == '=' and isinstance(value, str):
+                values[field] = (value,)
+            elif operator == 'in' and isinstance(value, (list, tuple)) \
+                    and all(isinstance(one, str) for one in value):
+                values[field] = tuple(value) or (None,)
+            else:
+                return None
+        if 'technical_name' not in values:
+            return None
+        self.check_access_rights('read')
+        # Same as ['environment', 'in', envs]: False stands for no env
+        envs = self._retrieve_env()
+        environment = "environment IN %(envs)s"
+        if False in envs:
+            environment = "(environment IS NULL OR {})".format(environment)
+        envs = [env for env in envs if env is not False]
+        query = """SELECT id FROM keychain_account
+                   WHERE technical_name IN %(technical_name)s
+                     AND {}""".format(environment)
+        if 'namespace' in values:
+            query += " AND namespace IN %(namespace)s"
+        query += " ORDER BY {}".format(self._order)
+        self.env.cr.execute(
+            query, dict(values, envs=tuple(envs) or (None,)))
+        ids = [row[0] for row in self.env.cr.fetchall()]
+        return self.browse(ids)._filter_access_rules('read')
+
     @api.multi
     def write(self, vals):
         """At this time there is no namespace set."""
         if not vals.get('data') and not self.data:
             vals['data'] = self._serialize_data(self._init_data())
+        secret_cache.invalidate(self.env.cr.dbname, self.ids)
+        secret_cache.data_cache.invalidate(self.env.cr.dbname, self.ids)
         return super(KeychainAccount, self).write(vals)
 
+    @api.multi
+    def unlink(self):
+        """Remove passwords from the store too."""
+        refs = [
+            account.password[len(stores.PREFIX):] for account in self
+            if (account.password or '').startswith(stores.PREFIX)
+        ]
+        secret_cache.invalidate(self.env.cr.dbname, self.ids)
+        result = super(KeychainAccount, self).unlink()
+        store = refs and stores.get()
+        if store:
+            self._discard_refs(store, refs)
+        return result
+
     @implemented_by_keychain
     def _validate_data(self, data):
         pass
@@ -145,7 +424,7 @@ class KeychainAccount(models.Model):
     @staticmethod
     def _parse_data(data):
         try:
-            return json.loads(data)
+            return secret_cache.json_loads()(data)
         except ValueError:
             raise ValidationError(_("Data should be a valid JSON"))
 
@@ -155,8 +434,9 @@ class KeychainAccount(models.Model):
         return cipher.encrypt((data or '').encode())
 
     @classmethod
-    def _decode_password(cls, data):
-        cipher = cls._get_cipher()
+    def _decode_password(cls, data, cipher=None):
+        if cipher is None:
+            cipher = cls._get_cipher()
         try:
             return str(cipher.decrypt(data.encode()), 'UTF-8')
         except InvalidToken:
@@ -172,6 +452,10 @@ class KeychainAccount(models.Model):
 
         force_env = name of the env key.
         Useful for encoding against one precise env
+
+        Ciphers are built once per process for each set of environments
+        and keys. Keys are read from config on each call, so a cipher is
+        built again as soon as config is reloaded with other keys.
         """
         def _get_keys(envs):
             suffixes = [
@@ -183,10 +467,17 @@ class KeychainAccount(models.Model):
             keys_str = [
                 config.get(key)
                 for key in keys_name]  # fetch from config
-            return [
-                Fernet(key) for key in keys_str  # build Fernet object
+            keys_str = [
+                key.decode() if isinstance(key, bytes) else key
+                for key in keys_str
                 if key and len(key) > 0  # remove False values
             ]
+            return [
+                key.strip()
+                for key_str in keys_str
+                for key in key_str.split(',')  # new key first, old ones
+                if key.strip()
+            ]
 
         if force_env:
             envs = [force_env]
@@ -198,4 +489,174 @@ class KeychainAccount(models.Model):
                 "No 'keychain_key_%s' entries found in config file. "
                 "Use a key similar to: %s" % (envs[0], Fernet.generate_key())
             ))
-        return MultiFernet(keys)
+        fingerprint = hashlib.sha256(
+            ",".join(keys).encode()).digest()
+        cache_key = (tuple(envs), fingerprint)
+        cipher = _ciphers.get(cache_key)
+        if cipher is None:
+            cipher = MultiFernet([Fernet(key) for key in keys])
+            with _ciphers_lock:
+                if len(_ciphers) >= CIPHERS_SIZE:
+                    _ciphers.clear()
+                _ciphers[cache_key] = cipher
+        return cipher
+
+    @api.model
+    def _rotate_keys(self, chunk_size=1000, restart=False):
+        """Encrypt all passwords again with the first key of their env.
+
+        Accounts are processed by chunks in id order, committing after each
+        one, so rows are locked briefly. Rows of a chunk are locked while
+        they are encrypted, so passwords changed meanwhile are not
+        overwritten. Progress is saved, so an interrupted rotation resumes
+        where it stopped.
+
+        :param int chunk_size:
+            Accounts encrypted per transaction.
+
+        :param bool restart:
+            Ignore saved progress and start from the first account.
+
+        :return int:
+            Amount of passwords encrypted again.
+        """
+        testing = getattr(threading.current_thread(), 'testing', False)
+        last_id = 0 if restart else self._rotation_progress()
+        self.env.cr.execute(
+            """SELECT COUNT(*) FROM keychain_account
+               WHERE id > %s AND password IS NOT NULL""", (last_id,))
+        total, done, start = self.env.cr.fetchone()[0], 0, time.time()
+        ciphers = {}
+        while True:
+            self.env.cr.execute(
+                """SELECT id, environment, password FROM keychain_account
+                   WHERE id > %s AND password IS NOT NULL
+                   ORDER BY id LIMIT %s FOR UPDATE""", (last_id, chunk_size))
+            rows = self.env.cr.fetchall()
+            if not rows:
+                break
+            values, stored = [], []
+            for account_id, environment, password in rows:
+                try:
+                    if environment not in ciphers:
+                        # Same cipher used to encrypt it
+                        ciphers[environment] = self._get_cipher(environment)
+                    if password.startswith(stores.PREFIX):
+                        # Written to the store at once, below
+                        stored.append(
+                            (account_id, ciphers[environment], password))
+                        continue
+                    values.append((account_id, self._rotate_password(
+                        ciphers[environment], password)))
+                except Warning as warn:
+                    # Keep rotating others; this one needs a manual fix
+                    _logger.warning(
+                        "Cannot rotate key of keychain account %d: %s",
+                        account_id, warn)
+            if stored:
+                values += self._rotate_stored(stored)
+            if values:
+                execute_values(
+                    self.env.cr,
+                    """UPDATE keychain_account SET password = new.password
+                       FROM (VALUES %s) AS new (id, password)
+                       WHERE keychain_account.id = new.id""",
+                    values,
+                )
+            last_id, done = rows[-1][0], done + len(values)
+            self._save_rotation_progress(last_id)
+            if not testing:
+                self.env.cr.commit()
+            _logger.info(
+                "Rotated keys of %d/%d keychain accounts (%.0f/s)",
+                done, total, done / max(time.time() - start, 0.001))
+        self._save_rotation_progress(None)
+        self.invalidate_cache(['password'])
+        return done
+
+    @api.model
+    def _rotation_progress(self):
+        """Get the last account rotated by an interrupted rotation, or 0."""
+        self.env.cr.execute("SELECT last_id FROM keychain_rotation_progress")
+        row = self.env.cr.fetchone()
+        return row[0] if row else 0
+
+    @api.model
+    def _save_rotation_progress(self, last_id):
+        """Save the last account rotated, or ``None`` once done."""
+        self.env.cr.execute("DELETE FROM keychain_rotation_progress")
+        if last_id is not None:
+            self.env.cr.execute(
+                "INSERT INTO keychain_rotation_progress VALUES (%s)",
+                (last_id,))
+
+    @classmethod
+    def _rotate_password(cls, cipher, password):
+        """Encrypt a password again with the first key of a cipher."""
+        token = password.encode()
+        try:
+            if hasattr(cipher, 'rotate'):
+                token = cipher.rotate(token)
+            else:
+                # cryptography < 2.2
+                token = cipher.encrypt(cipher.decrypt(token))
+        except InvalidToken:
+            raise Warning(_(
+                "Password has been encrypted with a different "
+                "key. Unless you can recover the previous key, "
+                "this password is unreadable."
+            ))
+        return token.decode()
+
+    @api.model
+    def _rotate_stored(self, passwords):
+        """Encrypt passwords kept in the store again, as new versions.
+
+        New versions are written to the store at once.
+
+        :param list passwords:
+            ``(account id, cipher, password column)`` of each account.
+
+        :return list:
+            ``(account id, new password column)`` of each account rotated.
+            Those whose token is missing from the store, or cannot be
+            decrypted, are left alone.
+        """
+        store = stores.get()
+        if store is None:
+            _logger.warning(
+                "Cannot rotate keys of %d keychain accounts: no "
+                "'keychain_store' is set in config file.", len(passwords))
+            return []
+        rotated, refs = [], []
+        for account_id, cipher, password in passwords:
+            ref = password[len(stores.PREFIX):]
+            token = store.get(ref)
+            if token is None:
+                continue
+            try:
+                rotated.append(
+                    (account_id, self._rotate_password(cipher, token)))
+            except Warning as warn:
+                _logger.warning(
+                    "Cannot rotate key of keychain account %d: %s",
+                    account_id, warn)
+                continue
+            refs.append(ref)
+        new_refs = self._stage_tokens(
+            store, [token for _account_id, token in rotated])
+        self._discard_refs(store, refs)
+        return [
+            (account_id, stores.PREFIX + ref)
+            for (account_id, _token), ref in zip(rotated, new_refs)
+        ]
+
+    @classmethod
+    def clear_caches(cls):
+        """Forget ciphers, decrypted passwords and stores too."""
+        with _ciphers_lock:
+            _ciphers.clear()
+        secret_cache.clear()
+        stores.clear()
+        secret_cache.data_cache.clear()
+        return super(KeychainAccount, cls).clear_caches()
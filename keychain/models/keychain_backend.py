@@ -4,14 +4,17 @@
 from odoo import api, fields, models
 from odoo.tools.config import config
 
+from ..cache import thaw
+
 
 class KeychainBackend(models.AbstractModel):
     _name = 'keychain.backend'
     _backend_name = None
 
     name = fields.Char(required=True)
+    # Both fields are computed together, from one search of accounts
     password = fields.Char(
-        compute="_compute_password",
+        compute="_compute_keychain",
         inverse="_inverse_password",
         required=True)
     data = fields.Serialized(
@@ -32,6 +35,28 @@ class KeychainBackend(models.AbstractModel):
             ('technical_name', '=', self._get_technical_name())
         ])
 
+    @api.multi
+    def _get_existing_keychains(self):
+        """Get accounts of several backends with one search.
+
+        :return dict:
+            Account of each backend, by technical name. If several
+            environments match, the current one wins over blank.
+        """
+        names = [record._get_technical_name() for record in self]
+        if not names:
+            return {}
+        accounts = self.env['keychain.account'].retrieve([
+            ('namespace', '=', self._backend_name),
+            ('technical_name', 'in', names)
+        ])
+        envs = self.env['keychain.account']._retrieve_env()
+        result = {}
+        for account in accounts.sorted(
+                lambda one: -envs.index(one.environment or False)):
+            result[account.technical_name] = account
+        return result
+
     @api.multi
     def _prepare_keychain(self):
         self.ensure_one()
@@ -61,12 +86,7 @@ class KeychainBackend(models.AbstractModel):
 
     @api.multi
     def _compute_password(self):
-        for record in self:
-            account = record._get_existing_keychain()
-            if account and account.password:
-                record.password = "******"
-            else:
-                record.password = ""
+        self._compute_keychain()
 
     @api.multi
     def _inverse_keychain(self):
@@ -76,9 +96,14 @@ class KeychainBackend(models.AbstractModel):
 
     @api.multi
     def _compute_keychain(self):
+        accounts = self._get_existing_keychains()
+        data = self.env['keychain.account'].browse(
+            [account.id for account in accounts.values()]
+        ).filtered('data').get_data_many()
         for record in self:
-            account = record._get_existing_keychain()
-            if account:
-                record.data = account.get_data()
+            account = accounts.get(record._get_technical_name())
+            if account and account.password:
+                record.password = "******"
             else:
-                record.data = {}
+                record.password = ""
+            record.data = thaw(account and data.get(account.id) or {})
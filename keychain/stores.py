@@ -0,0 +1,256 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Stores for encrypted passwords, outside the database.
+
+By default, encrypted passwords are kept in the ``password`` column. Set the
+``keychain_store`` option in Odoo's config file to keep them elsewhere:
+
+``file``
+    A local vault file, at ``keychain_store_path``.
+
+``vault``
+    A HashiCorp Vault compatible KV version 2 HTTP API, at
+    ``keychain_store_url`` (e.g. ``https://vault:8200``), using the
+    ``keychain_store_token`` token and the ``keychain_store_mount`` secrets
+    engine (``secret`` by default). Secrets read are cached for the lease
+    duration returned by the server, or ``keychain_store_ttl`` seconds (60
+    by default).
+
+Stores only see passwords already encrypted with the keychain keys. The
+``password`` column of an account then holds a reference to its token in the
+store, so reading a password costs no more than before for the database.
+
+References are never reused: each version of a password is put under a new
+one, and the previous version is deleted only once the transaction that
+replaced it commits. So cached tokens never get stale.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+from odoo.tools.config import config
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_logger = logging.getLogger(__name__)
+
+# Seconds to wait for the Vault API
+HTTP_TIMEOUT = 10
+# Start of the password column of accounts whose token is in a store
+PREFIX = 'store:'
+# Vault leases kept at once
+LEASES_SIZE = 1024
+
+
+class SecretStore(object):
+    """Key-value store of encrypted passwords."""
+
+    def get(self, ref):
+        """Get the token stored for a reference, or ``None``."""
+        raise NotImplementedError()
+
+    def put(self, ref, token):
+        """Store a token under a reference."""
+        raise NotImplementedError()
+
+    def delete(self, ref):
+        """Remove the token of a reference, if any."""
+        raise NotImplementedError()
+
+    def put_many(self, tokens):
+        """Store several tokens, given by reference."""
+        for ref, token in tokens.items():
+            self.put(ref, token)
+
+    def delete_many(self, refs):
+        """Remove the tokens of several references."""
+        for ref in refs:
+            self.delete(ref)
+
+
+class FileStore(SecretStore):
+    """Tokens kept in a local JSON file, read again only when it changes."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.tokens = {}
+
+    def _load(self):
+        """Read the file if it changed. Must be called with lock held."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.mtime, self.tokens = None, {}
+            return
+        # Each write replaces the file, so its inode changes too
+        mtime = (stat.st_ino, stat.st_mtime_ns)
+        if mtime != self.mtime:
+            with open(self.path) as vault:
+                self.tokens = json.load(vault)
+            self.mtime = mtime
+
+    def _update(self, changes):
+        """Change some tokens, atomically for other processes.
+
+        :param dict changes:
+            New tokens by reference, ``None`` to remove them.
+        """
+        with self.lock, open(self.path + '.lock', 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.mtime = None
+            self._load()
+            for ref, token in changes.items():
+                if token is None:
+                    self.tokens.pop(ref, None)
+                else:
+                    self.tokens[ref] = token
+            handle, temp = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.path)))
+            with os.fdopen(handle, 'w') as vault:
+                json.dump(self.tokens, vault)
+            os.chmod(temp, 0o600)
+            os.replace(temp, self.path)
+            self.mtime = None
+
+    def get(self, ref):
+        with self.lock:
+            self._load()
+            return self.tokens.get(ref)
+
+    def put(self, ref, token):
+        self._update({ref: token})
+
+    def delete(self, ref):
+        self._update({ref: None})
+
+    def put_many(self, tokens):
+        if tokens:
+            self._update(tokens)
+
+    def delete_many(self, refs):
+        if refs:
+            self._update(dict.fromkeys(refs))
+
+
+class VaultStore(SecretStore):
+    """Tokens kept in a Vault KV version 2 secrets engine."""
+
+    def __init__(self, url, token, mount='secret', ttl=60):
+        self.url = url.rstrip('/')
+        self.token = token
+        self.mount = mount
+        self.ttl = ttl
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # Expiration time and token, by reference, least recent first
+        self.leases = OrderedDict()
+
+    def _session(self):
+        """HTTP session of this thread, reusing its connections."""
+        try:
+            return self.local.session
+        except AttributeError:
+            session = self.local.session = requests.Session()
+            session.headers['X-Vault-Token'] = self.token
+            return session
+
+    def _url(self, kind, ref):
+        return '%s/v1/%s/%s/%s' % (self.url, self.mount, kind, ref)
+
+    def get(self, ref):
+        with self.lock:
+            lease = self.leases.get(ref)
+            if lease and lease[0] > time.monotonic():
+                self.leases.move_to_end(ref)
+                return lease[1]
+        response = self._session().get(
+            self._url('data', ref), timeout=HTTP_TIMEOUT)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        body = response.json()
+        token = body['data']['data'].get('token')
+        ttl = body.get('lease_duration') or self.ttl
+        with self.lock:
+            self.leases[ref] = (time.monotonic() + ttl, token)
+            self.leases.move_to_end(ref)
+            while len(self.leases) > LEASES_SIZE:
+                self.leases.popitem(last=False)
+        return token
+
+    def put(self, ref, token):
+        with self.lock:
+            self.leases.pop(ref, None)
+        self._session().post(
+            self._url('data', ref),
+            json={'data': {'token': token}},
+            timeout=HTTP_TIMEOUT,
+        ).raise_for_status()
+
+    def delete(self, ref):
+        with self.lock:
+            self.leases.pop(ref, None)
+        response = self._session().delete(
+            self._url('metadata', ref), timeout=HTTP_TIMEOUT)
+        if response.status_code != 404:
+            response.raise_for_status()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get():
+    """Get the configured store, or ``None`` to use the database."""
+    kind = config.get('keychain_store') or 'database'
+    if kind == 'database':
+        return None
+    options = tuple(config.get('keychain_store_%s' % name) for name in (
+        'path', 'url', 'token', 'mount', 'ttl'))
+    with _stores_lock:
+        key = (kind,) + options
+        if key not in _stores:
+            path, url, token, mount, ttl = options
+            if kind == 'file':
+                store = FileStore(path)
+            elif kind == 'vault':
+                store = VaultStore(
+                    url, token, mount or 'secret', float(ttl or 60))
+            else:
+                raise ValueError('Unknown keychain store %r' % kind)
+            _stores[key] = store
+        return _stores[key]
+
+
+def clear():
+    """Forget stores, with their cached leases and connections."""
+    with _stores_lock:
+        _stores.clear()
+
+
+def delete(store, refs):
+    """Remove tokens from a store, logging failures.
+
+    Used after transactions end, when errors cannot be reported anymore.
+
+    :param list refs:
+        References of the tokens.
+    """
+    try:
+        store.delete_many(refs)
+    except Exception:
+        _logger.warning(
+            "Cannot delete %s from keychain store", ", ".join(refs),
+            exc_info=True)
@@ -1,2 +1,3 @@
 from . import test_keychain
 from . import test_keychain_backend
+from . import test_benchmark
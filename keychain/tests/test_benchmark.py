@@ -0,0 +1,157 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""Throughput of keychain hot paths.
+
+Skipped unless the ``KEYCHAIN_BENCHMARK_ROUNDS`` environment variable says
+how many operations to time per case, i.e.::
+
+    KEYCHAIN_BENCHMARK_ROUNDS=5000 odoo -d test --test-enable -i keychain
+
+Results are logged, as they depend on the machine.
+"""
+
+import json
+import logging
+import os
+import time
+
+from mock import patch
+
+from odoo.tests.common import TransactionCase
+from odoo.tools.config import config
+
+from ..models import keychain as keychain_models
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from cryptography.fernet import Fernet
+except ImportError as err:
+    _logger.debug(err)
+
+# Accounts among which lookups are timed
+ACCOUNTS = 100000
+# Entries of the data whose parsing is timed
+DATA_ENTRIES = 10000
+
+
+class TestBenchmark(TransactionCase):
+
+    def setUp(self):
+        super(TestBenchmark, self).setUp()
+        self.rounds = int(os.environ.get('KEYCHAIN_BENCHMARK_ROUNDS') or 0)
+        if not self.rounds:
+            self.skipTest('Set KEYCHAIN_BENCHMARK_ROUNDS to run benchmarks')
+        self.keychain = self.env['keychain.account']
+        self.old_key = config.get('keychain_key')
+        self.old_running_env = config.get('running_env', '')
+        # Rotation in progress: a new key and an old one
+        config['keychain_key'] = '%s,%s' % (
+            Fernet.generate_key().decode(), Fernet.generate_key().decode())
+        config['running_env'] = None
+
+    def tearDown(self):
+        config['keychain_key'] = self.old_key
+        config['running_env'] = self.old_running_env
+        with keychain_models._ciphers_lock:
+            keychain_models._ciphers.clear()
+        super(TestBenchmark, self).tearDown()
+
+    def throughput(self, name, operation):
+        """Run an operation :attr:`rounds` times, logging its throughput.
+
+        :return float:
+            Operations per second.
+        """
+        start = time.perf_counter()
+        for _n in range(self.rounds):
+            operation()
+        result = self.rounds / (time.perf_counter() - start)
+        _logger.info('%s: %.0f per second', name, result)
+        return result
+
+    def test_decode(self):
+        """Decode passwords with cached ciphers, and building them."""
+        token = self.keychain._encode_password('secret', None).decode()
+
+        def _uncached():
+            # What every decode did before ciphers were cached
+            keychain_models._ciphers.clear()
+            self.keychain._decode_password(token)
+
+        def _cached():
+            self.keychain._decode_password(token)
+
+        uncached = self.throughput('Decode building ciphers', _uncached)
+        cached = self.throughput('Decode with cached ciphers', _cached)
+        _logger.info('Cached ciphers decode %.2f times faster',
+                     cached / uncached)
+
+    def test_retrieve(self):
+        """Retrieve accounts by technical name, with and without the fast
+        path, among many."""
+        self.env.cr.execute(
+            """INSERT INTO keychain_account
+                   (name, namespace, technical_name, login)
+               SELECT 'Benchmark', 'keychain_test', 'benchmark_' || n, 'a'
+               FROM generate_series(1, %s) AS n""", (ACCOUNTS,))
+        self.env.cr.execute('ANALYZE keychain_account')
+        self.env.cr.execute(
+            """EXPLAIN SELECT id FROM keychain_account
+               WHERE technical_name IN ('benchmark_1')
+                 AND (environment IS NULL OR environment IN ('dev'))""")
+        plan = '\n'.join(row[0] for row in self.env.cr.fetchall())
+        self.assertNotIn('Seq Scan', plan)
+        names = [
+            'benchmark_%d' % (n * 7919 % ACCOUNTS + 1)
+            for n in range(self.rounds)]
+
+        def _lookups(retrieve):
+            names_iter = iter(names)
+
+            def _lookup():
+                domain = [['technical_name', '=', next(names_iter)]]
+                self.assertEqual(len(retrieve(domain)), 1)
+            return _lookup
+
+        def _search(domain):
+            # What every retrieve did before the fast path
+            domain.append(
+                ['environment', 'in', self.keychain._retrieve_env()])
+            return self.keychain.search(domain)
+
+        generic = self.throughput(
+            'Retrieve through search among %d' % ACCOUNTS, _lookups(_search))
+        fast = self.throughput(
+            'Retrieve by technical name among %d' % ACCOUNTS,
+            _lookups(self.keychain.retrieve))
+        _logger.info('Retrieving by technical name is %.2f times faster',
+                     fast / generic)
+
+    def test_get_data(self):
+        """Get big data parsed once per version, and parsing it each time."""
+        field = self.keychain._fields['namespace']
+        # The field is shared by the registry: patch a copy, undone after
+        patcher = patch.object(
+            field, 'selection', field.selection + [('keychain_test', 'test')])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        account = self.keychain.create({
+            'name': 'Benchmark',
+            'namespace': 'keychain_test',
+            'technical_name': 'benchmark',
+            'data': json.dumps({
+                'entry_%d' % n: {'code': n, 'tags': ['a', 'b'], 'on': True}
+                for n in range(DATA_ENTRIES)
+            }),
+        })
+        parsed = self.throughput(
+            'Parse data of %d entries' % DATA_ENTRIES,
+            lambda: account._parse_data(account.data))
+        cached = self.throughput(
+            'Get data of %d entries' % DATA_ENTRIES, account.get_data)
+        self.throughput(
+            'Get mutable data of %d entries' % DATA_ENTRIES,
+            account.get_mutable_data)
+        _logger.info('Getting data is %.2f times faster than parsing it',
+                     cached / parsed)
+        self.assertGreater(cached, parsed)
@@ -4,9 +4,20 @@
 from odoo.tests.common import TransactionCase
 from odoo.tools.config import config
 from odoo.exceptions import ValidationError
+from odoo.tools import mute_logger
+
+from .. import stores
 
 
 import logging
+import os
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from json import dumps, loads
+
+from mock import patch
 
 _logger = logging.getLogger(__name__)
 
@@ -16,6 +27,55 @@ except ImportError as err:
     _logger.debug(err)
 
 
+class VaultHandler(BaseHTTPRequestHandler):
+    """Stand-in for the subset of Vault's KV version 2 API in use."""
+
+    secrets = {}
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body=None):
+        payload = dumps(body or {}).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _path(self):
+        if self.headers.get('X-Vault-Token') != 'test-token':
+            self._reply(403)
+            return None
+        return self.path.split('/', 4)[-1]
+
+    def do_GET(self):
+        path = self._path()
+        if path is None:
+            return
+        if path not in self.secrets:
+            return self._reply(404)
+        self._reply(200, {
+            'lease_duration': 0,
+            'data': {'data': self.secrets[path]},
+        })
+
+    def do_POST(self):
+        path = self._path()
+        if path is None:
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        self.secrets[path] = loads(self.rfile.read(length).decode())['data']
+        self._reply(200)
+
+    def do_DELETE(self):
+        path = self._path()
+        if path is None:
+            return
+        self.secrets.pop(path, None)
+        self._reply(204)
+
+
 class TestKeychain(TransactionCase):
 
     def setUp(self):
@@ -49,12 +109,13 @@ class TestKeychain(TransactionCase):
         config['running_env'] = self.old_running_env
         return super(TestKeychain, self).tearDown()
 
-    def _create_account(self):
+    def _create_account(self, technical_name="keychain.test", env=False):
         vals = {
             "name": "test",
             "namespace": "keychain_test",
             "login": "test",
-            "technical_name": "keychain.test"
+            "technical_name": technical_name,
+            "environment": env,
         }
         return self.keychain.create(vals)
 
@@ -220,3 +281,254 @@ class TestKeychain(TransactionCase):
                 self.assertTrue(True, 'Should validate json')
             except:
                 self.assertTrue(False, 'It should validate a good json')
+
+    def test_cipher_cache(self):
+        """Ciphers are reused until keys change."""
+        cipher = self.keychain._get_cipher()
+        self.assertIs(self.keychain._get_cipher(), cipher)
+        config['keychain_key'] = Fernet.generate_key()
+        new_cipher = self.keychain._get_cipher()
+        self.assertIsNot(new_cipher, cipher)
+        self.assertIs(self.keychain._get_cipher(), new_cipher)
+        self.keychain.clear_caches()
+        self.assertIsNot(self.keychain._get_cipher(), new_cipher)
+
+    def test_get_many(self):
+        """Passwords and data of several accounts are read at once."""
+        accounts = self._create_account() | self._create_account("other")
+        for account, password in zip(accounts, ('abc', 'def')):
+            account.clear_password = password
+            account._inverse_set_password()
+            account.write({'data': '{"c": "%s"}' % password})
+        self.assertDictEqual(accounts.get_passwords(), {
+            accounts[0].id: 'abc',
+            accounts[1].id: 'def',
+        })
+        self.assertDictEqual(accounts.get_data_many(), {
+            accounts[0].id: {'c': 'abc'},
+            accounts[1].id: {'c': 'def'},
+        })
+
+    def test_secret_cache(self):
+        """Decrypted passwords are cached until their tokens change."""
+        account = self._create_account()
+        account.clear_password = 'abc'
+        account._inverse_set_password()
+        config['keychain_cache_ttl'] = 60
+        try:
+            self.assertEqual(account._get_password(), 'abc')
+            keychain_clss = self.keychain.__class__
+            keychain_clss._decode_password = classmethod(
+                lambda cls, data, cipher=None: 'not cached')
+            try:
+                self.assertEqual(account._get_password(), 'abc')
+            finally:
+                del keychain_clss._decode_password
+            # Changed by another worker within the same second
+            self.env.cr.execute(
+                "UPDATE keychain_account SET password = 'x' WHERE id = %s",
+                (account.id,))
+            account.invalidate_cache()
+            with self.assertRaises(Warning):
+                account._get_password()
+        finally:
+            config['keychain_cache_ttl'] = 0
+            self.keychain.clear_caches()
+
+    def test_rotate_keys(self):
+        """Passwords are encrypted again with the new key."""
+        account = self._create_account()
+        account.clear_password = 'abc'
+        account._inverse_set_password()
+        old_key = config['keychain_key']
+        new_key = Fernet.generate_key()
+        config['keychain_key'] = b','.join([new_key, old_key])
+        self.assertEqual(account._get_password(), 'abc')
+        self.assertTrue(self.keychain._rotate_keys(chunk_size=1))
+        config['keychain_key'] = new_key
+        self.assertEqual(account._get_password(), 'abc')
+        self.assertFalse(self.keychain._rotation_progress())
+
+    def test_rotate_keys_unreadable(self):
+        """Passwords that cannot be rotated are not counted."""
+        account = self._create_account()
+        account.clear_password = 'abc'
+        account._inverse_set_password()
+        other = self._create_account('other')
+        self.env.cr.execute(
+            "UPDATE keychain_account SET password = 'x' WHERE id = %s",
+            (other.id,))
+        with mute_logger('odoo.addons.keychain.models.keychain'):
+            self.assertEqual(self.keychain._rotate_keys(), 1)
+        other.invalidate_cache()
+        self.assertEqual(other.password, 'x')
+        self.assertEqual(account._get_password(), 'abc')
+
+    def test_retrieve_by_technical_name(self):
+        """Exact technical name lookups match generic searches."""
+        config['running_env'] = 'dev'
+        blank = self._create_account()
+        dev = self._create_account(env='dev')
+        self._create_account(env='prod')
+        other = self._create_account("other")
+        domain = [('technical_name', '=', 'keychain.test')]
+        self.assertIsNotNone(
+            self.keychain._retrieve_by_technical_name(domain))
+        self.assertEqual(self.keychain.retrieve(domain), blank | dev)
+        self.assertEqual(
+            self.keychain.retrieve([
+                ('namespace', '=', 'keychain_test'),
+                ('technical_name', 'in', ['keychain.test', 'other']),
+            ]),
+            blank | dev | other)
+        self.assertFalse(self.keychain.retrieve([
+            ('namespace', '=', 'other'),
+            ('technical_name', '=', 'keychain.test'),
+        ]))
+        # Other domains take the generic path
+        self.assertIsNone(self.keychain._retrieve_by_technical_name(
+            [('technical_name', 'like', 'keychain')]))
+        self.assertEqual(
+            self.keychain.retrieve([('technical_name', 'like', 'keychain')]),
+            blank | dev)
+
+    def test_retrieve_by_technical_name_env(self):
+        """Accounts without env are found only if False is an env."""
+        blank = self._create_account()
+        dev = self._create_account(env='dev')
+        keychain_clss = self.keychain.__class__
+        keychain_clss._retrieve_env = staticmethod(lambda: ['dev', 'test'])
+        try:
+            domain = [('technical_name', '=', 'keychain.test')]
+            self.assertEqual(self.keychain.retrieve(domain), dev)
+            self.assertEqual(self.keychain.search(
+                domain + [('environment', 'in', ['dev', 'test'])]), dev)
+        finally:
+            del keychain_clss._retrieve_env
+        self.assertEqual(self.keychain.retrieve(domain), blank)
+
+    def test_technical_name_unique(self):
+        """Technical names are unique per environment."""
+        self._create_account(env='dev')
+        with self.assertRaises(Exception), self.env.cr.savepoint(), \
+                mute_logger('odoo.sql_db'):
+            self._create_account(env='dev')
+
+    def test_data_cache(self):
+        """Data is parsed once per version, and cannot be modified."""
+        account = self._create_account()
+        account.write({'data': '{"c": true, "l": [{"a": 1}]}'})
+        data = account.get_data()
+        self.assertIs(account.get_data(), data)
+        with self.assertRaises(TypeError):
+            data['c'] = False
+        with self.assertRaises(TypeError):
+            data['l'][0]['a'] = 2
+        account.write({'data': '{"c": false}'})
+        self.assertEqual(dict(account.get_data()), {'c': False})
+        # Changed by another worker within the same second
+        self.env.cr.execute(
+            """UPDATE keychain_account SET data = '{"c": 1}'
+               WHERE id = %s""", (account.id,))
+        account.invalidate_cache()
+        self.assertEqual(dict(account.get_data()), {'c': 1})
+
+    def test_mutable_data(self):
+        """Callers may get copies of data to modify or serialize."""
+        account = self._create_account()
+        account.write({'data': '{"c": true, "l": [{"a": 1}]}'})
+        data = account.get_mutable_data()
+        self.assertEqual(loads(dumps(data)), data)
+        data['c'] = False
+        data['l'][0]['a'] = 2
+        self.assertEqual(
+            account.get_mutable_data(), {'c': True, 'l': [{'a': 1}]})
+
+    def _check_store(self):
+        """Passwords go to the configured store, not to the database."""
+        account = self._create_account()
+        account.clear_password = 'abc'
+        account._inverse_set_password()
+        self.assertTrue(account.password.startswith('store:'))
+        self.assertEqual(account._get_password(), 'abc')
+        # New versions get new references, old ones are kept until commit
+        ref = account.password[len('store:'):]
+        account.clear_password = 'ghi'
+        account._inverse_set_password()
+        self.assertNotEqual(account.password, 'store:' + ref)
+        self.assertEqual(account._get_password(), 'ghi')
+        store = stores.get()
+        self.assertIsNotNone(store.get(ref))
+        # Existing passwords can be moved too
+        config['keychain_store'] = 'database'
+        other = self._create_account('other')
+        other.clear_password = 'def'
+        other._inverse_set_password()
+        self.assertTrue(other.password.startswith('gAAAA'))
+        config['keychain_store'] = self.store
+        self.assertTrue(self.keychain._move_to_store())
+        self.assertTrue(other.password.startswith('store:'))
+        self.assertEqual(
+            (account | other).get_passwords(),
+            {account.id: 'ghi', other.id: 'def'})
+        ref = other.password[len('store:'):]
+        other.unlink()
+        self.assertIsNotNone(store.get(ref))
+        return account
+
+    def test_file_store(self):
+        """Passwords can be kept in a local vault file."""
+        folder = tempfile.mkdtemp()
+        self.store = config['keychain_store'] = 'file'
+        config['keychain_store_path'] = os.path.join(folder, 'vault.json')
+        try:
+            account = self._check_store()
+            with open(config['keychain_store_path']) as vault:
+                self.assertIn(
+                    account.password[len('store:'):], loads(vault.read()))
+        finally:
+            config['keychain_store'] = 'database'
+            self.keychain.clear_caches()
+            shutil.rmtree(folder)
+
+    def test_file_store_many(self):
+        """Tokens are written to the vault file at once."""
+        folder = tempfile.mkdtemp()
+        try:
+            store = stores.FileStore(os.path.join(folder, 'vault.json'))
+            with patch.object(stores.os, 'replace', wraps=os.replace) as swap:
+                store.put_many({'a': 'x', 'b': 'y', 'c': 'z'})
+                store.delete_many(['a', 'b'])
+                self.assertEqual(swap.call_count, 2)
+            self.assertIsNone(store.get('a'))
+            self.assertEqual(store.get('c'), 'z')
+        finally:
+            shutil.rmtree(folder)
+
+    def test_vault_store(self):
+        """Passwords can be kept in a Vault KV secrets engine."""
+        VaultHandler.secrets = {}
+        server = HTTPServer(('127.0.0.1', 0), VaultHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.store = config['keychain_store'] = 'vault'
+        config['keychain_store_url'] = 'http://127.0.0.1:%d' % (
+            server.server_port)
+        config['keychain_store_token'] = 'test-token'
+        try:
+            account = self._check_store()
+            self.assertIn(
+                account.password[len('store:'):], VaultHandler.secrets)
+            # Leases kept are capped
+            store = stores.get()
+            store.leases.clear()
+            with patch.object(stores, 'LEASES_SIZE', 1):
+                for ref in list(VaultHandler.secrets)[:2]:
+                    store.get(ref)
+                self.assertEqual(len(store.leases), 1)
+        finally:
+            config['keychain_store'] = 'database'
+            self.keychain.clear_caches()
+            server.shutdown()
+            server.server_close()
@@ -57,7 +57,7 @@ class TestKeychain(TransactionCase):
         backend._inverse_keychain()
         account = backend._get_existing_keychain()
         self.assertDictEqual(
-            account.get_data(), {"a": "o", "c": "b"},
+            dict(account.get_data()), {"a": "o", "c": "b"},
             'Account data is not correct')
         backend._inverse_password()
         self.assertTrue(account, 'Account was not created')
@@ -78,3 +78,25 @@ class TestKeychain(TransactionCase):
         self.assertEqual(
             account.technical_name, '%s,%s' % (backend._name, backend.id),
             'Account technical_name is not correct')
+
+    def test_keychain_backend_many(self):
+        """Accounts of several backends are computed at once."""
+        config['keychain_key_dev'] = Fernet.generate_key()
+        config['running_env'] = 'dev'
+        backends = self.keychain_backend.browse()
+        for name in ('backend_1', 'backend_2'):
+            backend = self.keychain_backend.new({
+                'name': name,
+                'password': name,
+                'data': '{"c": "%s"}' % name,
+            })
+            backend._inverse_keychain()
+            backend._inverse_password()
+            backends |= backend
+        accounts = backends._get_existing_keychains()
+        self.assertEqual(len(accounts), 2)
+        backends._compute_keychain()
+        self.assertEqual(backends.mapped('password'), ['******'] * 2)
+        self.assertEqual(
+            [backend.data for backend in backends],
+            [{'c': 'backend_1'}, {'c': 'backend_2'}])
@@ -4,7 +4,7 @@
 
     'name': 'Password Security',
     "summary": "Allow admin to set password security requirements.",
-    'version': '11.0.1.2.0',
+    'version': '11.0.1.4.0',
     'author':
         "LasLabs, "
         "Kaushal Prajapati, "
@@ -21,6 +21,7 @@
         'views/res_company_view.xml',
         'security/ir.model.access.csv',
         'security/res_users_pass_history.xml',
+        'data/ir_cron.xml',
     ],
     "demo": [
         'demo/res_users.xml',
@@ -0,0 +1,150 @@
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+"""Verification of a password against a history of hashes.
+
+Each verification is a deliberately slow key derivation, so a history of 30
+hashes costs seconds of CPU. :func:`matches_any` verifies them most recent
+first, and stops at the first match.
+
+It can spread them over a pool of processes instead, but only if configured:
+pool processes are forked from the server, which may run threads, and are
+not subject to its worker limits. On a match, tasks not started yet are
+skipped; running ones cannot be interrupted and finish in the background.
+
+Hashes are grouped by scheme and rounds, so each task verifies hashes of the
+same cost with a handler resolved once. Their salts differ, so the key
+derivation itself cannot be shared.
+
+Server options:
+
+* ``password_security_history_workers``: processes in the pool. ``1`` by
+  default, which verifies in the calling process, as does ``0``.
+* ``password_security_history_cap``: hashes verified at most, even when the
+  company keeps an unlimited history, ``1000`` by default.
+"""
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from odoo.tools import config
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from passlib.registry import get_crypt_handler
+except ImportError as err:
+    _logger.debug(err)
+
+# Default hard cap of hashes verified
+CAP = 1000
+# Tasks submitted per worker, to skip pending work early on a match
+TASKS_PER_WORKER = 2
+
+_pool = None
+# Process and size the pool was created for
+_pool_key = None
+_pool_lock = threading.Lock()
+
+
+def workers():
+    """Processes to verify hashes with, from server options."""
+    return int(config.get('password_security_history_workers') or 1)
+
+
+def cap():
+    """Maximum amount of hashes to verify, from server options."""
+    return int(config.get('password_security_history_cap') or CAP)
+
+
+def _get_pool(size):
+    """Pool of this process, created again after forks or resizes."""
+    global _pool, _pool_key
+    key = (os.getpid(), size)
+    with _pool_lock:
+        if _pool_key != key:
+            if _pool is not None and _pool_key[0] == key[0]:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(size)
+            _pool_key = key
+        return _pool
+
+
+def _verify(scheme, password, hashes):
+    """Tell whether a password matches any hash of a scheme."""
+    handler = get_crypt_handler(scheme)
+    return any(handler.verify(password, hashed) for hashed in hashes)
+
+
+def _tasks(crypt, hashes, size):
+    """Split hashes into tasks of one scheme and rounds each.
+
+    :return list:
+        ``(scheme, hashes)`` tuples, keeping the order of hashes within
+        each group.
+    """
+    groups = OrderedDict()
+    for hashed in hashes:
+        try:
+            handler = crypt.identify(hashed, resolve=True)
+        except (TypeError, ValueError):
+            handler = None
+        if handler is None:
+            # Empty or unknown hashes never match
+            continue
+        try:
+            rounds = handler.from_string(hashed).rounds
+        except (AttributeError, ValueError):
+            rounds = None
+        groups.setdefault((handler.name, rounds), []).append(hashed)
+    tasks = []
+    for (scheme, _rounds), group in groups.items():
+        for start in range(0, len(group), size):
+            tasks.append((scheme, group[start:start + size]))
+    return tasks
+
+
+def matches_any(crypt, password, hashes, size=None):
+    """Tell whether a password matches any of some hashes.
+
+    :param crypt:
+        ``passlib`` context that identifies hashes.
+
+    :param list hashes:
+        Hashes to verify, most recent first. Only the first :func:`cap` of
+        them are verified.
+
+    :param int size:
+        Processes to use; see :func:`workers` for the default.
+
+    :return bool:
+    """
+    hashes = list(hashes)[:cap()]
+    size = workers() if size is None else size
+    if size <= 1 or len(hashes) <= 1:
+        return any(
+            _verify(scheme, password, group)
+            for scheme, group in _tasks(crypt, hashes, len(hashes) or 1))
+    chunk = -(-len(hashes) // (size * TASKS_PER_WORKER))
+    tasks = _tasks(crypt, hashes, chunk)
+    try:
+        pool = _get_pool(size)
+        pending = {
+            pool.submit(_verify, scheme, password, group)
+            for scheme, group in tasks
+        }
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            if any(future.result() for future in done):
+                # Only tasks not started yet are skipped
+                for future in pending:
+                    future.cancel()
+                return True
+        return False
+    except Exception:
+        _logger.warning(
+            'Cannot verify password history in a process pool, '
+            'verifying it in this process', exc_info=True)
+        return any(
+            _verify(scheme, password, group) for scheme, group in tasks)
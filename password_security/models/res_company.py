@@ -2,7 +2,21 @@
 # Copyright 2017 Kaushal Prajapati <kbprajapati@live.com>.
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
 
-from odoo import models, fields
+import threading
+
+from odoo import api, fields, models
+
+from ..policy import PasswordPolicy
+
+# Fields compiled into password policies
+POLICY_FIELDS = (
+    'password_lower', 'password_upper', 'password_numeric',
+    'password_special', 'password_length',
+)
+
+# Policy version and compiled policy, by database and company
+_policies = {}
+_policies_lock = threading.Lock()
 
 
 class ResCompany(models.Model):
@@ -49,3 +63,55 @@ class ResCompany(models.Model):
         default=24,
         help='Amount of hours until a user may change password again',
     )
+    password_policy_version = fields.Integer(
+        readonly=True,
+        copy=False,
+        help='Increased on every change of the password policy',
+    )
+
+    @api.multi
+    def write(self, vals):
+        res = super(ResCompany, self).write(vals)
+        if self and any(field in vals for field in POLICY_FIELDS):
+            # Write dates may not change within the same second, so other
+            # workers find out about the change through the version
+            self.env.cr.execute(
+                'UPDATE res_company '
+                'SET password_policy_version = '
+                'COALESCE(password_policy_version, 0) + 1 '
+                'WHERE id IN %s',
+                (tuple(self.ids),),
+            )
+            self.invalidate_cache(['password_policy_version'], self.ids)
+            with _policies_lock:
+                for company_id in self.ids:
+                    _policies.pop((self.env.cr.dbname, company_id), None)
+        return res
+
+    @api.multi
+    def _get_password_policy(self):
+        """ It returns the compiled password policy of the company
+
+        Policies are compiled once per version of the company policy, and
+        only the last one is kept.
+
+        :rtype: PasswordPolicy
+        """
+        self.ensure_one()
+        key = self.env.cr.dbname, self.id
+        with _policies_lock:
+            cached = _policies.get(key)
+        version = self.sudo().password_policy_version
+        if cached and cached[0] == version:
+            return cached[1]
+        company = self.sudo()
+        policy = PasswordPolicy(
+            lower=company.password_lower,
+            upper=company.password_upper,
+            numeric=company.password_numeric,
+            special=company.password_special,
+            length=company.password_length,
+        )
+        with _policies_lock:
+            _policies[key] = version, policy
+        return policy
@@ -2,12 +2,11 @@
 # Copyright 2017 Kaushal Prajapati <kbprajapati@live.com>.
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
 
-import re
-
 from datetime import datetime, timedelta
 
-from odoo import api, fields, models, _
+from odoo import api, fields, models, tools, _
 
+from .. import history
 from ..exceptions import PassError
 
 
@@ -46,31 +45,33 @@ class ResUsers(models.Model):
     @api.multi
     def password_match_message(self):
         self.ensure_one()
-        company_id = self.company_id
-        message = [_('Must contain the following:')]
-        if company_id.password_lower:
-            message.append(
-                _("* %d lowercase characters.") % company_id.password_lower
-            )
-        if company_id.password_upper:
-            message.append(
-                _("* %d uppercase characters.") % company_id.password_upper
-            )
-        if company_id.password_numeric:
-            message.append(
-                _("* %d numbers.") % company_id.password_numeric
-            )
-        if company_id.password_special:
-            message.append(
-                _("* %d special characters.") % company_id.password_special
-            )
-        if company_id.password_length:
-            message.append(
-                _("* A length of at least %d characters.") %
-                company_id.password_length
-            )
-        if len(message) == 1:
+        policy = self.company_id._get_password_policy()
+        return self._password_rules_message(policy.rules)
+
+    @api.model
+    @tools.ormcache_context(keys=('lang',))
+    def _get_password_rule_messages(self):
+        """ It returns translated messages of password rules, by rule """
+        return {
+            'header': _('Must contain the following:'),
+            'lower': _("* %d lowercase characters."),
+            'upper': _("* %d uppercase characters."),
+            'numeric': _("* %d numbers."),
+            'special': _("* %d special characters."),
+            'length': _("* A length of at least %d characters."),
+        }
+
+    @api.model
+    def _password_rules_message(self, rules):
+        """ It describes password rules
+        :param rules: ``(rule, minimum)`` tuples, from ``PasswordPolicy``
+        :return: Translated message, or an empty string without rules
+        """
+        if not rules:
             return ""
+        messages = self._get_password_rule_messages()
+        message = [messages['header']]
+        message.extend(messages[rule] % minimum for rule, minimum in rules)
         return '\n'.join(message)
 
     @api.multi
@@ -84,17 +85,9 @@ class ResUsers(models.Model):
         self.ensure_one()
         if not password:
             return True
-        company_id = self.company_id
-        password_regex = [
-            '^',
-            '(?=.*?[a-z]){' + str(company_id.password_lower) + ',}',
-            '(?=.*?[A-Z]){' + str(company_id.password_upper) + ',}',
-            '(?=.*?\\d){' + str(company_id.password_numeric) + ',}',
-            r'(?=.*?[\W_]){' + str(company_id.password_special) + ',}',
-            '.{%d,}$' % int(company_id.password_length),
-        ]
-        if not re.search(''.join(password_regex), password):
-            raise PassError(self.password_match_message())
+        broken = self.company_id._get_password_policy().check(password)
+        if broken:
+            raise PassError(self._password_rules_message(broken))
         return True
 
     @api.multi
@@ -147,16 +140,16 @@ class ResUsers(models.Model):
         :raises: PassError on reused password
         """
         crypt = self._crypt_context()
+        history_obj = self.env['res.users.pass.history'].sudo()
         for rec_id in self:
             recent_passes = rec_id.company_id.password_history
-            if recent_passes < 0:
-                recent_passes = rec_id.password_history_ids
-            else:
-                recent_passes = rec_id.password_history_ids[
-                    0:recent_passes-1
-                ]
-            if recent_passes.filtered(
-                    lambda r: crypt.verify(password, r.password_crypt)):
+            if not recent_passes:
+                continue
+            limit = history.cap()
+            if recent_passes > 0:
+                limit = min(recent_passes, limit)
+            crypts = history_obj._get_recent_crypts(rec_id.id, limit)
+            if history.matches_any(crypt, password, crypts):
                 raise PassError(
                     _('Cannot use the most recent %d passwords') %
                     rec_id.company_id.password_history
@@ -171,3 +164,4 @@ class ResUsers(models.Model):
                 'password_crypt': encrypted,
             })],
         })
+        self.env['res.users.pass.history'].sudo()._prune(self.ids)
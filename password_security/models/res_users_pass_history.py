@@ -1,7 +1,7 @@
 # Copyright 2016 LasLabs Inc.
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
 
-from odoo import fields, models
+from odoo import api, fields, models
 
 
 class ResUsersPassHistory(models.Model):
@@ -23,3 +23,72 @@ class ResUsersPassHistory(models.Model):
         default=lambda s: fields.Datetime.now(),
         index=True,
     )
+
+    @api.model_cr
+    def init(self):
+        """ It indexes the history of each user by date """
+        self.env.cr.execute(
+            "SELECT 1 FROM pg_indexes WHERE indexname = %s",
+            ('res_users_pass_history_user_id_date_idx',),
+        )
+        if not self.env.cr.fetchone():
+            self.env.cr.execute(
+                "CREATE INDEX res_users_pass_history_user_id_date_idx "
+                "ON res_users_pass_history (user_id, date DESC, id DESC)"
+            )
+
+    @api.model
+    def _get_recent_crypts(self, user_id, limit):
+        """ It returns the most recent hashes of a user, newest first """
+        self.env.cr.execute(
+            """SELECT password_crypt FROM res_users_pass_history
+               WHERE user_id = %s
+               ORDER BY date DESC, id DESC
+               LIMIT %s""",
+            (user_id, limit),
+        )
+        return [row[0] for row in self.env.cr.fetchall()]
+
+    @api.model
+    def _prune(self, user_ids=None):
+        """ It deletes history beyond the length kept by each company
+
+        Companies keeping an unlimited history, or none, are left alone.
+
+        :param user_ids: Users to prune, or ``None`` for all of them
+        :return: Amount of deleted rows
+        """
+        where, params = '', {}
+        if user_ids is not None:
+            if not user_ids:
+                return 0
+            where, params = 'WHERE h.user_id IN %(ids)s', {
+                'ids': tuple(user_ids),
+            }
+        self.env.cr.execute(
+            """DELETE FROM res_users_pass_history WHERE id IN (
+                   SELECT id FROM (
+                       SELECT h.id, c.password_history AS keep,
+                              row_number() OVER (
+                                  PARTITION BY h.user_id
+                                  ORDER BY h.date DESC, h.id DESC
+                              ) AS rank
+                       FROM res_users_pass_history h
+                       JOIN res_users u ON u.id = h.user_id
+                       JOIN res_company c ON c.id = u.company_id
+                       {}
+                   ) ranked
+                   WHERE keep > 0 AND rank > keep
+               )""".format(where),
+            params,
+        )
+        deleted = self.env.cr.rowcount
+        if deleted:
+            self.invalidate_cache()
+            self.env['res.users'].invalidate_cache(['password_history_ids'])
+        return deleted
+
+    @api.model
+    def _cron_prune(self):
+        """ It prunes the history of all users """
+        return self._prune()
@@ -0,0 +1,66 @@
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+"""Password policy of a company, compiled once per version of it.
+
+See ``res.company._get_password_policy()``.
+"""
+
+# Rules, in the order they are reported
+RULES = ('lower', 'upper', 'numeric', 'special', 'length')
+
+
+class PasswordPolicy(object):
+    """Minimum amounts of characters a password must contain.
+
+    Passwords are checked in one pass over their characters, and all the
+    rules they break are reported at once.
+    """
+
+    __slots__ = ('rules',)
+
+    def __init__(self, **minimums):
+        #: ``(rule, minimum)`` of rules that require something
+        self.rules = tuple(
+            (rule, minimums.get(rule) or 0) for rule in RULES
+            if (minimums.get(rule) or 0) > 0
+        )
+
+    @staticmethod
+    def count(password):
+        """Count the characters of a password for each rule.
+
+        Lowercase and uppercase letters are ASCII ones, numbers are any
+        decimal digit, and special characters are distinct characters that
+        are neither letters nor digits, or underscores.
+        """
+        lower = upper = numeric = 0
+        special = set()
+        for char in password:
+            if 'a' <= char <= 'z':
+                lower += 1
+            elif 'A' <= char <= 'Z':
+                upper += 1
+            elif char.isdecimal():
+                numeric += 1
+            elif char == '_' or not char.isalnum():
+                special.add(char)
+        return {
+            'lower': lower,
+            'upper': upper,
+            'numeric': numeric,
+            'special': len(special),
+            'length': len(password),
+        }
+
+    def check(self, password):
+        """Get the rules a password breaks.
+
+        :return list: ``(rule, minimum)`` of broken rules, in :data:`RULES`
+            order.
+        """
+        if not self.rules:
+            return []
+        counts = self.count(password)
+        return [
+            (rule, minimum) for rule, minimum in self.rules
+            if counts[rule] < minimum
+        ]
@@ -4,3 +4,4 @@
 from . import test_res_users
 from . import test_password_security_home
 from . import test_password_security_session
+from . import test_history
@@ -0,0 +1,54 @@
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+import logging
+import os
+import time
+
+from unittest.mock import patch
+
+from odoo.tests.common import TransactionCase
+
+from .. import history
+
+_logger = logging.getLogger(__name__)
+
+
+class TestHistory(TransactionCase):
+
+    def setUp(self):
+        super(TestHistory, self).setUp()
+        self.crypt = self.env['res.users']._crypt_context()
+        self.hashes = [self.crypt.hash('pass%d' % n) for n in range(4)]
+
+    def test_matches_any(self):
+        """ It should find reused passwords, in and out of the pool """
+        hashes = self.hashes + [None, '', 'unknown']
+        for size in (1, 2):
+            self.assertTrue(history.matches_any(
+                self.crypt, 'pass3', hashes, size))
+            self.assertFalse(history.matches_any(
+                self.crypt, 'other', hashes, size))
+
+    def test_cap(self):
+        """ It should verify a limited amount of hashes """
+        with patch.object(history, 'cap', return_value=3):
+            self.assertTrue(history.matches_any(
+                self.crypt, 'pass2', self.hashes, 1))
+            self.assertFalse(history.matches_any(
+                self.crypt, 'pass3', self.hashes, 1))
+
+    def test_benchmark(self):
+        """ It should log the time to check 30 and 300 past passwords
+
+        Skipped unless ``PASSWORD_SECURITY_BENCHMARK`` is set.
+        """
+        if not os.environ.get('PASSWORD_SECURITY_BENCHMARK'):
+            self.skipTest('Set PASSWORD_SECURITY_BENCHMARK to run it')
+        hashes = [self.crypt.hash('pass%d' % n) for n in range(300)]
+        for amount in (30, 300):
+            for size in (1, 4):
+                start = time.perf_counter()
+                history.matches_any(self.crypt, 'other', hashes[:amount], size)
+                _logger.info(
+                    '%d past passwords checked by %d processes in %.2f s',
+                    amount, size, time.perf_counter() - start)
@@ -159,3 +159,86 @@ class TestResUsers(TransactionCase):
             "name": "test1",
         })
         test1.unlink()
+
+    def test_check_password_history_length(self):
+        """ It should check exactly the most recent passwords """
+        rec_id = self._new_record()
+        self.main_comp.password_history = 2
+        rec_id.write({'password': 'asdQWE123$%^2'})
+        with self.assertRaises(PassError):
+            rec_id._check_password_history(self.password)
+        rec_id.write({'password': 'asdQWE123$%^3'})
+        rec_id._check_password_history(self.password)
+        with self.assertRaises(PassError):
+            rec_id._check_password_history('asdQWE123$%^2')
+
+    def test_check_password_history_disabled(self):
+        """ It should allow reuse when history is disabled """
+        rec_id = self._new_record()
+        self.main_comp.password_history = 0
+        rec_id._check_password_history(self.password)
+
+    def test_prune_password_history(self):
+        """ It should keep as many passwords as the company checks """
+        rec_id = self._new_record()
+        self.main_comp.password_history = 2
+        for password in ('asdQWE123$%^2', 'asdQWE123$%^3'):
+            rec_id.write({'password': password})
+        self.assertEqual(2, len(rec_id.password_history_ids))
+        self.main_comp.password_history = 1
+        history_obj = self.env['res.users.pass.history']
+        self.assertTrue(history_obj._cron_prune())
+        self.assertEqual(1, len(rec_id.password_history_ids))
+
+    def test_check_password_reports_all_rules(self):
+        """ It should report every rule a password breaks """
+        rec_id = self._new_record()
+        with self.assertRaises(PassError) as err:
+            rec_id._check_password_rules('password')
+        message = err.exception.message
+        self.assertIn('uppercase', message)
+        self.assertIn('numbers', message)
+        self.assertIn('special', message)
+        self.assertIn('length', message)
+        self.assertNotIn('lowercase', message)
+
+    def test_check_password_counts(self):
+        """ It should require the configured amount of characters """
+        rec_id = self._new_record()
+        self.main_comp.write({'password_numeric': 2, 'password_special': 2})
+        with self.assertRaises(PassError):
+            rec_id._check_password_rules('asdQWE123$$xy')
+        rec_id._check_password_rules('asdQWE123$%xy')
+
+    def test_password_policy_cache(self):
+        """ It should compile the policy once per company version """
+        policy = self.main_comp._get_password_policy()
+        self.assertIs(policy, self.main_comp._get_password_policy())
+        self.main_comp.password_length = 20
+        policy = self.main_comp._get_password_policy()
+        self.assertIn(('length', 20), policy.rules)
+
+    def test_password_policy_version(self):
+        """ It should compile again when other workers change the policy """
+        version = self.main_comp.password_policy_version
+        self.main_comp.password_length = 20
+        self.assertEqual(self.main_comp.password_policy_version, version + 1)
+        self.main_comp._get_password_policy()
+        # Another worker writes within the same second
+        self.env.cr.execute(
+            'UPDATE res_company SET password_length = 21, '
+            'password_policy_version = password_policy_version + 1 '
+            'WHERE id = %s',
+            (self.main_comp.id,),
+        )
+        self.main_comp.invalidate_cache()
+        policy = self.main_comp._get_password_policy()
+        self.assertIn(('length', 21), policy.rules)
+
+    def test_password_rule_messages_cache(self):
+        """ It should cache rule messages per language """
+        users = self.model_obj.with_context(lang='en_US')
+        messages = users._get_password_rule_messages()
+        self.assertIs(messages, users._get_password_rule_messages())
+        self.assertIn('header', self.model_obj.with_context(
+            lang=None)._get_password_rule_messages())